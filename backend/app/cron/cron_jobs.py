@@ -2,7 +2,7 @@ from apscheduler.triggers.cron import CronTrigger
 #from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
-from app.database import db
+from app.utils.jobs_utils import enqueue_job
 import logging
 import os
 
@@ -12,10 +12,10 @@ PROCESSING_HOURS = list(map(int, os.getenv("PROCESSING_HOURS", "4,8,16,20").spli
 VALIDATION_HOURS = list(map(int, os.getenv("VALIDATION_HOURS", "8").split(",")))
 
 async def enqueue_prepare_cron_processes_job():
-    await db["jobs"].insert_one({"type": "prepare_cron_processes", "data": {}})
+    await enqueue_job("prepare_cron_processes", {})
 
 async def enqueue_validate_processes_job():
-    await db["jobs"].insert_one({"type": "validate_processes", "data": {}})
+    await enqueue_job("validate_processes", {})
 
 # Initialize the scheduler
 #For asyncio-based applications, use AsyncIOScheduler
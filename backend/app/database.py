@@ -12,7 +12,9 @@ async def create_indexes():
         logging.info("Creating indexes for collections...")
         await db["records"].create_index("_id")
         await db["records"].create_index("repository")
+        await db["records"].create_index([("repository", 1), ("_id", 1)])
         await db["records"].create_index("version")
+        await db["record_buckets"].create_index([("repository", 1), ("_id", 1)])
         await db["repositories"].create_index("_id")
         await db["repositories"].create_index("data_ready")
         await db["repositories"].create_index("version")
@@ -24,11 +26,17 @@ async def create_indexes():
         await db["processes"].create_index("iteration")
         await db["processes"].create_index("validated")
         await db["processes"].create_index("status")
+        await db["uploads"].create_index("file_path")
+        await db["zone_maps"].create_index([("repository", 1), ("import_id", 1), ("first_id", 1)])
         await db["jobs"].create_index("_id")
+        await db["jobs"].create_index([("status", 1), ("_id", 1)])
+        await db["jobs"].create_index([("status", 1), ("lease_expires_at", 1)])
         await db["process_results"].create_index("_id")
         await db["process_results"].create_index("batch_number")
         await db["process_results"].create_index("process_id")
         await db["process_results"].create_index("process_item_id")
+        await db["process_results"].create_index([("process_item_id", 1), ("batch_number", 1)])
+        await db["process_shards"].create_index([("process_id", 1), ("iteration", 1), ("trigger_type", 1)])
         logging.info("Indexes created successfully.")
         
     except Exception as e:
@@ -1,7 +1,7 @@
 from app.logging_config import *
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.routers import auth, repositories, records, processes
+from app.routers import auth, repositories, records, processes, uploads
 from app.cron.cron_jobs import start_cron_jobs, stop_cron_jobs
 from app.database import create_indexes
 from dotenv import load_dotenv
@@ -26,6 +26,7 @@ app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(repositories.router, prefix="/api/repositories", tags=["repositories"])
 app.include_router(records.router, prefix="/api/records", tags=["records"])
 app.include_router(processes.router, prefix="/api/processes", tags=["processes"])
+app.include_router(uploads.router, prefix="/api/uploads", tags=["uploads"])
 
 # Start cron jobs when the application starts
 @app.on_event("startup")
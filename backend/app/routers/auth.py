@@ -1,5 +1,5 @@
 from fastapi import APIRouter, HTTPException, Depends
-from app.utils.auth_utils import create_access_token, get_current_user, get_user, verify_password, hash_password
+from app.utils.auth_utils import create_access_token, get_current_user, get_user, verify_password, hash_password, invalidate_user_cache
 from app.models.user import User, Token
 from app.database import db
 from datetime import timedelta
@@ -51,6 +51,8 @@ async def register(user: User):
         
         new_user = {"username": user.username, "role": role_name, "password": hashed_password}
         result = await db["users"].insert_one(new_user)
+        # Tokens of a removed user with the same username must not resolve to its cached role
+        invalidate_user_cache(user.username)
         access_token = create_access_token(data={"sub": user.username}, expires_delta=timedelta(minutes=TOKEN_EXPIRATION_TIME))
         
         return {"_id": str(result.inserted_id), "username": user.username, "access_token": access_token, "role": role_name, "token_type": "bearer"}
@@ -3,9 +3,11 @@ from app.utils.auth_utils import get_current_user
 from app.models.record import Record
 from app.utils.general_utils import get_query_params, validate_processes, validate_parameters, validate_operator, validate_aggregations, validate_aggregation_parameter_types
 from app.utils.repositories_utils import get_repository
+from app.utils.jobs_utils import enqueue_job
+from app.utils.csr_utils import CSRGroups
 from app.database import db
+from app.utils.responses_utils import MongoJSONResponse
 from bson.objectid import ObjectId
-from bson import json_util
 from datetime import datetime
 from dotenv import load_dotenv
 import logging
@@ -29,7 +31,7 @@ async def get_processes(repository_id: str, request:Request, current_user: dict
     
     processes = await db["processes"].find(parameters["query_params"], parameters["select"]).skip(parameters["offset"]).limit(parameters["limit"]).to_list(length=None)
     
-    return Response(status_code=200, content=json_util.dumps({"totalItems": totalItems, "totalPages": totalPages, "page": page, "items": processes}), media_type="application/json")
+    return MongoJSONResponse(status_code=200, content={"totalItems": totalItems, "totalPages": totalPages, "page": page, "items": processes})
 
 @router.post("/{repository_id}")
 async def process_data(repository_id: str, request: Request, current_user: dict = Depends(get_current_user)) -> dict:
@@ -94,9 +96,9 @@ async def process_data(repository_id: str, request: Request, current_user: dict
         processes_optimized.append({**base_aggregation_process, "optimized": True})
     try:    
         await db["processes"].insert_many(processes_non_optimized + processes_optimized)
-        await db["jobs"].insert_one({"type": "start_process", "data": {"process_id": str(process_id), "repository_id": str(repository_id), "actions": all_processes, "iteration": 1, "trigger_type": "user"}})
+        await enqueue_job("start_process", {"process_id": str(process_id), "repository_id": str(repository_id), "actions": all_processes, "iteration": 1, "trigger_type": "user"})
         
-        return Response(status_code=200, content=json_util.dumps({"process_id": str(process_id), "iteration": 1, "message": "Process started successfully"}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"process_id": str(process_id), "iteration": 1, "message": "Process started successfully"})
     except Exception as e:
         logging.error(f"Error starting process for repository {repository_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error starting process: {e}")
@@ -150,22 +152,49 @@ async def iterate_process(process_id: str, current_user: dict = Depends(get_curr
             })
         
         await db["processes"].insert_many(new_iteration_processes)
-        await db["jobs"].insert_one({"type": "start_process", "data": {"process_id": str(process_id), "repository_id": str(repository["_id"]), "actions": actions, "iteration": current_iteration + 1, "trigger_type": "user"}})
+        await enqueue_job("start_process", {"process_id": str(process_id), "repository_id": str(repository["_id"]), "actions": actions, "iteration": current_iteration + 1, "trigger_type": "user"})
         
-        return Response(status_code=200, content=json_util.dumps({"process_id": process_id, "iteration": current_iteration + 1, "message": "Process iteration started successfully"}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"process_id": process_id, "iteration": current_iteration + 1, "message": "Process iteration started successfully"})
     except Exception as e:
         logging.error(f"Error iterating process {process_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error iterating process: {e}")
 
+@router.get("/groups/{process_item_id}/{batch_number}")
+async def get_process_groups(process_item_id: str, batch_number: int, request: Request, current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Page through the groups of a batch of a group process, with their member counts and optionally their row ordinals.
+    """
+    if not current_user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    try:
+        limit = min(max(int(request.query_params.get("limit", 10)), 1), 100)
+        page = max(int(request.query_params.get("page", 1)), 1)
+        include_members = request.query_params.get("members", "").lower() == "true"
+        batch_result = await db["process_results"].find_one({"process_item_id": ObjectId(process_item_id), "batch_number": batch_number, "type": "group"}, {"groups": 1})
+        if batch_result is None or batch_result.get("groups") is None:
+            raise HTTPException(status_code=404, detail="Group results not found for the given process and batch")
+
+        groups = CSRGroups(batch_result["groups"])
+        totalItems = len(groups)
+        totalPages = totalItems // limit + (1 if totalItems % limit > 0 else 0)
+
+        return MongoJSONResponse(status_code=200, content={"totalItems": totalItems, "totalPages": totalPages, "page": page, "items": groups.page(limit * (page - 1), limit, include_members)})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Error getting groups of process {process_item_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error getting groups: {e}")
+
 @router.put("/validate")
 async def validate_processes_endpoint(request: Request, current_user: dict = Depends(get_current_user)) -> dict:
     """
     Validate processes.
     """
     try:
-        await db["jobs"].insert_one({"type": "validate_processes", "data": {}})
+        await enqueue_job("validate_processes", {})
         
-        return Response(status_code=201, content=json_util.dumps({"message": "validation_started"}), media_type="application/json")
+        return MongoJSONResponse(status_code=201, content={"message": "validation_started"})
     except Exception as e:
         logging.error(f"Error validating processes: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error validating processes: {e}")
@@ -179,9 +208,9 @@ async def reset_processes(repository_id: str, current_user: dict = Depends(get_c
         raise HTTPException(status_code=403, detail="You do not have permission to reset processes")
     
     try:
-        await db["jobs"].insert_one({"type": "reset_processes", "data": {"repository_id": repository_id}})
+        await enqueue_job("reset_processes", {"repository_id": repository_id})
         
-        return Response(status_code=200, content=json_util.dumps({"message": "Processes reset successfully"}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"message": "Processes reset successfully"})
     except Exception as e:
         logging.error(f"Error resetting processes for repository {repository_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error resetting processes: {e}")
\ No newline at end of file
@@ -1,54 +1,124 @@
 from fastapi import APIRouter, Response, Request, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from app.utils.auth_utils import get_current_user
 from typing import List, Any
 from app.models.record import Record
 from app.utils.general_utils import get_query_params
-from app.utils.records_utils import validate_permissions_and_repository, update_repository_info
+from app.utils.records_utils import RECORDS_BULK_MAX_OPERATIONS, validate_permissions_and_repository, validate_records_frame, update_repository_info, apply_records_bulk, get_record_ids_prefix, invalidate_zone_maps
+from app.utils.bson_utils import record_object_id
+from app.utils.records_layout_utils import RECORDS_BUCKET_SIZE, get_layout_repository, get_records_collection_name, is_bucketed
+from app.utils.records_export_utils import EXPORT_FORMATS, export_records
+from app.utils.buckets_utils import find_bucket, get_bucket_record, get_buckets_page, get_buckets_after, select_fields, insert_bucket_record, update_bucket_record, delete_bucket_record
 from app.database import db
+from app.utils.responses_utils import MongoJSONResponse
 from bson.objectid import ObjectId
-from bson import json_util
+from pymongo import ReturnDocument
 from datetime import datetime
 
 router = APIRouter()
 
+async def find_record(record_id: str, repository_id: str = None):
+    """
+    Find a record in the collection of its repository, a row of a bucket for bucketed repositories.
+    Without a repository the record is looked up in the shared records collection.
+    """
+    repository = await get_layout_repository(repository_id) if repository_id else {"_id": None}
+    records_collection = db[get_records_collection_name(repository)]
+    if is_bucketed(repository):
+        bucket, index = await find_bucket(records_collection, repository_id, record_id)
+        return (get_bucket_record(bucket, index) if bucket is not None else None), records_collection, True
+    return await records_collection.find_one({"_id": ObjectId(record_id)}), records_collection, False
+
 @router.get("/{repository_id}")
 async def get_records(repository_id: str, request: Request) -> dict:
     """
     Get records for a specific repository.
+    Pages can be read by page number or after the last _id of the previous page (after=<_id>), which reads the
+    _id index from that record instead of skipping all the records before it. nextAfter is the after of the next page.
     """
     try:
-        repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"current_data_size": 1})
+        repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"current_data_size": 1, "records_layout": 1})
         if not repository:
             raise HTTPException(status_code=404, detail=f"Repository {repository_id} not found")
         
+        records_collection = db[get_records_collection_name(repository)]
         parameters = get_query_params(request)
+        parameters["after"] = parameters["query_params"].pop("after", None)
+        page = parameters["page"]
+        if is_bucketed(repository):
+            return await get_bucketed_records(repository, records_collection, parameters)
         parameters["query_params"]["repository"] = ObjectId(repository_id)
         totalItems = 0
         if "_id" in parameters["query_params"]:
-            totalItems = await db["records"].count_documents(parameters["query_params"])
+            totalItems = await records_collection.count_documents(parameters["query_params"])
         else:
             totalItems = repository["current_data_size"]
-        page = parameters["page"]
         totalPages = totalItems // parameters["limit"] + (1 if totalItems % parameters["limit"] > 0 else 0)
         
-        records = await db["records"].find(parameters["query_params"], parameters["select"]).skip(parameters["offset"]).limit(parameters["limit"]).to_list(length=None)
+        if parameters["after"] and "_id" not in parameters["query_params"]:
+            query = {**parameters["query_params"], "_id": {"$gt": ObjectId(parameters["after"])}}
+            records = await records_collection.find(query, parameters["select"]).sort("_id", 1).limit(parameters["limit"]).to_list(length=None)
+        else:
+            # Pages are in _id order as well, so the nextAfter of a page continues where it ends
+            records = await records_collection.find(parameters["query_params"], parameters["select"]).sort("_id", 1).skip(parameters["offset"]).limit(parameters["limit"]).to_list(length=None)
+        nextAfter = str(records[-1]["_id"]) if len(records) == parameters["limit"] else None
         
-        return Response(status_code=200, content=json_util.dumps({"totalItems": totalItems, "totalPages": totalPages, "page": page, "items": records}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"totalItems": totalItems, "totalPages": totalPages, "page": page, "nextAfter": nextAfter, "items": records})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching records: {str(e)}")
 
+async def get_bucketed_records(repository: dict, records_collection: Any, parameters: dict) -> MongoJSONResponse:
+    """
+    Get records of a bucketed repository, by _id or by page. Other filters are not supported on buckets.
+    """
+    query_params = parameters["query_params"]
+    unsupported = [key for key in query_params if key != "_id"]
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"Filters {', '.join(unsupported)} are not supported on bucketed repositories")
+    if "_id" in query_params:
+        bucket, index = await find_bucket(records_collection, repository["_id"], query_params["_id"])
+        records = [get_bucket_record(bucket, index)] if bucket is not None else []
+        totalItems = len(records)
+    elif parameters["after"]:
+        records = await get_buckets_after(records_collection, repository["_id"], parameters["after"], parameters["limit"])
+        totalItems = repository["current_data_size"]
+    else:
+        records = await get_buckets_page(records_collection, repository["_id"], parameters["offset"], parameters["limit"])
+        totalItems = repository["current_data_size"]
+    totalPages = totalItems // parameters["limit"] + (1 if totalItems % parameters["limit"] > 0 else 0)
+    nextAfter = str(records[-1]["_id"]) if len(records) == parameters["limit"] else None
+    records = [select_fields(record, parameters["select"]) for record in records]
+
+    return MongoJSONResponse(status_code=200, content={"totalItems": totalItems, "totalPages": totalPages, "page": parameters["page"], "nextAfter": nextAfter, "items": records})
+
+@router.get("/{repository_id}/export")
+async def export_repository_records(repository_id: str, format: str = "ndjson") -> StreamingResponse:
+    """
+    Stream all the records of a repository as NDJSON (one record per line) or CSV, in _id order.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format {format}. Allowed formats are: {', '.join(EXPORT_FORMATS)}")
+    repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"parameters": 1, "records_layout": 1})
+    if not repository:
+        raise HTTPException(status_code=404, detail=f"Repository {repository_id} not found")
+
+    return StreamingResponse(export_records(repository, format), media_type=EXPORT_FORMATS[format], headers={"Content-Disposition": f'attachment; filename="{repository_id}.{format}"'})
+
 
 @router.put("/{record_id}")
-async def update_record(record_id: str, request: Request, current_user: dict = Depends(get_current_user)) -> dict:
+async def update_record(record_id: str, request: Request, repository: str = None, current_user: dict = Depends(get_current_user)) -> dict:
     """
     Update a record in the database.
+    The repository query parameter locates the record when the repository records are partitioned or bucketed.
     """
     try:
         if current_user["role"] != "admin":
             raise HTTPException(status_code=403, detail="You do not have permission to update records")
         
         record = await request.json()
-        current_record = await db["records"].find_one({"_id": ObjectId(record_id)})
+        current_record, records_collection, bucketed = await find_record(record_id, repository)
         
         if not current_record:
             raise HTTPException(status_code=404, detail="Record not found")
@@ -58,11 +128,15 @@ async def update_record(record_id: str, request: Request, current_user: dict = D
         validate_permissions_and_repository(current_user, repository, record)
         now = datetime.now()
 
-        await db["records"].update_one({"_id": ObjectId(record_id)}, {"$set": {"data": {**record}, "updated_at": now, "version": repository["version"] + 1}})
+        await invalidate_zone_maps(repository["_id"])
+        if bucketed:
+            await update_bucket_record(records_collection, repository["_id"], record_id, {**record}, now, repository["version"] + 1)
+        else:
+            await records_collection.update_one({"_id": ObjectId(record_id)}, {"$set": {"data": {**record}, "updated_at": now, "version": repository["version"] + 1}})
         
         await update_repository_info(repository, "update")
     
-        return Response(status_code=200, content=json_util.dumps({"_id": record_id ,"message": "Record updated successfully"}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"_id": record_id ,"message": "Record updated successfully"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating record: {str(e)}")
 
@@ -84,24 +158,72 @@ async def create_record(repository_id: str, request: Request, current_user: dict
         validate_permissions_and_repository(current_user, repository, record)
         now = datetime.now()
 
-        new_record = await db["records"].insert_one({"data": {**record}, "created_at": now, "repository": ObjectId(repository_id), "updated_at": now, "version": repository["version"] + 1})
+        ordinal_counter = await db["repositories"].find_one_and_update({"_id": ObjectId(repository_id)}, {"$inc": {"next_ordinal": 1}}, {"next_ordinal": 1}, return_document=ReturnDocument.BEFORE)
+        ordinal = ordinal_counter.get("next_ordinal", 0)
+        await invalidate_zone_maps(repository_id)
+        records_collection = db[get_records_collection_name(repository)]
+        record_id = record_object_id(await get_record_ids_prefix(repository_id), ordinal)
+        if is_bucketed(repository):
+            await insert_bucket_record(records_collection, repository_id, record_id, {**record}, ordinal, now, repository["version"] + 1, RECORDS_BUCKET_SIZE)
+        else:
+            await records_collection.insert_one({"_id": record_id, "data": {**record}, "ordinal": ordinal, "created_at": now, "repository": ObjectId(repository_id), "updated_at": now, "version": repository["version"] + 1})
 
         await update_repository_info(repository, "create")
     
-        return Response(status_code=201, content=json_util.dumps({"id": str(new_record.inserted_id), "message": "Record created successfully"}), media_type="application/json")
+        return MongoJSONResponse(status_code=201, content={"id": str(record_id), "message": "Record created successfully"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating record: {str(e)}")
 
+@router.post("/{repository_id}/bulk")
+async def bulk_records(repository_id: str, request: Request, current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Create, update and delete many records of a repository at once: {"create": [data], "update": [{"_id", "data"}],
+    "delete": [_id]}. The records are validated together, written with one bulk_write and the repository version is
+    bumped once.
+    """
+    try:
+        body = await request.json()
+        creates = body.get("create") or []
+        updates = body.get("update") or []
+        deletes = body.get("delete") or []
+        if not isinstance(creates, list) or not isinstance(updates, list) or not isinstance(deletes, list):
+            raise HTTPException(status_code=400, detail="create, update and delete must be lists")
+        if len(creates) + len(updates) + len(deletes) > RECORDS_BULK_MAX_OPERATIONS:
+            raise HTTPException(status_code=400, detail=f"At most {RECORDS_BULK_MAX_OPERATIONS} operations are allowed per request")
+
+        repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)})
+        validate_permissions_and_repository(current_user, repository, None)
+
+        errors = [{"operation": "create", **error} for error in validate_records_frame(repository, creates)]
+        invalid_updates = [index for index, update in enumerate(updates) if not isinstance(update, dict) or not ObjectId.is_valid(str(update.get("_id"))) or not isinstance(update.get("data"), dict)]
+        errors.extend({"operation": "update", "index": index, "field": "_id", "error": "Updates must have a valid _id and a data object"} for index in invalid_updates)
+        if not invalid_updates:
+            errors.extend({"operation": "update", **error} for error in validate_records_frame(repository, [update["data"] for update in updates]))
+        errors.extend({"operation": "delete", "index": index, "field": "_id", "error": "Invalid _id"} for index, record_id in enumerate(deletes) if not ObjectId.is_valid(str(record_id)))
+        if errors:
+            raise HTTPException(status_code=400, detail={"message": f"{len(errors)} validation errors", "errors": errors[:100]})
+
+        result = await apply_records_bulk(repository, creates, updates, deletes)
+        if result["error"] is not None:
+            raise HTTPException(status_code=500, detail={"message": f"Error applying records bulk: {result['error']}", "created": result["created"], "updated": result["updated"], "deleted": result["deleted"], "version": result["version"]})
+
+        return MongoJSONResponse(status_code=200, content={**result, "message": "Records updated successfully"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error applying records bulk: {str(e)}")
+
 @router.delete("/{record_id}")
-async def delete_record(record_id: str, current_user: dict = Depends(get_current_user)) -> dict:
+async def delete_record(record_id: str, repository: str = None, current_user: dict = Depends(get_current_user)) -> dict:
     """
     Delete a record from the database.
+    The repository query parameter locates the record when the repository records are partitioned or bucketed.
     """
     try:
         if current_user["role"] != "admin":
             raise HTTPException(status_code=403, detail="You do not have permission to update records")
         
-        record = await db["records"].find_one({"_id": ObjectId(record_id)})
+        record, records_collection, bucketed = await find_record(record_id, repository)
         
         if not record:
             raise HTTPException(status_code=404, detail="Record not found")
@@ -110,11 +232,15 @@ async def delete_record(record_id: str, current_user: dict = Depends(get_current
         
         validate_permissions_and_repository(current_user, repository, None)
         
-        await db["records"].delete_one({"_id": ObjectId(record_id)})
+        await invalidate_zone_maps(repository["_id"])
+        if bucketed:
+            await delete_bucket_record(records_collection, repository["_id"], record_id, datetime.now())
+        else:
+            await records_collection.delete_one({"_id": ObjectId(record_id)})
         
         await update_repository_info(repository, "delete")
     
-        return Response(status_code=200, content=json_util.dumps({"_id": record["_id"], "message": "Record deleted successfully"}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"_id": record["_id"], "message": "Record deleted successfully"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting record: {str(e)}")
     
@@ -3,7 +3,9 @@ from app.utils.auth_utils import get_current_user
 from app.models.repository import Repository
 from app.utils.general_utils import get_query_params
 from app.utils.repositories_utils import upsert_repository
+from app.utils.jobs_utils import enqueue_job
 from app.database import db
+from app.utils.responses_utils import MongoJSONResponse
 from bson.objectid import ObjectId
 from bson import json_util
 from typing import List, Any
@@ -21,7 +23,7 @@ async def get_repositories(request:  Request):
         totalPages = totalItems // parameters["limit"] + (1 if totalItems % parameters["limit"] > 0 else 0)
         repositories = await db["repositories"].find(parameters["query_params"], parameters["select"]).skip(parameters["offset"]).limit(parameters["limit"]).to_list(length=None)
 
-        return Response(status_code=200, content=json_util.dumps({"totalItems": totalItems, "totalPages": totalPages, "page": page, "items": repositories}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"totalItems": totalItems, "totalPages": totalPages, "page": page, "items": repositories})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching repositories: {str(e)}")
 
@@ -33,6 +35,7 @@ async def update_repository(
     url: str = Form(...),
     large_file: bool = Form(False),
     file_path: str = Form(""),
+    cluster_key: str = Form(""),
     parameters: str = Form(""),
     file: UploadFile = File(None),
     current_user: dict = Depends(get_current_user)
@@ -40,7 +43,7 @@ async def update_repository(
     """Update a repository by ID."""
     parameters = json_util.loads(parameters) if parameters else []
     
-    return await upsert_repository(repository_id, name, description, url, large_file, file_path, file, parameters, current_user, "update")
+    return await upsert_repository(repository_id, name, description, url, large_file, file_path, file, parameters, current_user, "update", cluster_key)
 
 @router.post("/")
 async def create_repository(
@@ -49,12 +52,13 @@ async def create_repository(
     url: str = Form(...),
     large_file: bool = Form(False),
     file_path: str = Form(""),
+    cluster_key: str = Form(""),
     file: UploadFile = File(None),
     current_user: dict = Depends(get_current_user)
 ) -> dict:
     """Create a new repository."""
     
-    return await upsert_repository(None, name, description, url, large_file, file_path, file, [], current_user, "create")
+    return await upsert_repository(None, name, description, url, large_file, file_path, file, [], current_user, "create", cluster_key)
 
 @router.delete("/{repository_id}")
 async def delete_repository(repository_id: str, current_user: dict = Depends(get_current_user)) -> dict:
@@ -64,8 +68,8 @@ async def delete_repository(repository_id: str, current_user: dict = Depends(get
 
     try:
         await db["repositories"].delete_one({"_id": ObjectId(repository_id)})
-        await db["jobs"].insert_one({"type": "delete_repository", "data": {"repository_id": repository_id}})        
+        await enqueue_job("delete_repository", {"repository_id": repository_id})        
 
-        return Response(status_code=200, content=json_util.dumps({"_id": repository_id, "message": "Repository deleted successfully. Records and processes related will be removed in the background"}), media_type="application/json")
+        return MongoJSONResponse(status_code=200, content={"_id": repository_id, "message": "Repository deleted successfully. Records and processes related will be removed in the background"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting repository: {str(e)} and all correspinding data")
@@ -0,0 +1,56 @@
+from fastapi import APIRouter, Response, Request, HTTPException, Depends
+from app.utils.auth_utils import get_current_user
+from app.utils.uploads_utils import init_upload, get_upload, append_upload_chunk, complete_upload
+from app.utils.responses_utils import MongoJSONResponse
+
+router = APIRouter()
+
+def validate_upload_permissions(current_user: dict):
+    if current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+@router.post("/")
+async def create_upload(request: Request, current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Start a chunked upload. The body has the file_name and optionally the total_size in bytes.
+    """
+    validate_upload_permissions(current_user)
+    body = await request.json()
+    if not body.get("file_name"):
+        raise HTTPException(status_code=400, detail="file_name is required.")
+    upload = await init_upload(body["file_name"], body.get("total_size"), current_user)
+
+    return MongoJSONResponse(status_code=201, content={"_id": upload["_id"], "size": upload["size"], "message": "Upload started"})
+
+@router.get("/{upload_id}")
+async def get_upload_status(upload_id: str, current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Get the size received so far, to resume an interrupted upload from it.
+    """
+    validate_upload_permissions(current_user)
+    upload = await get_upload(upload_id)
+
+    return MongoJSONResponse(status_code=200, content={key: upload[key] for key in ["_id", "file_name", "size", "total_size", "status", "file_path", "sha256"]})
+
+@router.put("/{upload_id}")
+async def append_upload(upload_id: str, offset: int, request: Request, current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Append the raw request body to an upload at the given offset.
+    """
+    validate_upload_permissions(current_user)
+    result = await append_upload_chunk(upload_id, offset, request.stream())
+
+    return MongoJSONResponse(status_code=200, content=result)
+
+@router.post("/{upload_id}/complete")
+async def finish_upload(upload_id: str, request: Request, current_user: dict = Depends(get_current_user)) -> dict:
+    """
+    Complete an upload checking its sha256. The returned file_path is used as a large file repository file_path.
+    """
+    validate_upload_permissions(current_user)
+    body = await request.json()
+    if not body.get("sha256"):
+        raise HTTPException(status_code=400, detail="sha256 is required.")
+    upload = await complete_upload(upload_id, body["sha256"])
+
+    return MongoJSONResponse(status_code=200, content={"_id": upload["_id"], "file_path": upload["file_path"], "sha256": upload["sha256"], "size": upload["size"], "message": "Upload completed"})
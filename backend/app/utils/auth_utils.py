@@ -3,12 +3,17 @@ from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from app.config import SECRET_KEY, ALGORITHM
+from app.config import SECRET_KEY, ALGORITHM, AUTH_CACHE_TTL_SECONDS, AUTH_CACHE_MAX_SIZE
 from app.database import db
+from collections import OrderedDict
+import time
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Validated token -> (user, monotonic expiry), least recently used first
+users_cache = OrderedDict()
+
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt."""
     return pwd_context.hash(password)
@@ -22,8 +27,48 @@ async def get_user(username: str) -> dict:
     user = await db["users"].find_one({"username": username})
     return user
 
+def get_cached_user(token: str):
+    cached = users_cache.get(token)
+    if cached is None:
+        return None
+    user, expires_at = cached
+    if time.monotonic() >= expires_at:
+        users_cache.pop(token, None)
+        return None
+    users_cache.move_to_end(token)
+    return dict(user)
+
+def cache_user(token: str, user: dict, token_expires_at: float = None):
+    """
+    Keep the user of a validated token for AUTH_CACHE_TTL_SECONDS, never past the token expiration.
+    """
+    ttl = AUTH_CACHE_TTL_SECONDS
+    if token_expires_at is not None:
+        ttl = min(ttl, token_expires_at - time.time())
+    if ttl <= 0 or AUTH_CACHE_MAX_SIZE <= 0:
+        return
+    users_cache[token] = (dict(user), time.monotonic() + ttl)
+    users_cache.move_to_end(token)
+    while len(users_cache) > AUTH_CACHE_MAX_SIZE:
+        users_cache.popitem(last=False)
+
+def invalidate_user_cache(username: str = None):
+    """
+    Drop the cached tokens of a user (e.g. when a user is registered again with its username), or of every user
+    without a username. The cache lives in each API process, other processes and users changed directly in the
+    database are seen after AUTH_CACHE_TTL_SECONDS at most.
+    """
+    if username is None:
+        users_cache.clear()
+        return
+    for token in [token for token, (user, _) in users_cache.items() if user.get("username") == username]:
+        users_cache.pop(token, None)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
-    """Get the current user from the token."""
+    """Get the current user from the token, from the cache while it was validated recently."""
+    user = get_cached_user(token)
+    if user is not None:
+        return user
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -32,6 +77,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> dict:
         user = await db["users"].find_one({"username": username}, {"password": 0})
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
+        cache_user(token, user, payload.get("exp"))
         return user
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
@@ -0,0 +1,106 @@
+from typing import Any, Dict, Iterable
+import numpy as np
+import struct
+
+# Roaring style layout: the ordinals are split by their high 16 bits in containers of 65536 values. Sparse containers
+# keep the sorted low 16 bits (2 bytes per value) and dense ones a 8 KB bitset, whichever is smaller.
+CONTAINER_SIZE = 1 << 16
+ARRAY_CONTAINER_MAX_CARDINALITY = 4096
+ARRAY_CONTAINER = 0
+BITSET_CONTAINER = 1
+HEADER_FORMAT = "<I"
+CONTAINER_HEADER_FORMAT = "<IBI"
+
+class OrdinalBitmap:
+    """
+    Compressed set of record ordinals used to represent filter results.
+    """
+
+    def __init__(self, containers: Dict[int, np.ndarray] = None):
+        # Every container is kept as a sorted array of its low 16 bits, dense containers are only packed when serialized
+        self.containers = containers if containers is not None else {}
+
+    @classmethod
+    def from_ordinals(cls, ordinals: Iterable[Any]) -> "OrdinalBitmap":
+        values = np.unique(np.asarray(ordinals, dtype=np.int64))
+        if len(values) > 0 and values[0] < 0:
+            raise ValueError("Record ordinals must be non negative.")
+        high = (values >> 16).astype(np.uint32)
+        low = (values & 0xFFFF).astype(np.uint16)
+        keys, starts = np.unique(high, return_index=True)
+        ends = np.append(starts[1:], len(values))
+
+        return cls({int(key): low[start:end] for key, start, end in zip(keys, starts, ends)})
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "OrdinalBitmap":
+        containers = {}
+        (total_containers,) = struct.unpack_from(HEADER_FORMAT, data, 0)
+        offset = struct.calcsize(HEADER_FORMAT)
+        for _ in range(total_containers):
+            key, container_type, cardinality = struct.unpack_from(CONTAINER_HEADER_FORMAT, data, offset)
+            offset += struct.calcsize(CONTAINER_HEADER_FORMAT)
+            if container_type == ARRAY_CONTAINER:
+                containers[key] = np.frombuffer(data, dtype="<u2", count=cardinality, offset=offset).astype(np.uint16)
+                offset += cardinality * 2
+            else:
+                bits = np.frombuffer(data, dtype=np.uint8, count=CONTAINER_SIZE // 8, offset=offset)
+                containers[key] = np.flatnonzero(np.unpackbits(bits, bitorder="little")).astype(np.uint16)
+                offset += CONTAINER_SIZE // 8
+
+        return cls(containers)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the bitmap. The layout only depends on the ordinals, so equal bitmaps have equal bytes.
+        """
+        parts = [struct.pack(HEADER_FORMAT, len(self.containers))]
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            if len(container) <= ARRAY_CONTAINER_MAX_CARDINALITY:
+                parts.append(struct.pack(CONTAINER_HEADER_FORMAT, key, ARRAY_CONTAINER, len(container)))
+                parts.append(container.astype("<u2").tobytes())
+            else:
+                bits = np.zeros(CONTAINER_SIZE, dtype=np.uint8)
+                bits[container] = 1
+                parts.append(struct.pack(CONTAINER_HEADER_FORMAT, key, BITSET_CONTAINER, len(container)))
+                parts.append(np.packbits(bits, bitorder="little").tobytes())
+
+        return b"".join(parts)
+
+    def to_ordinals(self) -> np.ndarray:
+        if len(self.containers) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([(np.int64(key) << 16) | self.containers[key].astype(np.int64) for key in sorted(self.containers)])
+
+    def cardinality(self) -> int:
+        return sum(len(container) for container in self.containers.values())
+
+    def union(self, other: "OrdinalBitmap") -> "OrdinalBitmap":
+        containers = dict(self.containers)
+        for key, container in other.containers.items():
+            containers[key] = np.union1d(containers[key], container).astype(np.uint16) if key in containers else container
+
+        return OrdinalBitmap(containers)
+
+    def __or__(self, other: "OrdinalBitmap") -> "OrdinalBitmap":
+        return self.union(other)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, OrdinalBitmap):
+            return NotImplemented
+        return self.containers.keys() == other.containers.keys() and all(np.array_equal(container, other.containers[key]) for key, container in self.containers.items())
+
+    def __len__(self) -> int:
+        return self.cardinality()
+
+def union_bitmaps(bitmaps: Iterable[OrdinalBitmap]) -> OrdinalBitmap:
+    """
+    Union the bitmaps of several batches in one pass, concatenating every container once.
+    """
+    containers = {}
+    for bitmap in bitmaps:
+        for key, container in bitmap.containers.items():
+            containers.setdefault(key, []).append(container)
+
+    return OrdinalBitmap({key: np.unique(np.concatenate(parts)) if len(parts) > 1 else parts[0] for key, parts in containers.items()})
@@ -0,0 +1,112 @@
+from bson.raw_bson import RawBSONDocument
+from bson.objectid import ObjectId
+from datetime import datetime
+from typing import Any, List
+import numpy as np
+import pandas as pd
+import struct
+import bson
+import os
+
+BSON_DOUBLE = b"\x01"
+BSON_DOCUMENT = b"\x03"
+BSON_OBJECT_ID = b"\x07"
+BSON_BOOLEAN = b"\x08"
+BSON_NULL = b"\x0a"
+BSON_INT32 = b"\x10"
+BSON_INT64 = b"\x12"
+INT32_MIN = -(2 ** 31)
+INT32_MAX = 2 ** 31 - 1
+INT64_MAX = 2 ** 63 - 1
+RECORD_ID_ORDINAL_BYTES = 5
+
+def new_record_ids_prefix(now: datetime) -> bytes:
+    """
+    Prefix of the record ids of a repository: the 4 byte timestamp an ObjectId starts with and 3 random bytes.
+    """
+    return struct.pack(">I", int(now.timestamp())) + os.urandom(3)
+
+def record_object_id(ids_prefix: bytes, ordinal: int) -> ObjectId:
+    """
+    Record _id made of the repository prefix and the big-endian ordinal, so the ids of a repository grow with its
+    ordinals. ObjectId() does not guarantee it: its 3 byte counter wraps around.
+    """
+    return ObjectId(ids_prefix + ordinal.to_bytes(RECORD_ID_ORDINAL_BYTES, "big"))
+
+def encode_element(name: str, value: Any) -> bytes:
+    """
+    Encode a single BSON element with the bson C extension, stripping the document length and terminator.
+    """
+    return bson.encode({name: value})[4:-1]
+
+def encode_value(name: str, key: bytes, value: Any) -> bytes:
+    if isinstance(value, str):
+        encoded = value.encode()
+        return b"\x02" + key + struct.pack("<i", len(encoded) + 1) + encoded + b"\x00"
+    return encode_element(name, value)
+
+def encode_fixed_width_column(key: bytes, type_byte: bytes, values: np.ndarray, value_format: str) -> List[bytes]:
+    """
+    Encode a numeric column at once: every element has the same width, so the elements are slices of one buffer.
+    """
+    elements = np.empty(len(values), dtype=[("type", "u1"), ("key", f"S{len(key)}"), ("value", value_format)])
+    elements["type"] = type_byte[0]
+    elements["key"] = key
+    elements["value"] = values
+    buffer = elements.tobytes()
+    width = elements.dtype.itemsize
+
+    return [buffer[start:start + width] for start in range(0, len(buffer), width)]
+
+def encode_column(name: str, column: pd.Series) -> List[bytes]:
+    """
+    Encode the BSON elements of a column. Missing values are encoded as null from the column mask, without copying
+    the chunk to replace them first. Unsigned values above INT64_MAX do not fit a BSON integer, they go through
+    encode_value, which fails on them as PyMongo does.
+    """
+    key = name.encode() + b"\x00"
+    mask = column.isna().to_numpy()
+    kind = column.dtype.kind
+    if kind == "f":
+        elements = encode_fixed_width_column(key, BSON_DOUBLE, column.to_numpy(dtype=np.float64, na_value=np.nan), "<f8")
+    elif kind in "iu" and not mask.any() and not (kind == "u" and len(column) > 0 and column.max() > INT64_MAX):
+        values = column.to_numpy(dtype=np.int64)
+        # Same integer types PyMongo picks for Python ints
+        if len(values) == 0 or (values.min() >= INT32_MIN and values.max() <= INT32_MAX):
+            elements = encode_fixed_width_column(key, BSON_INT32, values, "<i4")
+        else:
+            elements = encode_fixed_width_column(key, BSON_INT64, values, "<i8")
+    elif kind == "b" and not mask.any():
+        elements = encode_fixed_width_column(key, BSON_BOOLEAN, column.to_numpy(dtype=np.uint8), "u1")
+    else:
+        null_element = BSON_NULL + key
+        return [null_element if missing else encode_value(name, key, value) for value, missing in zip(column.tolist(), mask)]
+
+    if mask.any():
+        null_element = BSON_NULL + key
+        for index in np.flatnonzero(mask):
+            elements[index] = null_element
+
+    return elements
+
+def encode_records(chunk: pd.DataFrame, repository_id: Any, first_ordinal: int, now: datetime, ids_prefix: bytes) -> List[RawBSONDocument]:
+    """
+    Encode the record documents of a CSV chunk straight from its column arrays into BSON.
+    The documents have the same fields as the ones built by records_utils.build_records and PyMongo inserts their bytes as they are.
+    """
+    columns = [encode_column(str(name), chunk[name]) for name in chunk.columns]
+    repository_element = encode_element("repository", ObjectId(repository_id))
+    trailer = encode_element("created_at", now) + encode_element("updated_at", now) + encode_element("version", 0)
+    documents = []
+    for index, data_elements in enumerate(zip(*columns)):
+        data = b"".join(data_elements)
+        body = b"".join([
+            BSON_OBJECT_ID, b"_id\x00", record_object_id(ids_prefix, first_ordinal + index).binary,
+            repository_element,
+            BSON_DOCUMENT, b"data\x00", struct.pack("<i", len(data) + 5), data, b"\x00",
+            BSON_INT64, b"ordinal\x00", struct.pack("<q", first_ordinal + index),
+            trailer
+        ])
+        documents.append(RawBSONDocument(struct.pack("<i", len(body) + 5) + body + b"\x00"))
+
+    return documents
@@ -0,0 +1,387 @@
+from bson.objectid import ObjectId
+from datetime import datetime
+from pymongo import InsertOne, ReplaceOne, DeleteOne
+from pymongo.errors import BulkWriteError
+from typing import Any, List, Optional, Tuple
+from app.utils.bson_utils import record_object_id
+import numpy as np
+import pandas as pd
+import logging
+
+BUCKET_UPDATE_RETRIES = 3
+
+def build_buckets(chunk: pd.DataFrame, repository_id: Any, first_ordinal: int, now: datetime, bucket_size: int, ids_prefix: bytes) -> List[dict]:
+    """
+    Build the bucket documents of a chunk: blocks of bucket_size rows stored as one array per column, with the _id
+    and ordinal of every row. Row ids are made from the ordinals and the _id of a bucket is the _id of its first row,
+    so buckets sort in row order.
+    """
+    repository_id = ObjectId(repository_id)
+    columns = {str(name): chunk[name].astype(object).where(chunk[name].notna(), None).tolist() for name in chunk.columns}
+    buckets = []
+    for start in range(0, len(chunk), bucket_size):
+        count = min(bucket_size, len(chunk) - start)
+        ids = [record_object_id(ids_prefix, first_ordinal + start + index) for index in range(count)]
+        buckets.append({
+            "_id": ids[0],
+            "repository": repository_id,
+            "ids": ids,
+            "ordinals": list(range(first_ordinal + start, first_ordinal + start + count)),
+            "count": count,
+            "columns": {name: values[start:start + count] for name, values in columns.items()},
+            "revision": 0,
+            "version": 0,
+            "created_at": now,
+            "updated_at": now
+        })
+
+    return buckets
+
+def buckets_to_df(buckets: List[dict]) -> pd.DataFrame:
+    """
+    Decode buckets into the DataFrame the engines process, one concatenation per column instead of one dict per row.
+    """
+    names = list(dict.fromkeys(name for bucket in buckets for name in bucket["columns"]))
+    data = {
+        "_id": [record_id for bucket in buckets for record_id in bucket["ids"]],
+        "_ordinal": np.concatenate([np.asarray(bucket["ordinals"], dtype=np.int64) for bucket in buckets]) if buckets else [],
+    }
+    for name in names:
+        data[name] = [value for bucket in buckets for value in bucket["columns"].get(name, [None] * bucket["count"])]
+
+    return pd.DataFrame(data)
+
+def get_bucket_record(bucket: dict, index: int) -> dict:
+    """
+    Get a row of a bucket as a record document.
+    """
+    return {
+        "_id": bucket["ids"][index],
+        "repository": bucket["repository"],
+        "data": {name: values[index] for name, values in bucket["columns"].items()},
+        "ordinal": bucket["ordinals"][index],
+        "created_at": bucket["created_at"],
+        "updated_at": bucket["updated_at"],
+        "version": bucket["version"]
+    }
+
+def select_fields(record: dict, select: dict) -> dict:
+    if not select:
+        return record
+    return {key: value for key, value in record.items() if key == "_id" or key in select}
+
+async def fetch_buckets_batch(collection: Any, repository_id: Any, start_after_id: Any, batch_size: int) -> List[dict]:
+    """
+    Fetch the buckets after the bucket start_after_id until they hold batch_size rows.
+    """
+    query = {"repository": ObjectId(repository_id)}
+    if start_after_id is not None:
+        query["_id"] = {"$gt": ObjectId(start_after_id)}
+    buckets = []
+    rows = 0
+    async for bucket in collection.find(query).sort("_id", 1):
+        buckets.append(bucket)
+        rows += bucket["count"]
+        if rows >= batch_size:
+            break
+
+    return buckets
+
+async def get_bucket_range_starts(collection: Any, repository_id: Any, batch_size: int, range_batches: int) -> List[Any]:
+    """
+    Get the bucket _id every range of range_batches batches starts after, cutting the batches as fetch_buckets_batch
+    does. Only the bucket _id and count are read.
+    """
+    starts = []
+    rows = 0
+    batches = 0
+    async for bucket in collection.find({"repository": ObjectId(repository_id)}, {"_id": 1, "count": 1}).sort("_id", 1):
+        rows += bucket["count"]
+        if rows >= batch_size:
+            rows = 0
+            batches += 1
+            if batches % range_batches == 0:
+                starts.append(bucket["_id"])
+
+    return starts
+
+async def get_buckets_page(collection: Any, repository_id: Any, offset: int, limit: int) -> List[dict]:
+    """
+    Get the records offset to offset + limit of a bucketed repository. Whole buckets are skipped by their counts.
+    """
+    records = []
+    skipped = 0
+    async for header in collection.find({"repository": ObjectId(repository_id)}, {"_id": 1, "count": 1}).sort("_id", 1):
+        if skipped + header["count"] <= offset:
+            skipped += header["count"]
+            continue
+        bucket = await collection.find_one({"_id": header["_id"]})
+        if bucket is None:
+            continue
+        start = max(offset - skipped, 0)
+        for index in range(start, bucket["count"]):
+            records.append(get_bucket_record(bucket, index))
+            if len(records) == limit:
+                return records
+        skipped += bucket["count"]
+
+    return records
+
+async def get_buckets_after(collection: Any, repository_id: Any, after_id: Any, limit: int) -> List[dict]:
+    """
+    Get the limit records after the record after_id of a bucketed repository. Row ids grow within and across buckets,
+    so the rows after it are in the bucket starting at or before it and the buckets after that one.
+    """
+    after_id = ObjectId(after_id)
+    query = {"repository": ObjectId(repository_id)}
+    first = await collection.find({**query, "_id": {"$lte": after_id}}).sort("_id", -1).limit(1).to_list(length=1)
+    records = []
+    for bucket in first:
+        records.extend(get_bucket_record(bucket, index) for index in range(bucket["count"]) if bucket["ids"][index] > after_id)
+    if len(records) >= limit:
+        return records[:limit]
+    async for bucket in collection.find({**query, "_id": {"$gt": after_id}}).sort("_id", 1).batch_size(1):
+        for index in range(bucket["count"]):
+            records.append(get_bucket_record(bucket, index))
+            if len(records) == limit:
+                return records
+
+    return records
+
+async def find_bucket(collection: Any, repository_id: Any, record_id: Any) -> Tuple[Optional[dict], int]:
+    """
+    Find the bucket holding a record and its index. Buckets are keyed by their first row _id, so the record is in
+    the last bucket starting at or before it.
+    """
+    record_id = ObjectId(record_id)
+    buckets = await collection.find({"repository": ObjectId(repository_id), "_id": {"$lte": record_id}}).sort("_id", -1).limit(1).to_list(length=1)
+    if len(buckets) == 0 or record_id not in buckets[0]["ids"]:
+        return None, -1
+    return buckets[0], buckets[0]["ids"].index(record_id)
+
+async def store_bucket(collection: Any, bucket: dict, fields: dict) -> bool:
+    """
+    Set fields of a bucket if nobody changed it since it was read.
+    """
+    result = await collection.update_one({"_id": bucket["_id"], "revision": bucket["revision"]}, {"$set": fields, "$inc": {"revision": 1}})
+    return result.modified_count == 1
+
+async def update_bucket_record(collection: Any, repository_id: Any, record_id: Any, data: dict, now: datetime, version: int, missing_ok: bool = False) -> bool:
+    for _ in range(BUCKET_UPDATE_RETRIES):
+        bucket, index = await find_bucket(collection, repository_id, record_id)
+        if bucket is None:
+            if missing_ok:
+                return False
+            raise ValueError(f"Record {record_id} not found")
+        columns = bucket["columns"]
+        for name, value in data.items():
+            columns.setdefault(name, [None] * bucket["count"])[index] = value
+        if await store_bucket(collection, bucket, {"columns": columns, "updated_at": now, "version": version}):
+            return True
+    raise ValueError(f"Record {record_id} was changed concurrently, try again")
+
+async def delete_bucket_record(collection: Any, repository_id: Any, record_id: Any, now: datetime, missing_ok: bool = False) -> bool:
+    for _ in range(BUCKET_UPDATE_RETRIES):
+        bucket, index = await find_bucket(collection, repository_id, record_id)
+        if bucket is None:
+            if missing_ok:
+                return False
+            raise ValueError(f"Record {record_id} not found")
+        if bucket["count"] == 1:
+            result = await collection.delete_one({"_id": bucket["_id"], "revision": bucket["revision"]})
+            if result.deleted_count == 1:
+                return True
+            continue
+        # The bucket keeps its _id, the first row id, so the records after it still locate it
+        fields = {
+            "ids": bucket["ids"][:index] + bucket["ids"][index + 1:],
+            "ordinals": bucket["ordinals"][:index] + bucket["ordinals"][index + 1:],
+            "count": bucket["count"] - 1,
+            "columns": {name: values[:index] + values[index + 1:] for name, values in bucket["columns"].items()},
+            "updated_at": now
+        }
+        if await store_bucket(collection, bucket, fields):
+            return True
+    raise ValueError(f"Record {record_id} was changed concurrently, try again")
+
+async def insert_bucket_record(collection: Any, repository_id: Any, record_id: ObjectId, data: dict, ordinal: int, now: datetime, version: int, bucket_size: int) -> ObjectId:
+    """
+    Append a record to the last bucket of a repository, or start a new bucket when it is full. The record _id is
+    made from its ordinal, so it sorts after the rows already stored.
+    """
+    for _ in range(BUCKET_UPDATE_RETRIES):
+        buckets = await collection.find({"repository": ObjectId(repository_id)}).sort("_id", -1).limit(1).to_list(length=1)
+        if len(buckets) == 0 or buckets[0]["count"] >= bucket_size:
+            bucket = {"_id": record_id, "repository": ObjectId(repository_id), "ids": [record_id], "ordinals": [ordinal], "count": 1, "columns": {name: [value] for name, value in data.items()}, "revision": 0, "version": version, "created_at": now, "updated_at": now}
+            await collection.insert_one(bucket)
+            return record_id
+        bucket = buckets[0]
+        columns = bucket["columns"]
+        for name in set(columns) | set(data):
+            columns.setdefault(name, [None] * bucket["count"]).append(data.get(name))
+        fields = {"ids": bucket["ids"] + [record_id], "ordinals": bucket["ordinals"] + [ordinal], "count": bucket["count"] + 1, "columns": columns, "updated_at": now, "version": version}
+        if await store_bucket(collection, bucket, fields):
+            return record_id
+        logging.info(f"Bucket {bucket['_id']} changed while appending a record, retrying")
+    raise ValueError("The last bucket was changed concurrently, try again")
+
+async def find_buckets(collection: Any, repository_id: Any, record_ids: List[Any]) -> Tuple[dict, dict]:
+    """
+    Find the buckets holding some records. Returns the buckets by _id and the bucket _id of every record found.
+    Records are located in _id order, so the ones in a bucket already read do not query it again.
+    """
+    buckets = {}
+    record_buckets = {}
+    bucket = None
+    for record_id in sorted(set(ObjectId(record_id) for record_id in record_ids)):
+        if bucket is None or record_id not in bucket["ids"]:
+            bucket, _ = await find_bucket(collection, repository_id, record_id)
+            if bucket is None:
+                continue
+            bucket = buckets.setdefault(bucket["_id"], bucket)
+        record_buckets[record_id] = bucket["_id"]
+
+    return buckets, record_buckets
+
+def change_bucket(bucket: dict, updates: List[dict], deletes: List[Any]) -> dict:
+    """
+    Apply updates and deletes to the rows of a bucket read from the database, returning the new bucket.
+    """
+    count = bucket["count"]
+    columns = {name: list(values) for name, values in bucket["columns"].items()}
+    positions = {record_id: index for index, record_id in enumerate(bucket["ids"])}
+    for update in updates:
+        for name, value in update["data"].items():
+            columns.setdefault(name, [None] * count)[positions[ObjectId(update["_id"])]] = value
+    deleted = {positions[ObjectId(record_id)] for record_id in deletes}
+    keep = [index for index in range(count) if index not in deleted]
+    return {
+        **bucket,
+        "ids": [bucket["ids"][index] for index in keep],
+        "ordinals": [bucket["ordinals"][index] for index in keep],
+        "count": len(keep),
+        "columns": {name: [values[index] for index in keep] for name, values in columns.items()}
+    }
+
+def append_bucket_rows(bucket: dict, rows: List[Tuple[ObjectId, int, dict]]) -> dict:
+    columns = {name: list(values) for name, values in bucket["columns"].items()}
+    count = bucket["count"]
+    for record_id, ordinal, data in rows:
+        for name in set(columns) | set(data):
+            columns.setdefault(name, [None] * count).append(data.get(name))
+        count += 1
+    return {**bucket, "ids": bucket["ids"] + [row[0] for row in rows], "ordinals": bucket["ordinals"] + [row[1] for row in rows], "count": count, "columns": columns}
+
+async def plan_bucket_writes(collection: Any, repository_id: Any, creates: List[Tuple[ObjectId, int, dict]], updates: List[dict], deletes: List[Any], now: datetime, version: int, bucket_size: int) -> List[dict]:
+    """
+    Group record creates, updates and deletes per bucket: one revision checked replacement (or delete, when all its
+    rows go) per bucket read, and inserts for the buckets started by the creates. Every planned write keeps the
+    record operations it applies, so the ones of a write that fails can be tried again.
+    Updates and deletes of records that are not found are left out.
+    """
+    buckets, record_buckets = await find_buckets(collection, repository_id, [update["_id"] for update in updates] + list(deletes))
+    bucket_updates = {bucket_id: [] for bucket_id in buckets}
+    bucket_deletes = {bucket_id: [] for bucket_id in buckets}
+    for update in updates:
+        if ObjectId(update["_id"]) in record_buckets:
+            bucket_updates[record_buckets[ObjectId(update["_id"])]].append(update)
+    for record_id in deletes:
+        if ObjectId(record_id) in record_buckets:
+            bucket_deletes[record_buckets[ObjectId(record_id)]].append(record_id)
+
+    last_bucket_id = None
+    if creates:
+        last = await collection.find({"repository": ObjectId(repository_id)}).sort("_id", -1).limit(1).to_list(length=1)
+        if len(last) > 0:
+            last_bucket_id = last[0]["_id"]
+            buckets.setdefault(last_bucket_id, last[0])
+            bucket_updates.setdefault(last_bucket_id, [])
+            bucket_deletes.setdefault(last_bucket_id, [])
+
+    writes = []
+    remaining = list(creates)
+    for bucket_id, bucket in buckets.items():
+        changed = change_bucket(bucket, bucket_updates[bucket_id], bucket_deletes[bucket_id])
+        appended = []
+        if bucket_id == last_bucket_id:
+            appended = remaining[:max(bucket_size - changed["count"], 0)]
+            remaining = remaining[len(appended):]
+            changed = append_bucket_rows(changed, appended)
+        if not bucket_updates[bucket_id] and not bucket_deletes[bucket_id] and not appended:
+            continue
+        query = {"_id": bucket_id, "revision": bucket["revision"]}
+        if changed["count"] == 0:
+            operation = DeleteOne(query)
+        else:
+            operation = ReplaceOne(query, {**changed, "revision": bucket["revision"] + 1, "updated_at": now, "version": version})
+        writes.append({"operation": operation, "bucket_id": bucket_id, "revision": bucket["revision"] + 1, "updates": bucket_updates[bucket_id], "deletes": bucket_deletes[bucket_id], "creates": appended})
+
+    for start in range(0, len(remaining), bucket_size):
+        rows = remaining[start:start + bucket_size]
+        bucket = append_bucket_rows({"_id": rows[0][0], "repository": ObjectId(repository_id), "ids": [], "ordinals": [], "count": 0, "columns": {}, "revision": 0, "version": version, "created_at": now, "updated_at": now}, rows)
+        writes.append({"operation": InsertOne(bucket), "bucket_id": bucket["_id"], "revision": 0, "updates": [], "deletes": [], "creates": rows})
+
+    return writes
+
+async def get_applied_writes(collection: Any, writes: List[dict], failed_indexes: set, now: datetime) -> List[bool]:
+    """
+    Tell which planned bucket writes were applied. Replacements and deletes whose revision changed before them match
+    nothing without an error, so the buckets are read back: a replaced bucket has the new revision and update time,
+    a deleted bucket is gone.
+    """
+    bucket_ids = [write["bucket_id"] for write in writes if not isinstance(write["operation"], InsertOne)]
+    stored = {bucket["_id"]: bucket async for bucket in collection.find({"_id": {"$in": bucket_ids}}, {"revision": 1, "updated_at": 1})}
+    applied = []
+    for index, write in enumerate(writes):
+        if index in failed_indexes:
+            applied.append(False)
+        elif isinstance(write["operation"], InsertOne):
+            applied.append(True)
+        elif isinstance(write["operation"], DeleteOne):
+            applied.append(write["bucket_id"] not in stored)
+        else:
+            bucket = stored.get(write["bucket_id"])
+            applied.append(bucket is not None and bucket["revision"] == write["revision"] and bucket["updated_at"] == now)
+    return applied
+
+async def bulk_write_bucket_records(collection: Any, repository_id: Any, creates: List[Tuple[ObjectId, int, dict]], updates: List[dict], deletes: List[Any], now: datetime, version: int, bucket_size: int) -> dict:
+    """
+    Apply record creates (with their _id and ordinal), updates and deletes to the buckets of a repository with one
+    unordered bulk_write per attempt. Buckets changed concurrently are read again and their record operations
+    retried up to BUCKET_UPDATE_RETRIES times. Returns the applied records and the error left, if any.
+    """
+    # MongoDB stores milliseconds, the update time is compared when reading the buckets back
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    created_ids = []
+    updated = 0
+    deleted = 0
+    error = None
+    for _ in range(BUCKET_UPDATE_RETRIES):
+        writes = await plan_bucket_writes(collection, repository_id, creates, updates, deletes, now, version, bucket_size)
+        if len(writes) == 0:
+            creates, updates, deletes = [], [], []
+            break
+        failed_indexes = set()
+        try:
+            await collection.bulk_write([write["operation"] for write in writes], ordered=False)
+        except BulkWriteError as e:
+            failed_indexes = {write_error["index"] for write_error in e.details["writeErrors"]}
+            error = f"{len(failed_indexes)} bucket writes failed: {e.details['writeErrors'][0].get('errmsg')}"
+        applied = await get_applied_writes(collection, writes, failed_indexes, now)
+        creates, updates, deletes = [], [], []
+        for index, (write, write_applied) in enumerate(zip(writes, applied)):
+            if write_applied:
+                created_ids.extend(row[0] for row in write["creates"])
+                updated += len(write["updates"])
+                deleted += len(write["deletes"])
+            elif index not in failed_indexes:
+                creates.extend(write["creates"])
+                updates.extend(write["updates"])
+                deletes.extend(write["deletes"])
+        if error is not None or not (creates or updates or deletes):
+            break
+        logging.info(f"{len(creates) + len(updates) + len(deletes)} record operations hit buckets changed concurrently, retrying")
+    if error is None and (creates or updates or deletes):
+        error = f"{len(creates) + len(updates) + len(deletes)} operations hit buckets changed concurrently, try again"
+
+    return {"created_ids": created_ids, "updated": updated, "deleted": deleted, "error": error}
@@ -0,0 +1,83 @@
+from typing import Any, Dict, List
+import numpy as np
+import struct
+import json
+
+# Layout: header, key offsets, JSON encoded keys, group offsets and the flat row ordinals of all groups (CSR).
+# The members of group i are ordinals[offsets[i]:offsets[i + 1]], so any group or page of groups is read by slicing.
+HEADER_FORMAT = "<IIQB"
+
+def encode_key(group_key: Any) -> bytes:
+    key = list(group_key) if isinstance(group_key, tuple) else [group_key]
+    return json.dumps([item.item() if isinstance(item, np.generic) else item for item in key], default=str).encode()
+
+def encode_groups(group_mapping: Dict[Any, Any]) -> bytes:
+    """
+    Encode grouped row ordinals in CSR layout. Groups are sorted by their encoded key so both engines produce the same bytes.
+    """
+    encoded_groups = sorted(((encode_key(group_key), members) for group_key, members in group_mapping.items()), key=lambda group: group[0])
+    keys = [group[0] for group in encoded_groups]
+    counts = np.fromiter((len(group[1]) for group in encoded_groups), dtype=np.int64, count=len(encoded_groups))
+    offsets = np.zeros(len(encoded_groups) + 1, dtype="<u8")
+    offsets[1:] = np.cumsum(counts)
+    ordinals = np.concatenate([np.sort(np.asarray(group[1], dtype=np.int64)) for group in encoded_groups]) if len(encoded_groups) > 0 else np.empty(0, dtype=np.int64)
+    ordinal_width = 4 if len(ordinals) == 0 or ordinals.max() < 2 ** 32 else 8
+    key_offsets = np.zeros(len(keys) + 1, dtype="<u4")
+    key_offsets[1:] = np.cumsum([len(key) for key in keys], dtype=np.int64)
+
+    return b"".join([
+        struct.pack(HEADER_FORMAT, len(keys), int(key_offsets[-1]), len(ordinals), ordinal_width),
+        key_offsets.tobytes(),
+        b"".join(keys),
+        offsets.tobytes(),
+        ordinals.astype("<u4" if ordinal_width == 4 else "<u8").tobytes()
+    ])
+
+class CSRGroups:
+    """
+    Reader of CSR encoded group results. Arrays are views on the encoded bytes, so nothing is materialized until read.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = bytes(data)
+        self.total_groups, keys_size, total_ordinals, ordinal_width = struct.unpack_from(HEADER_FORMAT, self.data, 0)
+        offset = struct.calcsize(HEADER_FORMAT)
+        self.key_offsets = np.frombuffer(self.data, dtype="<u4", count=self.total_groups + 1, offset=offset)
+        offset += self.key_offsets.nbytes
+        self.keys_offset = offset
+        offset += keys_size
+        self.offsets = np.frombuffer(self.data, dtype="<u8", count=self.total_groups + 1, offset=offset)
+        offset += self.offsets.nbytes
+        self.ordinals = np.frombuffer(self.data, dtype="<u4" if ordinal_width == 4 else "<u8", count=total_ordinals, offset=offset)
+
+    def __len__(self) -> int:
+        return self.total_groups
+
+    def key(self, index: int) -> Any:
+        start = self.keys_offset + int(self.key_offsets[index])
+        end = self.keys_offset + int(self.key_offsets[index + 1])
+        key = json.loads(self.data[start:end])
+        return key[0] if len(key) == 1 else key
+
+    def member_counts(self, start: int = 0, end: int = None) -> np.ndarray:
+        return np.diff(self.offsets[start:(self.total_groups if end is None else end) + 1]).astype(np.int64)
+
+    def members(self, index: int) -> np.ndarray:
+        return self.ordinals[int(self.offsets[index]):int(self.offsets[index + 1])].astype(np.int64)
+
+    def page(self, offset: int, limit: int, include_members: bool = False) -> List[dict]:
+        """
+        Get the groups offset to offset + limit with their member counts, and their row ordinals when include_members.
+        """
+        end = min(offset + limit, self.total_groups)
+        if offset >= end:
+            return []
+        counts = self.member_counts(offset, end)
+        groups = []
+        for index in range(offset, end):
+            group = {"group": self.key(index), "count": int(counts[index - offset])}
+            if include_members:
+                group["ordinals"] = self.members(index).tolist()
+            groups.append(group)
+
+        return groups
@@ -0,0 +1,94 @@
+from app.utils.fingerprint_utils import normalize_value
+from typing import List, Any, Dict
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+import os
+
+load_dotenv()
+AGGREGATION_ABSOLUTE_TOLERANCE = float(os.getenv("AGGREGATION_ABSOLUTE_TOLERANCE", "0.002"))
+AGGREGATION_RELATIVE_TOLERANCE = float(os.getenv("AGGREGATION_RELATIVE_TOLERANCE", "1e-9"))
+
+def has_ordinals(df: pd.DataFrame) -> bool:
+    """
+    Check if every record of a batch has an ordinal. Records inserted before ordinals existed fall back to their ids.
+    """
+    return "_ordinal" in df.columns and bool(df["_ordinal"].notna().all())
+
+def values_close(optimized_value: Any, non_optimized_value: Any) -> bool:
+    if optimized_value is None or non_optimized_value is None:
+        return optimized_value is None and non_optimized_value is None
+    optimized_values = np.sort(np.asarray(optimized_value, dtype=float).ravel())
+    non_optimized_values = np.sort(np.asarray(non_optimized_value, dtype=float).ravel())
+    if optimized_values.shape != non_optimized_values.shape:
+        return False
+    return bool(np.all(np.isclose(optimized_values, non_optimized_values, rtol=AGGREGATION_RELATIVE_TOLERANCE, atol=AGGREGATION_ABSOLUTE_TOLERANCE, equal_nan=True)))
+
+def compare_aggregation_results(optimized_results: List[dict], non_optimized_results: List[dict]):
+    """
+    Compare the aggregations of both engines with AGGREGATION_ABSOLUTE_TOLERANCE and AGGREGATION_RELATIVE_TOLERANCE.
+    Returns None when equal or a description of the mismatch.
+    """
+    non_optimized_by_property = {result["property"]: result for result in non_optimized_results}
+    if len(optimized_results) != len(non_optimized_by_property):
+        return "aggregation produced a different number of properties"
+    mismatches = []
+    for optimized_result in optimized_results:
+        non_optimized_result = non_optimized_by_property.get(optimized_result["property"])
+        if non_optimized_result is None or set(optimized_result.keys()) != set(non_optimized_result.keys()):
+            mismatches.append(str(optimized_result["property"]))
+            continue
+        for operation in optimized_result.keys():
+            if operation == "property":
+                continue
+            try:
+                close = values_close(optimized_result[operation], non_optimized_result[operation])
+            except (TypeError, ValueError):
+                close = normalize_value(optimized_result[operation]) == normalize_value(non_optimized_result[operation])
+            if not close:
+                mismatches.append(f"{optimized_result['property']}.{operation}")
+    if len(mismatches) > 0:
+        return f"aggregation values differ for {', '.join(mismatches)}"
+    return None
+
+def compare_filter_results(optimized_result: dict, non_optimized_result: dict):
+    """
+    Compare the stored filter results of a batch of both engines by their sizes and record fingerprints.
+    Returns None when equal or a description of the mismatch.
+    """
+    if optimized_result["output_data_size"] != non_optimized_result["output_data_size"]:
+        return f"filter selected {optimized_result['output_data_size']} records with the optimized engine and {non_optimized_result['output_data_size']} with the non optimized engine"
+    if optimized_result.get("fingerprint") != non_optimized_result.get("fingerprint"):
+        return "filter selected different records"
+    return None
+
+def compare_group_results(optimized_result: dict, non_optimized_result: dict):
+    """
+    Compare the stored group results of a batch of both engines by their group membership fingerprints.
+    Returns None when equal or a description of the mismatch.
+    """
+    if optimized_result.get("fingerprint") != non_optimized_result.get("fingerprint"):
+        return "group assigned records to different groups"
+    return None
+
+def compare_batch_results(optimized_results: dict, non_optimized_results: dict) -> dict:
+    """
+    Compare the results of a batch stored by both engines, given per task process.
+    Returns a dictionary with the mismatch description (or None) per task process stored by either engine.
+    """
+    comparators = {
+        "filter": compare_filter_results,
+        "group": compare_group_results,
+        "aggregation": lambda optimized, non_optimized: compare_aggregation_results(optimized.get("results") or [], non_optimized.get("results") or [])
+    }
+    comparison = {}
+    for task_process, comparator in comparators.items():
+        optimized_result = optimized_results.get(task_process)
+        non_optimized_result = non_optimized_results.get(task_process)
+        if optimized_result is None and non_optimized_result is None:
+            continue
+        if optimized_result is None or non_optimized_result is None:
+            comparison[task_process] = f"{task_process} failed with the {'optimized' if optimized_result is None else 'non optimized'} engine"
+            continue
+        comparison[task_process] = comparator(optimized_result, non_optimized_result)
+    return comparison
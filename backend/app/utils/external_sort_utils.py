@@ -0,0 +1,125 @@
+from typing import Iterator, List
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+import tempfile
+import logging
+import pickle
+import shutil
+import os
+
+load_dotenv()
+INGEST_SORT_RUN_ROWS = int(os.getenv("INGEST_SORT_RUN_ROWS", "500000"))
+INGEST_SORT_MERGE_ROWS = int(os.getenv("INGEST_SORT_MERGE_ROWS", "200000"))
+INGEST_SORT_DIR = os.getenv("INGEST_SORT_DIR", "") or None
+SORT_KEY_COLUMN = "__cluster_key"
+NUMERIC_KEY_RATIO = 0.99
+
+def is_numeric_key(column: pd.Series) -> bool:
+    if column.dtype.kind in "iufb":
+        return True
+    non_null = column.dropna()
+    return len(non_null) > 0 and pd.to_numeric(non_null, errors="coerce").notna().mean() >= NUMERIC_KEY_RATIO
+
+def get_sort_key(column: pd.Series, numeric: bool) -> pd.Series:
+    """
+    Sort key of a column: numbers for numeric keys (values that do not coerce go with the nulls) or text otherwise.
+    """
+    if numeric:
+        return pd.to_numeric(column, errors="coerce").astype(float)
+    return column.where(column.isna(), column.astype(str))
+
+def write_blocks(df: pd.DataFrame, file_path: str, block_rows: int):
+    with open(file_path, "wb") as f:
+        for start in range(0, len(df), block_rows):
+            pickle.dump(df.iloc[start:start + block_rows], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def read_blocks(file_path: str) -> Iterator[pd.DataFrame]:
+    with open(file_path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def merge_runs(run_paths: List[str]) -> Iterator[pd.DataFrame]:
+    """
+    K-way merge of sorted runs reading one block per run at a time. Every step takes from all the buffers the rows
+    up to the smallest last key among them, which are the next rows in the global order.
+    """
+    readers = [read_blocks(run_path) for run_path in run_paths]
+    buffers = [next(reader, None) for reader in readers]
+    while any(buffer is not None for buffer in buffers):
+        active = [index for index, buffer in enumerate(buffers) if buffer is not None]
+        bound = min(buffers[index][SORT_KEY_COLUMN].iloc[-1] for index in active)
+        parts = []
+        for index in active:
+            buffer = buffers[index]
+            cut = int(np.searchsorted(buffer[SORT_KEY_COLUMN].to_numpy(), bound, side="right"))
+            parts.append(buffer.iloc[:cut])
+            buffers[index] = buffer.iloc[cut:] if cut < len(buffer) else next(readers[index], None)
+        # Runs are concatenated in file order and sorted stably, so equal keys keep the file order
+        yield pd.concat(parts).sort_values(SORT_KEY_COLUMN, kind="stable")
+
+def rechunk(frames: Iterator[pd.DataFrame], chunk_size: int) -> Iterator[pd.DataFrame]:
+    pending = []
+    pending_rows = 0
+    for frame in frames:
+        pending.append(frame)
+        pending_rows += len(frame)
+        while pending_rows >= chunk_size:
+            merged = pd.concat(pending)
+            yield merged.iloc[:chunk_size]
+            pending = [merged.iloc[chunk_size:]]
+            pending_rows = len(pending[0])
+    if pending_rows > 0:
+        yield pd.concat(pending)
+
+def sort_chunks(chunks: Iterator[pd.DataFrame], key: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    External sort of a stream of chunks by the key column in bounded memory. Sorted runs of INGEST_SORT_RUN_ROWS rows
+    are spilled to disk and merged back in chunks of chunk_size rows. Rows with a null key go last in file order.
+    """
+    sort_dir = tempfile.mkdtemp(prefix="cluster_sort_", dir=INGEST_SORT_DIR)
+    try:
+        run_paths = []
+        null_path = os.path.join(sort_dir, "nulls")
+        null_file = open(null_path, "wb")
+        numeric = None
+        run = []
+        run_rows = 0
+
+        def spill_run():
+            run_df = pd.concat(run).sort_values(SORT_KEY_COLUMN, kind="stable")
+            run_path = os.path.join(sort_dir, f"run_{len(run_paths)}")
+            # The merge holds one block per run, so blocks are sized for up to 16 runs in INGEST_SORT_MERGE_ROWS rows
+            write_blocks(run_df, run_path, max(INGEST_SORT_MERGE_ROWS // 16, 1000))
+            run_paths.append(run_path)
+
+        try:
+            for chunk in chunks:
+                if key not in chunk.columns:
+                    raise ValueError(f"Cluster key {key} is not a column of the file.")
+                if numeric is None:
+                    numeric = is_numeric_key(chunk[key])
+                sort_key = get_sort_key(chunk[key], numeric)
+                missing = sort_key.isna().to_numpy()
+                if missing.any():
+                    pickle.dump(chunk[missing], null_file, protocol=pickle.HIGHEST_PROTOCOL)
+                run.append(chunk[~missing].assign(**{SORT_KEY_COLUMN: sort_key[~missing]}))
+                run_rows += int((~missing).sum())
+                if run_rows >= INGEST_SORT_RUN_ROWS:
+                    spill_run()
+                    run = []
+                    run_rows = 0
+            if run_rows > 0:
+                spill_run()
+        finally:
+            null_file.close()
+        logging.info(f"Sorted {len(run_paths)} runs by {key}, merging them")
+
+        sorted_frames = (frame.drop(columns=[SORT_KEY_COLUMN]) for frame in merge_runs(run_paths))
+        yield from rechunk(sorted_frames, chunk_size)
+        yield from rechunk(read_blocks(null_path), chunk_size)
+    finally:
+        shutil.rmtree(sort_dir, ignore_errors=True)
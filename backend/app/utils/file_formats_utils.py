@@ -0,0 +1,82 @@
+from typing import Any, Iterator, Optional
+from io import BytesIO
+import pandas as pd
+import chardet
+import gzip
+
+COMPRESSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet"}
+FORMAT_TYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+def get_file_format(file_name: str) -> Optional[dict]:
+    """
+    Get the format and compression of a repository file from its extensions, e.g. data.csv.gz.
+    Returns None for unsupported files. Parquet files are compressed internally, so they can not be compressed again.
+    """
+    suffixes = [f".{suffix.lower()}" for suffix in str(file_name).split("/")[-1].split(".")[1:]]
+    compression = None
+    compression_suffix = ""
+    if len(suffixes) > 0 and suffixes[-1] in COMPRESSIONS:
+        compression_suffix = suffixes.pop()
+        compression = COMPRESSIONS[compression_suffix]
+    if len(suffixes) == 0 or suffixes[-1] not in FORMATS:
+        return None
+    file_format = FORMATS[suffixes[-1]]
+    if file_format == "parquet" and compression is not None:
+        return None
+
+    return {"format": file_format, "compression": compression, "type": FORMAT_TYPES[file_format], "extension": suffixes[-1] + compression_suffix}
+
+def read_sample(source: Any, compression: Optional[str], sample_size: int) -> bytes:
+    """
+    Read the first sample_size uncompressed bytes of a file path or a bytes stream.
+    """
+    if compression == "gzip":
+        with gzip.open(source, "rb") as f:
+            sample = f.read(sample_size)
+    elif compression == "zstd":
+        import zstandard
+
+        f = open(source, "rb") if isinstance(source, str) else source
+        try:
+            sample = zstandard.ZstdDecompressor().stream_reader(f, closefd=False).read(sample_size)
+        finally:
+            if isinstance(source, str):
+                f.close()
+    elif isinstance(source, str):
+        with open(source, "rb") as f:
+            sample = f.read(sample_size)
+    else:
+        sample = source.read(sample_size)
+    if isinstance(source, BytesIO):
+        source.seek(0)
+
+    return sample
+
+def detect_encoding(source: Any, compression: Optional[str] = None, sample_size: int = 10000) -> str:
+    result = chardet.detect(read_sample(source, compression, sample_size))
+    encoding = result['encoding'] or 'utf-8'
+    # Fallback: treat ascii as utf-8
+    if encoding.lower() == 'ascii':
+        encoding = 'utf-8'
+    return encoding
+
+def read_parquet_chunks(source: Any, chunk_size: int) -> Iterator[pd.DataFrame]:
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(source)
+    for record_batch in parquet_file.iter_batches(batch_size=chunk_size):
+        yield record_batch.to_pandas()
+
+def read_chunks_from_file(source: Any, file_format: dict, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Stream a repository file in DataFrames of chunk_size rows, decompressing it on the fly.
+    """
+    if file_format["format"] == "parquet":
+        return read_parquet_chunks(source, chunk_size)
+    if file_format["format"] == "jsonl":
+        # JSON Lines are UTF-8 by definition
+        return iter(pd.read_json(source, lines=True, chunksize=chunk_size, compression=file_format["compression"], encoding="utf-8", dtype=False))
+
+    encoding = detect_encoding(source, file_format["compression"])
+    return iter(pd.read_csv(source, chunksize=chunk_size, encoding=encoding, compression=file_format["compression"], on_bad_lines="warn"))
@@ -0,0 +1,64 @@
+from typing import List, Any, Dict, Iterable
+import numpy as np
+import hashlib
+import math
+
+def hash_parts(parts: Iterable[bytes]) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part)
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+def normalize_value(value: Any) -> str:
+    """
+    Canonical text of a value so both engines produce the same fingerprint for equal results.
+    Numbers are written exactly as floats, so 1 and 1.0 match, and lists are sorted. Only values read from the
+    records (group keys) are fingerprinted, computed values are compared with a tolerance instead.
+    """
+    if value is None:
+        return "null"
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return "[" + ",".join(sorted(normalize_value(item) for item in value)) + "]"
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        number = float(value)
+        if math.isnan(number):
+            return "nan"
+        return repr(number)
+    return str(value)
+
+def filter_fingerprint(record_ids: Iterable[Any]) -> str:
+    """
+    Order independent fingerprint of the records selected by a filter: hash of the sorted record ids.
+    """
+    return hash_parts(sorted(str(record_id).encode() for record_id in record_ids))
+
+def filter_bitmap_fingerprint(bitmap: Any) -> str:
+    """
+    Fingerprint of the records selected by a filter from its ordinals bitmap, whose bytes only depend on the ordinals.
+    """
+    return hash_parts([b"bitmap", bitmap.to_bytes()])
+
+def group_fingerprint(group_mapping: Dict[Any, List[Any]]) -> str:
+    """
+    Order independent fingerprint of grouped records: every group is hashed from its key and the fingerprint of its
+    record ids, and the sorted group hashes are hashed together.
+    """
+    group_hashes = []
+    for group_key, record_ids in group_mapping.items():
+        key = group_key if isinstance(group_key, tuple) else (group_key,)
+        group_hashes.append(hash_parts([normalize_value(item).encode() for item in key] + [filter_fingerprint(record_ids).encode()]).encode())
+    return hash_parts(sorted(group_hashes))
+
+def aggregation_fingerprint(aggregation_results: List[dict]) -> str:
+    """
+    Fingerprint of the properties and operations of aggregation results. The values are left out: rounding float
+    noise can put equal values on both sides of a rounding boundary, so they are compared with
+    AGGREGATION_ABSOLUTE_TOLERANCE when validating.
+    """
+    parts = []
+    for result in sorted(aggregation_results, key=lambda result: str(result.get("property"))):
+        parts.append(f"{result.get('property')}:{','.join(sorted(str(operation) for operation in result.keys()))}".encode())
+    return hash_parts(parts)
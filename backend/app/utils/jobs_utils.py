@@ -0,0 +1,149 @@
+from app.database import db
+from datetime import datetime
+from typing import Any, List
+from pymongo import ReturnDocument
+import logging
+
+async def enqueue_job(job_type: str, data: Any = None):
+    """
+    Insert a job in the jobs queue.
+    The enqueue time is stored with the job so the worker can measure how long it waited in the queue.
+    """
+    job = {"type": job_type, "data": data if data is not None else {}, "status": "queued", "owner": None, "lease_expires_at": None, "attempts": 0, "created_at": datetime.now()}
+    result = await db["jobs"].insert_one(job)
+
+    return result.inserted_id
+
+async def enqueue_jobs(jobs: List[dict]):
+    """
+    Insert several jobs with one round trip. Each item has the job "type" and its "data".
+    """
+    if len(jobs) == 0:
+        return []
+    now = datetime.now()
+    result = await db["jobs"].insert_many([
+        {"type": job["type"], "data": job.get("data") or {}, "status": "queued", "owner": None, "lease_expires_at": None, "attempts": 0, "created_at": now}
+        for job in jobs
+    ])
+
+    return result.inserted_ids
+
+async def claim_job(worker_id: str, lease_seconds: int, excluded_types: List[str] = None):
+    """
+    Claim the oldest queued job for a worker with a lease of lease_seconds.
+    The job stays in the collection while it runs, so it is re-queued if the worker stops renewing the lease.
+    Lease times use the MongoDB server clock ($$NOW) so workers on different hosts agree on expirations.
+    Jobs enqueued before leases existed have no status and are claimed as queued jobs.
+    """
+    query = {"status": {"$in": ["queued", None]}}
+    if excluded_types:
+        query["type"] = {"$nin": excluded_types}
+
+    return await db["jobs"].find_one_and_update(
+        query,
+        [{"$set": {
+            "status": "running",
+            "owner": worker_id,
+            "lease_expires_at": {"$add": ["$$NOW", lease_seconds * 1000]},
+            "heartbeat_at": "$$NOW",
+            "started_at": "$$NOW",
+            "attempts": {"$add": [{"$ifNull": ["$attempts", 0]}, 1]}
+        }}],
+        sort=[("_id", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def renew_job_lease(job_id, worker_id: str, lease_seconds: int) -> bool:
+    """
+    Extend the lease of a running job. Returns False if the worker does not own the job anymore.
+    """
+    result = await db["jobs"].update_one(
+        {"_id": job_id, "owner": worker_id, "status": "running"},
+        [{"$set": {"lease_expires_at": {"$add": ["$$NOW", lease_seconds * 1000]}, "heartbeat_at": "$$NOW"}}]
+    )
+
+    return result.matched_count > 0
+
+def get_lease_query(job_id, worker_id: str, attempts: int = None) -> dict:
+    """
+    Query matching a job only while the worker holds its lease. The attempt tells apart a job the same worker
+    claimed again after its lease expired.
+    """
+    query = {"_id": job_id, "owner": worker_id, "status": "running"}
+    if attempts is not None:
+        query["attempts"] = attempts
+    return query
+
+async def complete_job(job_id, worker_id: str, attempts: int = None) -> bool:
+    """
+    Remove a finished job from the queue. Returns False if the worker lost the lease of the job.
+    """
+    result = await db["jobs"].delete_one(get_lease_query(job_id, worker_id, attempts))
+    return result.deleted_count > 0
+
+async def fail_job(job_id, worker_id: str, error: str, attempts: int = None) -> bool:
+    """
+    Mark a job as failed. Failed jobs are kept in the collection for inspection and are not retried.
+    Returns False if the worker lost the lease of the job.
+    """
+    result = await db["jobs"].update_one(
+        get_lease_query(job_id, worker_id, attempts),
+        {"$set": {"status": "failed", "errors": error, "lease_expires_at": None, "finished_at": datetime.now()}}
+    )
+    return result.matched_count > 0
+
+async def release_job(job_id, worker_id: str):
+    """
+    Give a claimed job back to the queue without counting the attempt, e.g. when the worker shuts down.
+    """
+    await db["jobs"].update_one(
+        {"_id": job_id, "owner": worker_id, "status": "running"},
+        {"$set": {"status": "queued", "owner": None, "lease_expires_at": None}, "$inc": {"attempts": -1}}
+    )
+
+async def requeue_expired_jobs(max_attempts: int):
+    """
+    Re-queue the running jobs whose lease expired, because their worker crashed or lost the connection.
+    Jobs that already used max_attempts are marked as failed instead.
+    """
+    expired_query = {"status": "running", "$expr": {"$lt": ["$lease_expires_at", "$$NOW"]}}
+    requeued = await db["jobs"].update_many(
+        {**expired_query, "attempts": {"$lt": max_attempts}},
+        {"$set": {"status": "queued", "owner": None, "lease_expires_at": None}}
+    )
+    failed = await db["jobs"].update_many(
+        {**expired_query, "attempts": {"$gte": max_attempts}},
+        {"$set": {"status": "failed", "errors": f"Lease expired after {max_attempts} attempts", "lease_expires_at": None, "finished_at": datetime.now()}}
+    )
+    if requeued.modified_count > 0:
+        logging.warning(f"Re-queued {requeued.modified_count} jobs with expired leases.")
+    if failed.modified_count > 0:
+        logging.error(f"Marked {failed.modified_count} jobs with expired leases as failed after {max_attempts} attempts.")
+
+def get_queue_latency(job: dict, started_at: datetime) -> int:
+    """
+    Get the time in milliseconds a job waited in the queue before being started.
+    Jobs enqueued before the enqueue time was stored fall back to the ObjectId generation time.
+    """
+    created_at = job.get("created_at")
+    if created_at is None:
+        created_at = job["_id"].generation_time.astimezone().replace(tzinfo=None)
+
+    return max(int((started_at - created_at).total_seconds() * 1000), 0)
+
+async def store_job_metrics(job_type: str, queue_latency: int, run_time: int, failed: bool):
+    """
+    Accumulate the queue latency and run time metrics of a job in its job type metrics document.
+    """
+    try:
+        await db["job_metrics"].update_one(
+            {"_id": job_type},
+            {
+                "$inc": {"count": 1, "failed": 1 if failed else 0, "total_queue_latency": queue_latency, "total_run_time": run_time},
+                "$max": {"max_queue_latency": queue_latency, "max_run_time": run_time},
+                "$set": {"last_queue_latency": queue_latency, "last_run_time": run_time, "updated_at": datetime.now()}
+            },
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"Error storing job metrics for job type {job_type}: {e}")
@@ -4,12 +4,22 @@ from app.database import db
 from app.utils.monitor_resources_utils import monitor_resources, get_metrics, dequeue_measurements, get_process_times, compute_cgroup_cpu_percent
 from queue import Queue
 from threading import Lock
-from app.utils.general_utils import group_results_to_objects, convert_numpy_types
+from app.utils.general_utils import convert_numpy_types
+from app.utils.fingerprint_utils import filter_fingerprint, filter_bitmap_fingerprint, group_fingerprint, aggregation_fingerprint
+from app.utils.equivalence_utils import compare_batch_results, has_ordinals
+from app.utils.bitmap_utils import OrdinalBitmap, union_bitmaps
+from app.utils.csr_utils import encode_groups
+from app.utils.zone_maps_utils import get_zone_plan
+from app.utils.records_layout_utils import get_records_collection, get_layout_repository, get_records_collection_name, is_bucketed
+from app.utils.buckets_utils import buckets_to_df, fetch_buckets_batch, get_bucket_range_starts
+from bson.binary import Binary
 from datetime import datetime
 from dotenv import load_dotenv
 from app.utils import non_optimized_processing_utils as non_opt_utils
 from app.utils import optimized_processing_utils as opt_utils
 from app.utils.records_utils import delete_collection_in_batches
+from app.utils.jobs_utils import enqueue_job, enqueue_jobs
+from pymongo import ReturnDocument
 from collections import defaultdict
 import multiprocessing as mp
 import pandas as pd
@@ -21,10 +31,14 @@ import os
 load_dotenv()
 PROCESSES_RECORDS_BATCH_SIZE = int(os.getenv("PROCESSES_RECORDS_BATCH_SIZE", "15000"))
 PROCESS_RESULTS_BATCH_SIZE = int(os.getenv("PROCESS_RESULTS_BATCH_SIZE", "500"))
+PROCESS_SHARD_BATCHES = int(os.getenv("PROCESS_SHARD_BATCHES", "20"))
+PROCESS_RANGE_MAX_ATTEMPTS = int(os.getenv("PROCESS_RANGE_MAX_ATTEMPTS", "3"))
+CRON_ITERATIONS = int(os.getenv("CRON_ITERATIONS", "10"))
 USES_CGROUP_CPU_MEASUREMENT = bool(os.getenv("USES_CGROUP_CPU_MEASUREMENT", "").lower() == "true")
+INLINE_EQUIVALENCE_CHECK = bool(os.getenv("INLINE_EQUIVALENCE_CHECK", "").lower() == "true")
 
 
-async def store_success(process_id, input_data_size, output_data_size, metrics, time_metrics):
+async def store_success(process_id, input_data_size, output_data_size, metrics, time_metrics, extra_fields=None, results_bitmap=None):
   await db["processes"].update_one(
     {"_id": ObjectId(process_id)},
     {"$set": 
@@ -33,29 +47,42 @@ async def store_success(process_id, input_data_size, output_data_size, metrics,
         "output_data_size": output_data_size,
         "metrics": metrics,
         **time_metrics,
+        **(extra_fields or {}),
+        "results_bitmap": Binary(results_bitmap.to_bytes()) if results_bitmap is not None else None,
         "status": "completed",
         "errors": None,
         "updated_at": datetime.now()
       }
     })
 
-async def store_batch(process_item_id, process_id, input_data_size, output_data_size, metrics, batch_number, task_process, trigger_type, iteration, optimized, repository):
-  await db["process_results"].insert_one(
+async def store_batch(process_item_id, process_id, input_data_size, output_data_size, metrics, batch_number, task_process, trigger_type, iteration, optimized, repository, fingerprint=None, bitmap=None, groups=None, results=None):
+  """
+  Store the results of a batch of a process item. A batch processed again after resuming a process replaces
+  its previous results instead of duplicating them. Filter batches store the selected record ordinals as a bitmap,
+  group batches the row ordinals of every group in CSR layout and aggregation batches their values.
+  """
+  await db["process_results"].update_one(
+    {"process_item_id": ObjectId(process_item_id), "batch_number": batch_number},
     {
-      "process_item_id": ObjectId(process_item_id),
-      "process_id": ObjectId(process_id),
-      "repository": ObjectId(repository),
-      "input_data_size": input_data_size,
-      "output_data_size": output_data_size,
-      "optimized": optimized,
-      "batch_number": batch_number,
-      "type": task_process,
-      "trigger_type": trigger_type,
-      "iteration": iteration,
-      "metrics": metrics,
-      "created_at": datetime.now(),
-      "updated_at": datetime.now()
-    })
+      "$set": {
+        "process_id": ObjectId(process_id),
+        "repository": ObjectId(repository),
+        "input_data_size": input_data_size,
+        "output_data_size": output_data_size,
+        "optimized": optimized,
+        "type": task_process,
+        "trigger_type": trigger_type,
+        "iteration": iteration,
+        "metrics": metrics,
+        "fingerprint": fingerprint,
+        "bitmap": Binary(bitmap.to_bytes()) if bitmap is not None else None,
+        "groups": Binary(groups) if groups is not None else None,
+        "results": results,
+        "updated_at": datetime.now()
+      },
+      "$setOnInsert": {"created_at": datetime.now()}
+    },
+    upsert=True)
 
 async def store_errors(process_id,  input_data_size, metrics, time_metrics, errors):
   await db["processes"].update_one(
@@ -85,15 +112,20 @@ async def apply_filter(df: pd.DataFrame, processes, utils, num_processes: int, b
   
   try:
     filter_results = None
-    filter_results = utils.filter_data(df, filter_process_item["parameters"])
+    filter_results = await asyncio.to_thread(utils.filter_data, df, filter_process_item["parameters"])
     stop_event.set()
     monitor_thread.join()
     filter_metrics_list = dequeue_measurements(filter_metrics, filter_lock)
     
-    #normalized_filter_results = filter_results["_id"].tolist()
     output_filter_data_size = len(filter_results)
+    bitmap = None
+    if has_ordinals(df):
+      bitmap = await asyncio.to_thread(OrdinalBitmap.from_ordinals, filter_results["_ordinal"].to_numpy())
+      fingerprint = filter_bitmap_fingerprint(bitmap)
+    else:
+      fingerprint = await asyncio.to_thread(filter_fingerprint, filter_results["_id"].tolist())
     
-    await store_batch(filter_process_item["_id"], filter_process_item["process_id"], input_filter_data_size, output_filter_data_size, filter_metrics_list, batch_number, "filter", trigger_type, iteration, filter_process_item["optimized"], filter_process_item["repository"])
+    await store_batch(filter_process_item["_id"], filter_process_item["process_id"], input_filter_data_size, output_filter_data_size, filter_metrics_list, batch_number, "filter", trigger_type, iteration, filter_process_item["optimized"], filter_process_item["repository"], fingerprint, bitmap)
 
     return filter_results
   except Exception as e:
@@ -112,6 +144,8 @@ async def apply_groupping(df: pd.DataFrame, processes, utils, batch_number: int,
   if not group_process_item:
     logging.error("Group process not found")
     raise ValueError("Group process not found")
+  # Groups are stored as row ordinals when every record has one, otherwise as record ids
+  map_property = "_ordinal" if has_ordinals(df) else "_id"
   if group_process_item["optimized"] is not True:
     df = df.to_dict(orient="records")
   group_metrics = Queue()
@@ -120,19 +154,17 @@ async def apply_groupping(df: pd.DataFrame, processes, utils, batch_number: int,
   monitor_thread = threading.Thread(target=monitor_resources, args=(0.250, stop_event, group_metrics, group_lock))
   monitor_thread.start()
   try:
-    group_results = utils.group_data(df, group_process_item["parameters"])
+    group_results = await asyncio.to_thread(utils.group_data, df, group_process_item["parameters"])
     stop_event.set()
     monitor_thread.join()
     group_metrics_list = dequeue_measurements(group_metrics, group_lock)
-    # normalized_group_results = utils.map_groupped_records(group_results, "_id")
-    # grouped_objects = group_results_to_objects(normalized_group_results)
+    normalized_group_results = await asyncio.to_thread(utils.map_groupped_records, group_results, map_property)
+    fingerprint = await asyncio.to_thread(group_fingerprint, normalized_group_results)
+    groups = await asyncio.to_thread(encode_groups, normalized_group_results) if map_property == "_ordinal" else None
     
-    # if group_process_item["optimized"] is True:
-    #   grouped_objects = convert_numpy_types(grouped_objects)
-    
-    #output_group_data_size = len(grouped_objects) + sum(len(obj["values"]) for obj in grouped_objects)
-    
-    await store_batch(group_process_item["_id"], group_process_item["process_id"], input_group_data_size, None, group_metrics_list, batch_number, "group", trigger_type, iteration, group_process_item["optimized"], group_process_item["repository"])
+    await store_batch(group_process_item["_id"], group_process_item["process_id"], input_group_data_size, None, group_metrics_list, batch_number, "group", trigger_type, iteration, group_process_item["optimized"], group_process_item["repository"], fingerprint, groups=groups)
+
+    return normalized_group_results
     
     #await store_success(group_process_item["_id"], input_group_data_size, output_group_data_size, group_metrics_list, group_time_metrics, grouped_objects)
     
@@ -158,15 +190,15 @@ async def apply_aggregation(df: pd.DataFrame, processes, utils, batch_number: in
   monitor_thread = threading.Thread(target=monitor_resources, args=(0.250, stop_event, aggregation_metrics, aggregation_lock))
   monitor_thread.start()
   try:
-    aggregation_results = utils.aggregate_data(df, aggregation_process_item["parameters"])
+    aggregation_results = await asyncio.to_thread(utils.aggregate_data, df, aggregation_process_item["parameters"])
     stop_event.set()
     monitor_thread.join()
     aggregation_metrics_list = dequeue_measurements(aggregation_metrics, aggregation_lock)
+    fingerprint = aggregation_fingerprint(aggregation_results)
     
-    # if aggregation_process_item["optimized"] is True:
-    #   aggregation_results = convert_numpy_types(aggregation_results)
-    
-    await store_batch(aggregation_process_item["_id"], aggregation_process_item["process_id"], input_aggregation_data_size, None, aggregation_metrics_list, batch_number, "aggregation", trigger_type, iteration, aggregation_process_item["optimized"], aggregation_process_item["repository"])
+    await store_batch(aggregation_process_item["_id"], aggregation_process_item["process_id"], input_aggregation_data_size, None, aggregation_metrics_list, batch_number, "aggregation", trigger_type, iteration, aggregation_process_item["optimized"], aggregation_process_item["repository"], fingerprint, results=convert_numpy_types(aggregation_results))
+
+    return aggregation_results
     #await store_success(aggregation_process_item["_id"], input_aggregation_data_size, None, aggregation_metrics_list, aggregation_time_metrics, aggregation_results)
     
   except Exception as e:
@@ -181,33 +213,68 @@ async def apply_aggregation(df: pd.DataFrame, processes, utils, batch_number: in
   
 
 async def process_data(df: pd.DataFrame, processes, utils, num_processes, actions, optimized, batch_number: int, trigger_type, iteration):
+  """
+  Apply the actions of a process to a batch with one engine.
+  Returns the output of every task process applied (None for the ones that failed).
+  """
+  outputs = {}
   if "filter" in actions:
     try:
       filter_results = await apply_filter(df, processes, utils, num_processes, batch_number, trigger_type, iteration)
+      outputs["filter"] = filter_results
       if "group" in actions and "aggregation" in actions:
-        await apply_groupping(filter_results, processes, utils, batch_number, trigger_type, iteration),
-        await apply_aggregation(filter_results, processes, utils, batch_number, trigger_type, iteration)
+        outputs["group"] = await apply_groupping(filter_results, processes, utils, batch_number, trigger_type, iteration)
+        outputs["aggregation"] = await apply_aggregation(filter_results, processes, utils, batch_number, trigger_type, iteration)
       elif "group" in actions:
-        await apply_groupping(filter_results, processes, utils, batch_number, trigger_type, iteration)
+        outputs["group"] = await apply_groupping(filter_results, processes, utils, batch_number, trigger_type, iteration)
       elif "aggregation" in actions:
-        await apply_aggregation(filter_results, processes, utils, batch_number, trigger_type, iteration)
+        outputs["aggregation"] = await apply_aggregation(filter_results, processes, utils, batch_number, trigger_type, iteration)
     except Exception as e:
       if "group" in actions:
         group_process = next((p for p in processes if p["task_process"] == "group"), None)
         if group_process:
-          await db["processes"].update_one({"_id": group_process_item["_id"]}, {"$set": {"status": "failed", "errors": f"FILTER errors: {str(e)}", "updated_at": datetime.now()}})
+          await db["processes"].update_one({"_id": group_process["_id"]}, {"$set": {"status": "failed", "errors": f"FILTER errors: {str(e)}", "updated_at": datetime.now()}})
       if "aggregation" in actions:
         aggregation_process = next((p for p in processes if p["task_process"] == "aggregation"), None)
         if aggregation_process:
           await db["processes"].update_one({"_id": aggregation_process["_id"]}, {"$set": {"status": "failed", "errors": f"FILTER errors: {str(e)}", "updated_at": datetime.now()}})
   elif "group" in actions and "aggregation" in actions:
-    await apply_groupping(df, processes, utils, batch_number, trigger_type, iteration),
-    await apply_aggregation(df, processes, utils, batch_number, trigger_type, iteration)
+    outputs["group"] = await apply_groupping(df, processes, utils, batch_number, trigger_type, iteration)
+    outputs["aggregation"] = await apply_aggregation(df, processes, utils, batch_number, trigger_type, iteration)
   elif "group" in actions:
-    await apply_groupping(df, processes, utils, batch_number, trigger_type, iteration)
+    outputs["group"] = await apply_groupping(df, processes, utils, batch_number, trigger_type, iteration)
   elif "aggregation" in actions:
-    await apply_aggregation(df, processes, utils, batch_number, trigger_type, iteration)
-    
+    outputs["aggregation"] = await apply_aggregation(df, processes, utils, batch_number, trigger_type, iteration)
+
+  return outputs
+
+async def store_equivalence(processes: List[Any], batch_number: int, comparison: dict):
+  """
+  Store in the batch results of both engines whether each task process produced equivalent outputs.
+  """
+  for task_process, mismatch in comparison.items():
+    process_item_ids = [process["_id"] for process in processes if process["task_process"] == task_process]
+    await db["process_results"].update_many(
+      {"process_item_id": {"$in": process_item_ids}, "batch_number": batch_number},
+      {"$set": {"equivalent": mismatch is None, "mismatch": mismatch}}
+    )
+    if mismatch is not None:
+      logging.warning(f"Engines mismatch in {task_process} of process_id {processes[0]['process_id']} batch {batch_number}: {mismatch}")
+
+async def get_inline_validation(process_item_id):
+  """
+  Get the validation of a process item from the engines equivalence stored in its batch results.
+  Returns None when its batches were not compared.
+  """
+  summary = await db["process_results"].aggregate([
+    {"$match": {"process_item_id": ObjectId(process_item_id), "equivalent": {"$exists": True}}},
+    {"$group": {"_id": None, "compared_batches": {"$sum": 1}, "mismatched_batches": {"$sum": {"$cond": ["$equivalent", 0, 1]}}}}
+  ]).to_list(length=None)
+  if len(summary) == 0:
+    return None
+
+  return {"validated": True, "valid": summary[0]["mismatched_batches"] == 0, "mismatched_batches": summary[0]["mismatched_batches"]}
+
 async def start_metrics_results_gathering(process_id: str, processes: List[Any], repository: Any, actions, trigger_type: str, total_batches, total_num_processes: int = 1):
   """
   Gather metrics and results for a given process.
@@ -219,7 +286,8 @@ async def start_metrics_results_gathering(process_id: str, processes: List[Any],
       process_input_data_size = 0
       process_output_data_size = 0
       process_time_metrics = {}
-      process_metrics = []
+      batch_bitmaps = []
+      missing_bitmaps = False
       
       if current_process["task_process"] == "filter" or "filter" not in actions:
         process_input_data_size = repository["current_data_size"]
@@ -232,136 +300,418 @@ async def start_metrics_results_gathering(process_id: str, processes: List[Any],
         
         process_input_data_size = input_filter_data_size_list[0]["output_data_size"] if input_filter_data_size_list else 0
         
+      range_metrics = defaultdict(list)
       for i in range(0, total_batches, PROCESS_RESULTS_BATCH_SIZE):
-        batch_results = await db["process_results"].find({"process_item_id": ObjectId(process["_id"])}, {"metrics": 1, "results": 1, "output_data_size": 1}).sort("batch_number", 1).skip(i).limit(PROCESS_RESULTS_BATCH_SIZE).to_list(length=None)
-        process_metrics.extend([item for result in batch_results if result["metrics"] is not None for item in result["metrics"]])
+        batch_results = await db["process_results"].find({"process_item_id": ObjectId(process["_id"])}, {"batch_number": 1, "metrics": 1, "results": 1, "output_data_size": 1, "bitmap": 1}).sort("batch_number", 1).skip(i).limit(PROCESS_RESULTS_BATCH_SIZE).to_list(length=None)
+        for result in batch_results:
+          if not result["metrics"]:
+            continue
+          batch_metrics = sorted(result["metrics"], key=lambda x: x["timestamp"])
+          # Cumulative cgroup counters are only comparable within a batch, which one worker ran
+          if USES_CGROUP_CPU_MEASUREMENT is True:
+            batch_metrics = compute_cgroup_cpu_percent(batch_metrics, total_num_processes)
+          range_metrics[(result["batch_number"] - 1) // PROCESS_SHARD_BATCHES].extend(batch_metrics)
+        if current_process["task_process"] == "filter":
+          missing_bitmaps = missing_bitmaps or any(result.get("bitmap") is None for result in batch_results)
+          batch_bitmaps.extend(OrdinalBitmap.from_bytes(result["bitmap"]) for result in batch_results if result.get("bitmap") is not None)
         if current_process["task_process"] != "aggregation":
           process_output_data_size += sum(result["output_data_size"] for result in batch_results if result["output_data_size"] is not None)
           
           
-      process_metrics.sort(key=lambda x: x["timestamp"] if isinstance(x, dict) and "timestamp" in x else 0)
-      
-      if USES_CGROUP_CPU_MEASUREMENT is True:
-        process_metrics = compute_cgroup_cpu_percent(process_metrics, total_num_processes)
-      
-      first_process_metric = process_metrics[0] if len(process_metrics) > 0 else None
-      last_process_metric = process_metrics[::-1][0]  if len(process_metrics) > 0 else None
-      
-      if first_process_metric != None and last_process_metric != None:
-        process_time_metrics = get_process_times([first_process_metric, last_process_metric])
-        
+      process_metrics = sorted((metric for metrics in range_metrics.values() for metric in metrics), key=lambda x: x["timestamp"])
+      # Batch ranges may run in parallel on several workers, so the duration adds the time of every range
+      range_times = [get_process_times(sorted(metrics, key=lambda x: x["timestamp"])) for metrics in range_metrics.values()]
+      if len(range_times) > 0:
+        process_time_metrics = {
+          "start_time": min(times["start_time"] for times in range_times),
+          "end_time": max(times["end_time"] for times in range_times),
+          "duration": sum(times["duration"] for times in range_times)
+        }
+
       if len(process_metrics) == 0:
         process_time_metrics = {"duration": 0}
       
       if current_process["task_process"] == "aggregation":
         process_output_data_size = None
       
-      await store_success(process["_id"], process_input_data_size, process_output_data_size, process_metrics, process_time_metrics)
+      results_bitmap = None
+      if current_process["task_process"] == "filter" and len(batch_bitmaps) > 0 and not missing_bitmaps:
+        results_bitmap = await asyncio.to_thread(union_bitmaps, batch_bitmaps)
+        process_output_data_size = results_bitmap.cardinality()
+
+      validation = await get_inline_validation(process["_id"]) if INLINE_EQUIVALENCE_CHECK else None
+      extra_fields = {**(validation or {}), "skipped_batches_count": len(current_process.get("skipped_batches", []))}
+      await store_success(process["_id"], process_input_data_size, process_output_data_size, process_metrics, process_time_metrics, extra_fields, results_bitmap)
       logging.info(f"Process {process['_id']} completed successfully")
     else:
       logging.warning(f"Process {process['_id']} is not in progress, skipping results gathering")
   logging.info(f"All processes for process_id {process_id} completed successfully")
   
+def get_total_batches(total_records: int) -> int:
+  return total_records // PROCESSES_RECORDS_BATCH_SIZE + (1 if total_records % PROCESSES_RECORDS_BATCH_SIZE > 0 else 0)
+
+def get_run_query(process_id: str, iteration: int, trigger_type: str) -> dict:
+  """
+  Query identifying one run (iteration and trigger) of a process in the process_shards collection.
+  """
+  return {"process_id": ObjectId(process_id), "iteration": iteration, "trigger_type": trigger_type}
+
+async def get_run_processes(process_id: str, repository_id: str, iteration: int, trigger_type: str):
+  return await db["processes"].find({"process_id": ObjectId(process_id), "repository": ObjectId(repository_id), "trigger_type": trigger_type, "iteration": iteration, "status": "in_progress"}).to_list(length=None)
+
+async def fetch_records_batch(repository_id: str, start_after_id: Any):
+  """
+  Fetch the next PROCESSES_RECORDS_BATCH_SIZE records of a repository after the given _id, in _id order.
+  """
+  query = {"repository": ObjectId(repository_id)}
+  if start_after_id is not None:
+    query["_id"] = {"$gt": ObjectId(start_after_id)}
+
+  records_collection = await get_records_collection(repository_id)
+  return await records_collection.find(query).sort("_id", 1).limit(PROCESSES_RECORDS_BATCH_SIZE).to_list(length=None)
+
+async def fetch_batch_df(repository_id: str, start_after_id: Any):
+  """
+  Fetch the next batch of a repository as the DataFrame the engines process, with the _id the next batch starts after.
+  Bucketed repositories decode whole buckets into columns and continue after the last bucket read.
+  """
+  repository = await get_layout_repository(repository_id)
+  if is_bucketed(repository):
+    buckets = await fetch_buckets_batch(db[get_records_collection_name(repository)], repository_id, start_after_id, PROCESSES_RECORDS_BATCH_SIZE)
+    if len(buckets) == 0:
+      return None, start_after_id
+    return await asyncio.to_thread(buckets_to_df, buckets), buckets[-1]["_id"]
+
+  batch = await fetch_records_batch(repository_id, start_after_id)
+  if len(batch) == 0:
+    return None, start_after_id
+  return pd.DataFrame([{"_id": record["_id"], "_ordinal": record.get("ordinal"), **record["data"]} for record in batch]), batch[-1]["_id"]
+
+async def get_batch_ranges(repository_id: str, total_batches: int) -> List[dict]:
+  """
+  Split the batches of a repository in ranges of PROCESS_SHARD_BATCHES batches.
+  Each range starts after the last record _id of the previous range. The boundaries are found walking the
+  _id index from one range to the next, so planning reads every index key once instead of skipping from the start.
+  """
+  ranges = []
+  start_after_id = None
+  repository = await get_layout_repository(repository_id)
+  records_collection = db[get_records_collection_name(repository)]
+  range_size = PROCESS_SHARD_BATCHES * PROCESSES_RECORDS_BATCH_SIZE
+  if is_bucketed(repository):
+    starts = [None] + [str(bucket_id) for bucket_id in await get_bucket_range_starts(records_collection, repository_id, PROCESSES_RECORDS_BATCH_SIZE, PROCESS_SHARD_BATCHES)]
+    for index, first_batch in enumerate(range(1, total_batches + 1, PROCESS_SHARD_BATCHES)):
+      if index >= len(starts):
+        break
+      ranges.append({"first_batch": first_batch, "last_batch": min(first_batch + PROCESS_SHARD_BATCHES - 1, total_batches), "start_after_id": starts[index]})
+    return ranges
+  for first_batch in range(1, total_batches + 1, PROCESS_SHARD_BATCHES):
+    last_batch = min(first_batch + PROCESS_SHARD_BATCHES - 1, total_batches)
+    ranges.append({"first_batch": first_batch, "last_batch": last_batch, "start_after_id": start_after_id})
+    if last_batch == total_batches:
+      break
+    query = {"repository": ObjectId(repository_id)}
+    if start_after_id is not None:
+      query["_id"] = {"$gt": ObjectId(start_after_id)}
+    boundary = await records_collection.find(query, {"_id": 1}).sort("_id", 1).skip(range_size - 1).limit(1).to_list(length=1)
+    if len(boundary) == 0:
+      break
+    start_after_id = str(boundary[0]["_id"])
+
+  return ranges
+
+def get_checkpoint(processes: List[Any], first_batch: int):
+  """
+  Get the last checkpoint of a batch range stored in the processes of one engine.
+  """
+  for process in processes:
+    checkpoint = (process.get("checkpoints") or {}).get(str(first_batch))
+    if checkpoint:
+      return checkpoint
+  return None
+
+async def store_checkpoint(processes: List[Any], first_batch: int, batch_number: int, last_record_id: Any):
+  """
+  Store in the processes of one engine the last batch of a batch range completed and the last record _id it read.
+  """
+  await db["processes"].update_many(
+    {"_id": {"$in": [process["_id"] for process in processes]}},
+    {"$set": {f"checkpoints.{first_batch}": {"batch_number": batch_number, "last_record_id": last_record_id, "updated_at": datetime.now()}}}
+  )
+
+async def store_skipped_batch(processes: List[Any], batch_number: int, input_data_size: int, trigger_type: str, iteration: int):
+  """
+  Store the results of a batch that was not read because its zone maps prove the filter empty: an empty filter
+  bitmap, no groups and no aggregations, with the fingerprints of those empty results, so it is gathered, compared
+  and validated as any other batch. The batch is also recorded in the skipped_batches of the processes.
+  """
+  for process in processes:
+    if process["task_process"] == "filter":
+      bitmap = OrdinalBitmap.from_ordinals([])
+      await store_batch(process["_id"], process["process_id"], input_data_size, 0, [], batch_number, "filter", trigger_type, iteration, process["optimized"], process["repository"], filter_bitmap_fingerprint(bitmap), bitmap)
+    elif process["task_process"] == "group":
+      await store_batch(process["_id"], process["process_id"], 0, None, [], batch_number, "group", trigger_type, iteration, process["optimized"], process["repository"], group_fingerprint({}), groups=encode_groups({}))
+    elif process["task_process"] == "aggregation":
+      await store_batch(process["_id"], process["process_id"], 0, None, [], batch_number, "aggregation", trigger_type, iteration, process["optimized"], process["repository"], aggregation_fingerprint([]), results=[])
+  await db["processes"].update_many({"_id": {"$in": [process["_id"] for process in processes]}}, {"$addToSet": {"skipped_batches": batch_number}})
+
+async def run_batch_range(processes: List[Any], repository_id: str, actions, iteration: int, trigger_type: str, first_batch: int, last_batch: int, start_after_id: Any = None):
+  """
+  Process the batches first_batch to last_batch with both engines, starting after the record start_after_id.
+  A checkpoint is stored per engine after every batch, so a range that is run again (e.g. after its worker died)
+  continues after the last completed batch. With INLINE_EQUIVALENCE_CHECK the batch results of both engines are
+  compared once the range is processed.
+  """
+  optimized_processes = [process for process in processes if process["optimized"] is True]
+  non_optimized_processes = [process for process in processes if process["optimized"] is False]
+  total_num_processes = mp.cpu_count()
+  zone_plan = await get_zone_plan(repository_id, processes, actions, PROCESSES_RECORDS_BATCH_SIZE)
+  engines = [
+    (optimized_processes, opt_utils, max(total_num_processes - 3, 1), True),
+    (non_optimized_processes, non_opt_utils, None, False)
+  ]
+
+  for engine_processes, utils, num_processes, optimized in engines:
+    if len(engine_processes) == 0:
+      continue
+    next_batch = first_batch
+    last_record_id = start_after_id
+    checkpoint = get_checkpoint(engine_processes, first_batch)
+    if checkpoint:
+      next_batch = checkpoint["batch_number"] + 1
+      last_record_id = checkpoint["last_record_id"]
+      logging.info(f"Resuming {'optimized' if optimized else 'non optimized'} processes of process_id {engine_processes[0]['process_id']} at batch {next_batch}")
+
+    for batch_number in range(next_batch, last_batch + 1):
+      if zone_plan is not None and zone_plan.is_batch_empty(batch_number):
+        last_record_id = await zone_plan.get_batch_last_id(batch_number)
+        await store_skipped_batch(engine_processes, batch_number, zone_plan.get_batch_size(batch_number), trigger_type, iteration)
+        await store_checkpoint(engine_processes, first_batch, batch_number, last_record_id)
+        continue
+      df, last_record_id = await fetch_batch_df(repository_id, last_record_id)
+      if df is None:
+        break
+
+      await process_data(df, engine_processes, utils, num_processes, actions, optimized, batch_number, trigger_type, iteration)
+      await store_checkpoint(engine_processes, first_batch, batch_number, last_record_id)
+
+  if INLINE_EQUIVALENCE_CHECK and len(optimized_processes) > 0 and len(non_optimized_processes) > 0:
+    await compare_batch_range(processes, first_batch, last_batch)
+
+async def compare_batch_range(processes: List[Any], first_batch: int, last_batch: int):
+  """
+  Compare the batch results both engines stored for the batches first_batch to last_batch. Each engine ran the
+  whole range on its own, so the time measured for one engine does not include the other.
+  """
+  process_item_ids = [process["_id"] for process in processes]
+  results_by_batch = defaultdict(lambda: ({}, {}))
+  async for result in db["process_results"].find(
+    {"process_item_id": {"$in": process_item_ids}, "batch_number": {"$gte": first_batch, "$lte": last_batch}},
+    {"batch_number": 1, "type": 1, "optimized": 1, "output_data_size": 1, "fingerprint": 1, "results": 1}
+  ):
+    optimized_results, non_optimized_results = results_by_batch[result["batch_number"]]
+    (optimized_results if result["optimized"] else non_optimized_results)[result["type"]] = result
+
+  for batch_number, (optimized_results, non_optimized_results) in sorted(results_by_batch.items()):
+    comparison = compare_batch_results(optimized_results, non_optimized_results)
+    await store_equivalence(processes, batch_number, comparison)
+
 async def start_process(process_id: str, repository_id: str, actions, iteration: int = 1, trigger_type: str = "user"):
     """
     Process data for a given collection and queries.
+    Processes with more than PROCESS_SHARD_BATCHES batches are split in batch range jobs that any worker can claim,
+    the last range to finish enqueues the job gathering the metrics and results.
+    Running it again for the same run (e.g. after the worker died) resumes from the checkpoints stored per batch.
     """
     # Fetch data from the database
     try:
       repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"current_data_size": 1})
       total_records = repository["current_data_size"]
       logging.info(f"Total records to process: {total_records} for repository {repository_id}")
-      total_batches = total_records // PROCESSES_RECORDS_BATCH_SIZE + (1 if total_records % PROCESSES_RECORDS_BATCH_SIZE > 0 else 0)
+      total_batches = get_total_batches(total_records)
       logging.info(f"Batch size: {PROCESSES_RECORDS_BATCH_SIZE}")
       logging.info(f"Total batches per process: {total_batches}")
-      processes = await db["processes"].find({"process_id": ObjectId(process_id), "repository": ObjectId(repository_id), "trigger_type": trigger_type, "iteration": iteration, "status": "in_progress"}).to_list(length=None)
-      optimized_processes = [process for process in processes if process["optimized"] is True]
-      non_optimized_processes = [process for process in processes if process["optimized"] is False]
-      total_num_processes = mp.cpu_count()
-      
-      for j in range(0, 2, 1):
-        for i in range(0, total_records, PROCESSES_RECORDS_BATCH_SIZE):
-          batch_number = (i // PROCESSES_RECORDS_BATCH_SIZE) + 1
-          batch = await db["records"].find({"repository": ObjectId(repository_id)}).sort("_id", 1).skip(i).limit(PROCESSES_RECORDS_BATCH_SIZE).to_list(length=None)
-          df = pd.DataFrame([{"_id": record["_id"], **record["data"]} for record in batch])
-          
-          if j == 0:
-            await process_data(df, optimized_processes, opt_utils, max(total_num_processes - 3, 1), actions, True, batch_number, trigger_type, iteration)
-          elif j == 1:
-            await process_data(df, non_optimized_processes, non_opt_utils, None, actions, False, batch_number, trigger_type, iteration),
-      
-      await start_metrics_results_gathering(process_id, processes, repository, actions, trigger_type, total_batches, total_num_processes)
+      processes = await get_run_processes(process_id, repository_id, iteration, trigger_type)
+
+      if total_batches <= PROCESS_SHARD_BATCHES:
+        await run_batch_range(processes, repository_id, actions, iteration, trigger_type, 1, total_batches)
+        await start_metrics_results_gathering(process_id, processes, repository, actions, trigger_type, total_batches, mp.cpu_count())
+        await enqueue_next_cron_iteration(process_id, repository_id, actions, iteration, trigger_type)
+        return
+
+      process_shard = await db["process_shards"].find_one(get_run_query(process_id, iteration, trigger_type))
+      if process_shard and process_shard.get("planned") is True:
+        logging.info(f"Batch range jobs of process_id {process_id} were already enqueued, skipping")
+        return
+      batch_ranges = await get_batch_ranges(repository_id, total_batches)
+      await db["process_shards"].update_one(
+        get_run_query(process_id, iteration, trigger_type),
+        {"$set": {"repository": ObjectId(repository_id), "total_ranges": len(batch_ranges), "planned": False, "updated_at": datetime.now()}, "$setOnInsert": {"completed_ranges": [], "failed_ranges": [], "created_at": datetime.now()}},
+        upsert=True
+      )
+      for batch_range in batch_ranges:
+        await enqueue_job("process_batch_range", {"process_id": process_id, "repository_id": repository_id, "actions": actions, "iteration": iteration, "trigger_type": trigger_type, **batch_range})
+      await db["process_shards"].update_one(get_run_query(process_id, iteration, trigger_type), {"$set": {"planned": True}})
+      logging.info(f"Process {process_id} split in {len(batch_ranges)} batch range jobs of up to {PROCESS_SHARD_BATCHES} batches")
     except Exception as e:
       logging.error(f"Error processing data for process_id {process_id}: {e}")
+      await fail_run_processes(process_id, repository_id, iteration, trigger_type, f"Error processing data: {e}")
+      # A failed cron iteration does not block the ones after it
+      await enqueue_next_cron_iteration(process_id, repository_id, actions, iteration, trigger_type)
       raise e
 
+async def fail_run_processes(process_id: str, repository_id: str, iteration: int, trigger_type: str, errors: str):
+    """
+    Mark the processes of a run that are still in progress as failed, so the run finishes without them.
+    """
+    await db["processes"].update_many(
+      {"process_id": ObjectId(process_id), "repository": ObjectId(repository_id), "trigger_type": trigger_type, "iteration": iteration, "status": "in_progress"},
+      {"$set": {"status": "failed", "errors": errors, "updated_at": datetime.now()}}
+    )
+
+async def finish_batch_range(process_id: str, repository_id: str, actions, iteration: int, trigger_type: str, first_batch: int, outcome: str):
+    """
+    Record a batch range as finished in the completed_ranges or failed_ranges of its shard. The ranges are added to
+    sets, so a range finished twice (e.g. re-queued after a lost lease) is counted once, and the range finishing the
+    run enqueues the metrics and results gathering.
+    """
+    process_shard = await db["process_shards"].find_one_and_update(
+      get_run_query(process_id, iteration, trigger_type),
+      {"$addToSet": {outcome: first_batch}, "$set": {"updated_at": datetime.now()}},
+      return_document=ReturnDocument.BEFORE
+    )
+    if process_shard is None:
+      return
+    finished_ranges = set(process_shard.get("completed_ranges", [])) | set(process_shard.get("failed_ranges", []))
+    if first_batch not in finished_ranges and len(finished_ranges) + 1 == process_shard["total_ranges"]:
+      await enqueue_job("gather_process_results", {"process_id": process_id, "repository_id": repository_id, "actions": actions, "iteration": iteration, "trigger_type": trigger_type})
+      logging.info(f"All batch ranges of process_id {process_id} finished, results gathering enqueued")
+
+async def process_batch_range(process_id: str, repository_id: str, actions, iteration: int, trigger_type: str, first_batch: int, last_batch: int, start_after_id: str = None):
+    """
+    Process a range of batches of a process. When all the ranges of the run are finished the metrics and
+    results gathering job is enqueued. A failed range is enqueued again, resuming from its checkpoints, up to
+    PROCESS_RANGE_MAX_ATTEMPTS times. After that it is recorded in the failed_ranges of the shard and the processes
+    of the run are marked as failed, so the run still finishes.
+    """
+    try:
+      logging.info(f"Processing batches {first_batch} to {last_batch} of process_id {process_id}")
+      processes = await get_run_processes(process_id, repository_id, iteration, trigger_type)
+      await run_batch_range(processes, repository_id, actions, iteration, trigger_type, first_batch, last_batch, start_after_id)
+    except Exception as e:
+      logging.error(f"Error processing batches {first_batch} to {last_batch} of process_id {process_id}: {e}")
+      process_shard = await db["process_shards"].find_one_and_update(
+        get_run_query(process_id, iteration, trigger_type),
+        {"$inc": {f"range_attempts.{first_batch}": 1}, "$set": {"updated_at": datetime.now()}},
+        return_document=ReturnDocument.AFTER
+      )
+      attempts = process_shard["range_attempts"][str(first_batch)] if process_shard else PROCESS_RANGE_MAX_ATTEMPTS
+      if attempts < PROCESS_RANGE_MAX_ATTEMPTS:
+        await enqueue_job("process_batch_range", {"process_id": process_id, "repository_id": repository_id, "actions": actions, "iteration": iteration, "trigger_type": trigger_type, "first_batch": first_batch, "last_batch": last_batch, "start_after_id": start_after_id})
+        logging.info(f"Batch range {first_batch} of process_id {process_id} enqueued again after {attempts} failed attempts")
+      else:
+        await fail_run_processes(process_id, repository_id, iteration, trigger_type, f"Batches {first_batch} to {last_batch} failed {attempts} times: {e}")
+        await finish_batch_range(process_id, repository_id, actions, iteration, trigger_type, first_batch, "failed_ranges")
+      raise e
+
+    await finish_batch_range(process_id, repository_id, actions, iteration, trigger_type, first_batch, "completed_ranges")
+
+async def gather_process_results(process_id: str, repository_id: str, actions, iteration: int = 1, trigger_type: str = "user"):
+    """
+    Gather the metrics and results of a process whose batch ranges were processed by several jobs.
+    """
+    try:
+      repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"current_data_size": 1})
+      processes = await get_run_processes(process_id, repository_id, iteration, trigger_type)
+      await start_metrics_results_gathering(process_id, processes, repository, actions, trigger_type, get_total_batches(repository["current_data_size"]), mp.cpu_count())
+      await db["process_shards"].delete_one(get_run_query(process_id, iteration, trigger_type))
+      await enqueue_next_cron_iteration(process_id, repository_id, actions, iteration, trigger_type)
+    except Exception as e:
+      logging.error(f"Error gathering results for process_id {process_id}: {e}")
+      await fail_run_processes(process_id, repository_id, iteration, trigger_type, f"Error gathering results: {e}")
+      await enqueue_next_cron_iteration(process_id, repository_id, actions, iteration, trigger_type)
+      raise e
+
+async def enqueue_next_cron_iteration(process_id: str, repository_id: str, actions, iteration: int, trigger_type: str):
+    """
+    Enqueue the start_process job of the cron iteration after the given one, once the given one finished.
+    Iterations are measured one after another so they do not compete for the CPU. The next iteration is marked as
+    enqueued atomically, so a run finished twice (e.g. after a lost lease) enqueues it once.
+    """
+    if trigger_type != "system":
+      return
+    result = await db["processes"].update_many(
+      {"process_id": ObjectId(process_id), "repository": ObjectId(repository_id), "trigger_type": "system", "iteration": iteration + 1, "cron_enqueued": False},
+      {"$set": {"cron_enqueued": True, "updated_at": datetime.now()}}
+    )
+    if result.modified_count > 0:
+      await enqueue_job("start_process", {"process_id": str(process_id), "repository_id": str(repository_id), "actions": actions, "iteration": iteration + 1, "trigger_type": "system"})
+      logging.info(f"Enqueued cron iteration {iteration + 1} of process_id {process_id}")
+
 async def prepare_cron_initiated_processes():
     """
-    Process data for a given collection and queries.
+    Create the system initiated iterations of the user processes of every repository with data ready.
+    Existing cron runs of all repositories are resolved with one aggregation. Only the first iteration of every
+    process is enqueued, each iteration enqueues the next one when it finishes, so the iterations of a process run
+    one after another while different processes still run concurrently within the CPU budget.
     """
     try:
       logging.info("Starting cron initiated process.")
-      # existing_executing_processes = await db["processes"].find({"status": "in_progress"}, {"results": 0, "metrics": 0, "errors": 0}).to_list(length=None)
-        
-      # if len(existing_executing_processes) > 0:
-      #     logging.info(f"There are executing processes. The system will try again at the next cron interval.")
-      #     return
-      repositories = await db["repositories"].find({"data_ready": True}).to_list(length=None)
+      repositories = await db["repositories"].find({"data_ready": True}, {"_id": 1, "version": 1}).to_list(length=None)
       if len(repositories) == 0:
         logging.info("No repositories found with data ready. Skipping cron initiated process.")
         return
-      
-      for repository in repositories:
-        processes = await db["processes"].find({"repository": repository["_id"], "iteration": 1, "repository_version": repository["version"], "trigger_type": "user"}, {"metrics": 0}).to_list(length=None)
-        
-        if len(processes) == 0:
-          logging.info(f"Repository {repository['_id']} has no user initiated processes. Skipping.")
+
+      repository_ids = [repository["_id"] for repository in repositories]
+      processes = await db["processes"].find(
+        {"$or": [{"repository": repository["_id"], "repository_version": repository["version"]} for repository in repositories], "iteration": 1, "trigger_type": "user"},
+        {"metrics": 0}
+      ).to_list(length=None)
+      existing_cron_runs = await db["processes"].aggregate([
+        {"$match": {"repository": {"$in": repository_ids}, "trigger_type": "system"}},
+        {"$group": {"_id": {"repository": "$repository", "process_id": "$process_id"}}}
+      ]).to_list(length=None)
+      existing_cron_keys = {(run["_id"]["repository"], run["_id"]["process_id"]) for run in existing_cron_runs}
+
+      grouped_processes = defaultdict(list)
+      for user_initiated_process in processes:
+        grouped_processes[(user_initiated_process["repository"], user_initiated_process["process_id"])].append(user_initiated_process)
+
+      repository_versions = {repository["_id"]: repository["version"] for repository in repositories}
+      cron_processes = []
+      cron_jobs = []
+      for (repository_id, process_id), process_group in grouped_processes.items():
+        if (repository_id, process_id) in existing_cron_keys:
+          logging.info(f"Process {process_id} already has cron initiated processes for repository {repository_id}. Skipping.")
           continue
-        
-        grouped_processes = defaultdict(list)
-        for user_initiated_process in processes:
-            grouped_processes[user_initiated_process["process_id"]].append(user_initiated_process)
-        
-        valid_process_ids = []
-        for process_id, process_group in grouped_processes.items():
-          existing_cron_processes = await db["processes"].find({"repository": repository["_id"], "process_id": process_id, "trigger_type": "system"}).to_list(length=None)
-          if len(existing_cron_processes) == 0:
-            valid_process_ids.append(str(process_id))
-        
-        for i in range(10):
-          logging.info(f"Iteration {i + 1} for repository {repository['_id']}")
-          for process_id, process_group in grouped_processes.items():
-            if str(process_id) not in valid_process_ids:
-              logging.info(f"Process {process_id} already has cron initiated processes for repository {repository['_id']}. Skipping.")
-              continue
-            cron_processes = []
-            all_actions = []
-            for process in process_group:
-              if all_actions == []:
-                all_actions = process["actions"]
-              cron_processes.append({
-                "parameters": process["parameters"],
-                "actions": process["actions"],
-                "task_process": process["task_process"],
-                "status": "in_progress",
-                "repository": repository["_id"],
-                "process_id": process_id,
-                "trigger_type": "system",
-                "created_at": datetime.now(),
-                "updated_at": datetime.now(),
-                "optimized": process["optimized"],
-                "iteration": i + 1,
-                "validated": False
-              })
-            await db["processes"].insert_many(cron_processes)
-            logging.info(f"Inserted {len(cron_processes)} cron processes for repository {repository['_id']} and process_id {process_id} at iteration {i + 1}. Starting processing.")
-            try:
-              await start_process(str(process_id), str(repository["_id"]), all_actions, i + 1, "system")
-              logging.info(f"Started cron initiated process for repository {repository['_id']} and process_id {process_id} at iteration {i + 1}.")
-            except Exception as e:
-              logging.error(f"Error in cron initiated process: {e} for repository {repository['_id']} and process_id {process_id} at iteration {i + 1}")
-              continue
-      logging.info("Cron initiated processes completed successfully.")      
+        all_actions = process_group[0]["actions"]
+        for i in range(CRON_ITERATIONS):
+          for process in process_group:
+            cron_processes.append({
+              "parameters": process["parameters"],
+              "actions": process["actions"],
+              "task_process": process["task_process"],
+              "status": "in_progress",
+              "repository": repository_id,
+              "repository_version": repository_versions[repository_id],
+              "process_id": process_id,
+              "trigger_type": "system",
+              "created_at": datetime.now(),
+              "updated_at": datetime.now(),
+              "optimized": process["optimized"],
+              "iteration": i + 1,
+              "cron_enqueued": i == 0,
+              "validated": False
+            })
+        cron_jobs.append({"type": "start_process", "data": {"process_id": str(process_id), "repository_id": str(repository_id), "actions": all_actions, "iteration": 1, "trigger_type": "system"}})
+
+      if len(cron_jobs) == 0:
+        logging.info("No user initiated processes without cron initiated processes. Skipping cron initiated process.")
+        return
+
+      await db["processes"].insert_many(cron_processes)
+      await enqueue_jobs(cron_jobs)
+      logging.info(f"Inserted {len(cron_processes)} cron processes and enqueued the first cron iteration of {len(cron_jobs)} processes of {len(repositories)} repositories.")
     except Exception as e:
       logging.error(f"Error in cron initiated process: {e}")
       return
@@ -384,6 +734,7 @@ async def reset_processes(repository_id: str):
       logging.info(f"Deleting process results for repository {repository_id}")
       await delete_collection_in_batches(db["process_results"], processes_results_query)
       logging.info(f"Deleted process results for repository {repository_id}")
+      await db["process_shards"].delete_many(processes_query)
       
       logging.info(f"Processes for repository {repository_id} reset successfully.")
     except Exception as e:
@@ -0,0 +1,66 @@
+from app.database import db
+from app.utils.records_layout_utils import get_records_collection_name, is_bucketed
+from app.utils.buckets_utils import get_bucket_record
+from app.utils.responses_utils import dumps
+from typing import AsyncIterator, List
+from dotenv import load_dotenv
+from io import StringIO
+import asyncio
+import csv
+import os
+
+load_dotenv()
+RECORDS_EXPORT_BATCH_SIZE = int(os.getenv("RECORDS_EXPORT_BATCH_SIZE", "1000"))
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+async def iter_records_batches(repository: dict) -> AsyncIterator[List[dict]]:
+    """
+    Iterate the records of a repository in _id order, RECORDS_EXPORT_BATCH_SIZE at a time. The cursor only fetches
+    the next batch when the previous one was consumed.
+    """
+    records_collection = db[get_records_collection_name(repository)]
+    query = {"repository": repository["_id"]}
+    batch = []
+    if is_bucketed(repository):
+        async for bucket in records_collection.find(query).sort("_id", 1).batch_size(1):
+            for index in range(bucket["count"]):
+                batch.append(get_bucket_record(bucket, index))
+            if len(batch) >= RECORDS_EXPORT_BATCH_SIZE:
+                yield batch
+                batch = []
+    else:
+        async for record in records_collection.find(query).sort("_id", 1).batch_size(RECORDS_EXPORT_BATCH_SIZE):
+            batch.append(record)
+            if len(batch) == RECORDS_EXPORT_BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def records_to_ndjson(records: List[dict]) -> bytes:
+    return b"".join(dumps(record) + b"\n" for record in records)
+
+def records_to_csv(records: List[dict], columns: List[str], header: bool) -> bytes:
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(["_id", *columns])
+    for record in records:
+        writer.writerow([str(record["_id"]), *[record["data"].get(column) for column in columns]])
+    return buffer.getvalue().encode("utf-8")
+
+async def export_records(repository: dict, export_format: str) -> AsyncIterator[bytes]:
+    """
+    Stream the records of a repository as NDJSON or CSV. Each batch is serialized in a thread and only read from the
+    database once the client received the previous one, so memory stays bounded by one batch.
+    """
+    columns = [parameter["name"] for parameter in repository.get("parameters") or []]
+    header = True
+    async for records in iter_records_batches(repository):
+        if export_format == "csv":
+            yield await asyncio.to_thread(records_to_csv, records, columns, header)
+            header = False
+        else:
+            yield await asyncio.to_thread(records_to_ndjson, records)
+    if export_format == "csv" and header:
+        yield await asyncio.to_thread(records_to_csv, [], columns, header)
@@ -0,0 +1,67 @@
+from app.database import db
+from bson.objectid import ObjectId
+from typing import Any
+from dotenv import load_dotenv
+import logging
+import os
+
+load_dotenv()
+RECORDS_PARTITIONED = bool(os.getenv("RECORDS_PARTITIONED", "false").lower() == "true")
+RECORDS_BUCKETED = bool(os.getenv("RECORDS_BUCKETED", "false").lower() == "true")
+RECORDS_BUCKET_SIZE = int(os.getenv("RECORDS_BUCKET_SIZE", "1000"))
+SHARED_LAYOUT = "shared"
+PARTITIONED_LAYOUT = "partitioned"
+BUCKETED_LAYOUT = "bucketed"
+
+def get_partition_name(repository_id: Any) -> str:
+    return f"records_{repository_id}"
+
+def get_import_layout() -> str:
+    """
+    Layout of the records of a repository imported now.
+    """
+    if RECORDS_BUCKETED:
+        return BUCKETED_LAYOUT
+    return PARTITIONED_LAYOUT if RECORDS_PARTITIONED else SHARED_LAYOUT
+
+def get_records_collection_name(repository: dict) -> str:
+    """
+    Name of the collection holding the records of a repository: its own partition, the buckets collection or the
+    shared records collection.
+    """
+    if repository.get("records_layout") == PARTITIONED_LAYOUT:
+        return get_partition_name(repository["_id"])
+    if repository.get("records_layout") == BUCKETED_LAYOUT:
+        return "record_buckets"
+    return "records"
+
+def is_bucketed(repository: dict) -> bool:
+    return repository.get("records_layout") == BUCKETED_LAYOUT
+
+async def get_layout_repository(repository_id: Any) -> dict:
+    """
+    Get the id and records layout of a repository.
+    """
+    repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"records_layout": 1})
+    return repository or {"_id": ObjectId(repository_id)}
+
+async def get_records_collection(repository_id: Any) -> Any:
+    """
+    Get the collection of the records of a repository by its id.
+    """
+    return db[get_records_collection_name(await get_layout_repository(repository_id))]
+
+async def create_partition(repository_id: Any):
+    """
+    Create the partition of a repository with the indexes the records queries use.
+    """
+    collection = db[get_partition_name(repository_id)]
+    await collection.create_index([("repository", 1), ("_id", 1)])
+    await collection.create_index("version")
+
+async def drop_partition(repository_id: Any):
+    """
+    Drop the partition of a repository, a metadata operation whatever the number of records. Missing partitions are ignored.
+    """
+    await db[get_partition_name(repository_id)].drop()
+    logging.info(f"Dropped records partition of repository {repository_id}")
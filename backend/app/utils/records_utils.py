@@ -5,18 +5,37 @@ from typing import Any, List
 from dotenv import load_dotenv
 from io import BytesIO
 from app.models.repository import Repository
+from app.utils.bson_utils import encode_records, new_record_ids_prefix, record_object_id
+from app.utils.file_formats_utils import get_file_format, read_chunks_from_file
+from app.utils.external_sort_utils import sort_chunks
+from app.utils.records_layout_utils import PARTITIONED_LAYOUT, BUCKETED_LAYOUT, RECORDS_BUCKET_SIZE, get_import_layout, get_layout_repository, get_records_collection_name, is_bucketed, create_partition, drop_partition
+from app.utils.buckets_utils import build_buckets, bulk_write_bucket_records
+from app.utils.zone_maps_utils import ZONE_MAPS_ENABLED, compute_zone_map, store_zone_map
 from pathlib import Path
+from bson.binary import Binary
 from bson.objectid import ObjectId
-from pymongo import UpdateOne
+from pymongo import InsertOne, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 import mimetypes
+import asyncio
+import time
+import numpy as np
 import pandas as pd
 import logging
 import os
-import chardet
 
 load_dotenv()
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
 RECORDS_BATCH_SIZE = int(os.getenv("RECORDS_BATCH_SIZE", "5000"))  # Default to 5000 records per batch
+INGEST_MAX_INFLIGHT_INSERTS = int(os.getenv("INGEST_MAX_INFLIGHT_INSERTS", "4"))
+INGEST_QUEUE_CHUNKS = int(os.getenv("INGEST_QUEUE_CHUNKS", "4"))
+INGEST_PRE_ENCODED_BSON = bool(os.getenv("INGEST_PRE_ENCODED_BSON", "true").lower() == "true")
+INGEST_INFERENCE_SAMPLE_ROWS = int(os.getenv("INGEST_INFERENCE_SAMPLE_ROWS", "5000"))
+INGEST_NUMERIC_RATIO = float(os.getenv("INGEST_NUMERIC_RATIO", "0.99"))
+INGEST_CATEGORY_RATIO = float(os.getenv("INGEST_CATEGORY_RATIO", "0.05"))
+TYPE_CHANGE_CHUNK_SIZE = int(os.getenv("TYPE_CHANGE_CHUNK_SIZE", "50000"))
+RECORDS_BULK_MAX_OPERATIONS = int(os.getenv("RECORDS_BULK_MAX_OPERATIONS", "10000"))
+CONVERT_TYPES = {"number": "double", "string": "string"}
 
 
 def validate_permissions_and_repository(current_user: dict, repository: Any, record: dict):
@@ -50,6 +69,43 @@ def validate_permissions_and_repository(current_user: dict, repository: Any, rec
             if key not in parameter_names:
                 raise HTTPException(status_code=400, detail=f"Invalid field '{key}' in record. Allowed fields are: {', '.join(parameter_names)}") 
 
+def validate_records_frame(repository: Any, records: List[dict]) -> List[dict]:
+    """
+    Validate many records against the repository parameters at once, one column check per parameter instead of one
+    check per field. Returns the errors with the index of the record they belong to.
+    """
+    if len(records) == 0:
+        return []
+    parameter_names = [param["name"] for param in repository["parameters"]]
+    errors = []
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            errors.append({"index": index, "field": None, "error": "Record must be an object"})
+    if errors:
+        return errors
+    df = pd.DataFrame.from_records(records)
+    for key in df.columns:
+        if key not in parameter_names:
+            for index in np.flatnonzero(df[key].notna().to_numpy()):
+                errors.append({"index": int(index), "field": key, "error": f"Invalid field '{key}'. Allowed fields are: {', '.join(parameter_names)}"})
+    for param in repository["parameters"]:
+        if param["name"] not in df.columns:
+            errors.extend({"index": index, "field": param["name"], "error": f"Field '{param['name']}' is required"} for index in range(len(df)))
+            continue
+        column = df[param["name"]]
+        types = column.map(type)
+        missing = column.isna() | (types == str) & (column == "")
+        if param["type"] == "number":
+            invalid = ~missing & ~types.isin([int, float])
+        elif param["type"] == "string":
+            invalid = ~missing & (types != str)
+        else:
+            invalid = pd.Series(False, index=column.index)
+        errors.extend({"index": int(index), "field": param["name"], "error": f"Field '{param['name']}' is required"} for index in np.flatnonzero(missing.to_numpy()))
+        errors.extend({"index": int(index), "field": param["name"], "error": f"Field '{param['name']}' must be a {param['type']}"} for index in np.flatnonzero(invalid.to_numpy()))
+
+    return sorted(errors, key=lambda error: error["index"])
+
 async def update_repository_info(repository: Any, type: str):
     records_count = 0
     
@@ -66,6 +122,76 @@ async def update_repository_info(repository: Any, type: str):
     
     await db["repositories"].update_one({"_id": repository["_id"]}, {"$set": repository_data})
 
+async def invalidate_zone_maps(repository_id: Any):
+    """
+    Stop using the zone maps of the last import, before records are written.
+    """
+    await db["repositories"].update_one({"_id": ObjectId(repository_id), "zone_maps_import_id": {"$ne": None}}, {"$unset": {"zone_maps_import_id": ""}})
+
+async def get_record_ids_prefix(repository_id: Any, renew: bool = False) -> bytes:
+    """
+    Get the prefix the record ids of a repository are made with, setting a new one when it has none yet or renew is
+    set (an import replacing the records starts the ordinals again).
+    """
+    repository_query = {"_id": ObjectId(repository_id)} if renew else {"_id": ObjectId(repository_id), "record_ids_prefix": None}
+    await db["repositories"].update_one(repository_query, {"$set": {"record_ids_prefix": Binary(new_record_ids_prefix(datetime.now()))}})
+    repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"record_ids_prefix": 1})
+    return bytes(repository["record_ids_prefix"])
+
+async def apply_records_bulk(repository: Any, creates: List[dict], updates: List[dict], deletes: List[Any]) -> dict:
+    """
+    Apply many record creates, updates and deletes with one unordered bulk_write, and bump the repository version and
+    current_data_size once for the writes that were applied. Records must be validated before.
+    """
+    repository_id = ObjectId(repository["_id"])
+    records_collection = db[get_records_collection_name(repository)]
+    version = repository["version"] + 1
+    now = datetime.now()
+    first_ordinal = 0
+    if creates:
+        ordinal_counter = await db["repositories"].find_one_and_update({"_id": repository_id}, {"$inc": {"next_ordinal": len(creates)}}, {"next_ordinal": 1}, return_document=ReturnDocument.BEFORE)
+        first_ordinal = ordinal_counter.get("next_ordinal", 0)
+    await invalidate_zone_maps(repository_id)
+    created_ids = []
+    if creates:
+        ids_prefix = await get_record_ids_prefix(repository_id)
+        created_ids = [record_object_id(ids_prefix, first_ordinal + index) for index in range(len(creates))]
+    error = None
+    if is_bucketed(repository):
+        # Rows are grouped per bucket, one revision checked replacement per bucket
+        result = await bulk_write_bucket_records(records_collection, repository_id, [(created_ids[index], first_ordinal + index, record) for index, record in enumerate(creates)], updates, deletes, now, version, RECORDS_BUCKET_SIZE)
+        created_ids, updated, deleted, error = result["created_ids"], result["updated"], result["deleted"], result["error"]
+    else:
+        operations = [
+            InsertOne({"_id": created_ids[index], "data": record, "ordinal": first_ordinal + index, "created_at": now, "repository": repository_id, "updated_at": now, "version": version})
+            for index, record in enumerate(creates)
+        ]
+        operations.extend(UpdateOne({"_id": ObjectId(update["_id"]), "repository": repository_id}, {"$set": {"data": update["data"], "updated_at": now, "version": version}}) for update in updates)
+        operations.extend(DeleteOne({"_id": ObjectId(record_id), "repository": repository_id}) for record_id in deletes)
+        updated = 0
+        deleted = 0
+        if operations:
+            try:
+                result = await records_collection.bulk_write(operations, ordered=False)
+                updated, deleted = result.modified_count, result.deleted_count
+            except BulkWriteError as e:
+                # Unordered writes keep going after an error, so only the applied ones count
+                failed_inserts = {created_ids[write_error["index"]] for write_error in e.details["writeErrors"] if write_error["index"] < len(creates)}
+                created_ids = [record_id for record_id in created_ids if record_id not in failed_inserts][:e.details["nInserted"]]
+                updated, deleted = e.details["nModified"], e.details["nRemoved"]
+                error = f"{len(e.details['writeErrors'])} operations failed: {e.details['writeErrors'][0].get('errmsg')}"
+
+    if len(created_ids) + updated + deleted > 0:
+        await db["repositories"].update_one(
+            {"_id": repository_id},
+            {"$set": {"version": version, "data_updated_at": now, "updated_at": now}, "$inc": {"current_data_size": len(created_ids) - deleted}}
+        )
+    else:
+        version = repository["version"]
+    logging.info(f"Bulk mutation of repository {repository_id}: {len(created_ids)} created, {updated} updated, {deleted} deleted")
+
+    return {"created": len(created_ids), "updated": updated, "deleted": deleted, "created_ids": created_ids, "version": version, "error": error}
+
 async def delete_collection_in_batches(collection, filter_query, batch_size=10000):
     while True:
         # Find a batch of _ids to delete
@@ -84,14 +210,107 @@ async def delete_repository_related_data(repository_id: str):
     try:
         logging.info(f"Deleting all records and processes for repository {repository_id}")
         filter_query = {"repository": ObjectId(repository_id)}
+        # Partitioned records go with their collection, records in the shared collection are deleted in batches
+        await drop_partition(repository_id)
         await delete_collection_in_batches(db["records"], filter_query)
+        await delete_collection_in_batches(db["record_buckets"], filter_query)
         await delete_collection_in_batches(db["processes"], filter_query)
+        await db["process_shards"].delete_many(filter_query)
+        await db["zone_maps"].delete_many(filter_query)
         
         logging.info(f"Deleted all records and processes for repository {repository_id}")
     except Exception as e:
         logging.error(f"Error deleting records and processes for repository {repository_id}: {e}")
         raise ValueError(f"Error deleting records and processes for repository {repository_id}: {e}")
 
+def infer_column_stats(column: pd.Series) -> dict:
+    """
+    Vectorized stats of a sample column: null ratio, ratio of values that coerce to numbers and a cardinality estimate.
+    """
+    total = len(column)
+    non_null = column.dropna()
+    numeric = pd.to_numeric(non_null, errors="coerce")
+    numeric_values = numeric.dropna()
+    distinct = int(non_null.nunique())
+    stats = {
+        "sample_size": total,
+        "null_ratio": float(1 - len(non_null) / total) if total > 0 else 0.0,
+        "numeric_ratio": float(len(numeric_values) / len(non_null)) if len(non_null) > 0 else 0.0,
+        "distinct_count": distinct,
+        "distinct_ratio": float(distinct / len(non_null)) if len(non_null) > 0 else 0.0,
+    }
+    if len(numeric_values) > 0:
+        stats["min"] = float(numeric_values.min())
+        stats["max"] = float(numeric_values.max())
+        stats["integer"] = bool((numeric_values % 1 == 0).all())
+
+    return stats
+
+def infer_parameters(chunk: pd.DataFrame) -> List[dict]:
+    """
+    Infer the parameter types from a sample of INGEST_INFERENCE_SAMPLE_ROWS rows of the first chunk.
+    A column is a number when at least INGEST_NUMERIC_RATIO of its non null values coerce to numbers, and its stats
+    are stored with the parameter together with the dtype the engines can load it with.
+    """
+    sample = chunk.head(INGEST_INFERENCE_SAMPLE_ROWS)
+    if sample.empty:
+        logging.error("The CSV file is empty or contains no valid records.")
+        raise ValueError("The CSV file is empty or contains no valid records.")
+    parameters = []
+    for col in sample.columns:
+        stats = infer_column_stats(sample[col])
+        is_number = stats["numeric_ratio"] >= INGEST_NUMERIC_RATIO and stats["null_ratio"] < 1
+        if is_number:
+            stats["dtype"] = "int64" if stats.get("integer") and stats["null_ratio"] == 0 else "float64"
+        else:
+            stats["dtype"] = "category" if stats["distinct_ratio"] <= INGEST_CATEGORY_RATIO else "string"
+        parameters.append({"name": col, "type": "number" if is_number else "string", "stats": stats})
+
+    return parameters
+
+def build_records(chunk: pd.DataFrame, repository_id: Any, first_ordinal: int, now: datetime, ids_prefix: bytes) -> List[dict]:
+    """
+    Build the record documents of a CSV chunk. The _id is made from the ordinal so records are ordered as in the file.
+    """
+    chunk = chunk.where(pd.notnull(chunk), None)
+    repository_id = ObjectId(repository_id)
+
+    return [
+        {
+            "_id": record_object_id(ids_prefix, first_ordinal + index),
+            "repository": repository_id,
+            "data": record,
+            "ordinal": first_ordinal + index,
+            "created_at": now,
+            "updated_at": now,
+            "version": 0
+        }
+        for index, record in enumerate(chunk.to_dict(orient="records"))
+    ]
+
+async def read_chunks(reader: Any, chunks: asyncio.Queue):
+    """
+    Parse the CSV chunks in a worker thread and hand them to the importer. None marks the end of the file.
+    """
+    try:
+        while True:
+            chunk = await asyncio.to_thread(next, reader, None)
+            if chunk is None:
+                break
+            await chunks.put(chunk)
+    finally:
+        await chunks.put(None)
+
+async def insert_records(collection: Any, records: List[dict], rows: int, semaphore: asyncio.Semaphore, zone_map: dict = None) -> int:
+    try:
+        if len(records) > 0:
+            await collection.insert_many(records, ordered=False)
+        if zone_map is not None:
+            await store_zone_map(zone_map)
+        return rows
+    finally:
+        semaphore.release()
+
 async def store_repository_records(repository: Repository, delete_existing_records: bool = False):
     try:
         # Delete existing records if needed
@@ -125,81 +344,100 @@ async def store_repository_records(repository: Repository, delete_existing_recor
         now = datetime.now()
         batch_size = RECORDS_BATCH_SIZE
         total_inserted = 0
+        # Dense row ordinals identify the records in the filter results bitmaps
+        first_ordinal = 0 if delete_existing_records else repository.get("next_ordinal", 0)
+        # Record ids are made from the ordinals, so batches and zones in _id order follow the file
+        ids_prefix = await get_record_ids_prefix(repository["_id"], renew=delete_existing_records)
         parameters = []
         column_names = []
-        found_complete_row = None
+
+        file_format = get_file_format(repository.get("file_path") or "data.csv")
+        if file_format is None:
+            logging.error(f"Unsupported file format for {repository.get('file_path')}.")
+            raise ValueError(f"Unsupported file format for {repository.get('file_path')}.")
 
         # Read in chunks
         logging.info(f"Processing file: {UPLOAD_DIR}/{repository['file_path']}")
-        logging.info(f"Reading CSV file in chunks of {batch_size} rows")
-        
-        def detect_encoding(file_path, sample_size=10000):
-            with open(file_path, 'rb') as f:
-                rawdata = f.read(sample_size)
-            result = chardet.detect(rawdata)
-            encoding = result['encoding'] or 'utf-8'
-            # Fallback: treat ascii as utf-8
-            if encoding.lower() == 'ascii':
-                encoding = 'utf-8'
-            return encoding
-        
-        encoding = detect_encoding(file_path)
-        logging.info(f"Detected encoding: {encoding}")
-        
-        for i, chunk in enumerate(pd.read_csv(file_stream, chunksize=batch_size, encoding=encoding, on_bad_lines="warn")):
-            chunk = chunk.where(pd.notnull(chunk), None)
-            if i == 0:
-                # Infer columns and types from the first non-empty chunk
-                column_names = list(chunk.columns)
-                # Find a row with no nulls to infer types
-                for _, row in chunk.iterrows():
-                    if row.notnull().all():
-                        found_complete_row = row
-                        break
-                if found_complete_row is None and not chunk.empty:
-                    found_complete_row = chunk.loc[chunk.isnull().sum(axis=1).idxmin()]
-                if found_complete_row is None:
-                    logging.error("The CSV file is empty or contains no valid records.")
-                    raise ValueError("The CSV file is empty or contains no valid records.")
-                # Infer parameter types
-                parameters = []
-                for col in column_names:
-                    value = found_complete_row[col]
-                    if isinstance(value, (int, float)):
-                        column_type = "number"
-                    elif isinstance(value, str):
-                        column_type = "string"
-                    else:
-                        column_type = "string"
-                    parameters.append({"name": col, "type": column_type})
-
-            records_data = chunk.to_dict(orient="records")
-            records = [
-                {
-                    "repository": ObjectId(repository['_id']),
-                    "data": record,
-                    "created_at": now,
-                    "updated_at": now,
-                    "version": 0
-                }
-                for record in records_data
-            ]
-            if records:
-                await db["records"].insert_many(records)
-                total_inserted += len(records)
+        logging.info(f"Reading {file_format['format']} file ({file_format['compression'] or 'uncompressed'}) in chunks of {batch_size} rows")
+        reader = await asyncio.to_thread(read_chunks_from_file, file_stream, file_format, batch_size)
+        if repository.get("cluster_key"):
+            # Records are inserted in cluster key order so ranges of the key are contiguous batches
+            logging.info(f"Clustering records of repository {repository['_id']} by {repository['cluster_key']}")
+            reader = sort_chunks(reader, repository["cluster_key"], batch_size)
+        chunks = asyncio.Queue(maxsize=INGEST_QUEUE_CHUNKS)
+        reader_task = asyncio.create_task(read_chunks(reader, chunks))
+        insert_semaphore = asyncio.Semaphore(INGEST_MAX_INFLIGHT_INSERTS)
+        insert_tasks = set()
+        rows_read = 0
+        # Zone maps are only used while the repository keeps the zone_maps_import_id set once the import completes
+        import_id = ObjectId()
+        records_layout = get_import_layout()
+        if records_layout == PARTITIONED_LAYOUT:
+            await create_partition(repository["_id"])
+        await db["repositories"].update_one({"_id": ObjectId(repository["_id"])}, {"$set": {"records_layout": records_layout}, "$unset": {"zone_maps_import_id": ""}})
+        records_collection = db[get_records_collection_name({"_id": repository["_id"], "records_layout": records_layout})]
+        start_time = time.perf_counter()
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                if len(parameters) == 0:
+                    column_names = list(chunk.columns)
+                    parameters = await asyncio.to_thread(infer_parameters, chunk)
+
+                # Records are built one chunk after another so their _id and ordinal follow the file order
+                if records_layout == BUCKETED_LAYOUT:
+                    records = await asyncio.to_thread(build_buckets, chunk, repository["_id"], first_ordinal + rows_read, now, RECORDS_BUCKET_SIZE, ids_prefix)
+                else:
+                    records = await asyncio.to_thread(encode_records if INGEST_PRE_ENCODED_BSON else build_records, chunk, repository["_id"], first_ordinal + rows_read, now, ids_prefix)
+                zone_map = None
+                # Zone maps locate batches by record counts in _id order, which buckets do not follow
+                if ZONE_MAPS_ENABLED and records_layout != BUCKETED_LAYOUT and len(records) > 0:
+                    zone_map = await asyncio.to_thread(compute_zone_map, chunk, repository["_id"], import_id, records[0]["_id"], records[-1]["_id"], first_ordinal + rows_read)
+                rows_read += len(chunk)
+                await insert_semaphore.acquire()
+                insert_tasks.add(asyncio.create_task(insert_records(records_collection, records, len(chunk), insert_semaphore, zone_map)))
+                for task in [task for task in insert_tasks if task.done()]:
+                    insert_tasks.remove(task)
+                    total_inserted += task.result()
+                elapsed_time = time.perf_counter() - start_time
+                logging.info(f"Read {rows_read} rows and inserted {total_inserted} records for repository {repository['_id']} ({rows_read / elapsed_time if elapsed_time > 0 else 0:.0f} rows/s)")
+
+            total_inserted += sum(await asyncio.gather(*insert_tasks))
+            insert_tasks.clear()
+            await reader_task
+        finally:
+            reader_task.cancel()
+            for task in insert_tasks:
+                task.cancel()
+
+        if len(parameters) == 0:
+            logging.error("The CSV file is empty or contains no valid records.")
+            raise ValueError("The CSV file is empty or contains no valid records.")
+        elapsed_time = time.perf_counter() - start_time
+        logging.info(f"Imported {total_inserted} records for repository {repository['_id']} in {elapsed_time:.2f}s ({total_inserted / elapsed_time if elapsed_time > 0 else 0:.0f} rows/s)")
         
-        # Update repository info
+        # Update repository info, record writes move data_updated_at past imported_at
+        imported_at = datetime.now()
         repository_data = {
             "data_ready": True,
             "valid": True,
             "file_size": file_size,
-            "type": "text/csv",
+            "type": file_format["type"],
+            "compression": file_format["compression"],
+            "file_sha256": repository.get("file_sha256"),
             "original_data_size": total_inserted,
             "current_data_size": total_inserted,
-            "data_updated_at": datetime.now(),
+            "data_updated_at": imported_at,
+            "imported_at": imported_at,
             "parameters": parameters,
+            "next_ordinal": first_ordinal + rows_read,
+            "cluster_key": repository.get("cluster_key") or None,
+            "zone_maps_import_id": import_id,
         }
         await db["repositories"].update_one({"_id": ObjectId(repository['_id'])}, {"$set": repository_data})
+        await db["zone_maps"].delete_many({"repository": ObjectId(repository["_id"]), "import_id": {"$ne": import_id}})
         logging.info(f"Inserted total {total_inserted} records for repository {repository['_id']}")
 
         # Optionally delete the file after processing
@@ -215,6 +453,34 @@ async def store_repository_records(repository: Repository, delete_existing_recor
         logging.error(f"Error storing records for repository {repository['_id']}: {e}", exc_info=True)
         raise ValueError(f"Error storing records for repository {repository['_id']}: {e}")
 
+def get_convert_pipeline(parameters: List[dict], bucketed: bool = False) -> List[dict]:
+    """
+    Update pipeline converting the data of the changed parameters in MongoDB. Values that do not convert are set to
+    null. Parameter names are passed as literals so names with dots or $ are not read as paths. Buckets convert every
+    value of their column arrays.
+    """
+    field_name = "columns" if bucketed else "data"
+    data = f"${field_name}"
+    for parameter in parameters:
+        field = {"$literal": parameter["name"]}
+        current = {"$getField": {"field": field, "input": f"${field_name}"}}
+        if bucketed:
+            value = {"$map": {"input": current, "as": "value", "in": {"$convert": {"input": "$$value", "to": CONVERT_TYPES[parameter["type"]], "onError": None, "onNull": None}}}}
+        else:
+            value = {"$convert": {"input": current, "to": CONVERT_TYPES[parameter["type"]], "onError": None, "onNull": None}}
+        data = {"$setField": {"field": field, "input": data, "value": value}}
+    return [{"$set": {field_name: data, "updated_at": "$$NOW", "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}}}]
+
+async def get_range_last_id(collection: Any, repository_id: ObjectId, last_id: Any, size: int) -> Any:
+    """
+    Get the _id closing the next range of size records after last_id, or None when fewer records are left.
+    """
+    query = {"repository": repository_id}
+    if last_id is not None:
+        query["_id"] = {"$gt": last_id}
+    record = await collection.find(query, {"_id": 1}).sort("_id", 1).skip(size - 1).limit(1).to_list(length=1)
+    return record[0]["_id"] if record else None
+
 async def change_parameters_type(repository_id: str, changed_parameters: List[str]):
     repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"parameters": 1, "current_data_size": 1, "data_ready": 1, "version": 1})
     
@@ -226,39 +492,62 @@ async def change_parameters_type(repository_id: str, changed_parameters: List[st
         logging.error(f"Repository with ID {repository_id} has no parameters.")
         raise HTTPException(status_code=400, detail="Repository has no parameters")
     
+    parameters = []
+    for parameter in changed_parameters:
+        repository_parameter = next((param for param in repository["parameters"] if param["name"] == parameter), None)
+        if repository_parameter is None:
+            logging.error(f"Parameter '{parameter}' not found in repository parameters.")
+            raise HTTPException(status_code=400, detail=f"Parameter '{parameter}' not found in repository parameters.")
+        if repository_parameter["type"] not in CONVERT_TYPES:
+            logging.warning(f"Parameter '{parameter}' has type {repository_parameter['type']}, its values are kept")
+            continue
+        parameters.append(repository_parameter)
+
+    repository_object_id = ObjectId(repository_id)
+    layout_repository = await get_layout_repository(repository_id)
+    bucketed = is_bucketed(layout_repository)
+    records_collection = db[get_records_collection_name(layout_repository)]
+    # Buckets are converted whole, so their progress is counted in buckets
+    total = await records_collection.count_documents({"repository": repository_object_id}) if bucketed else repository.get("current_data_size") or 0
+    chunk_size = max(TYPE_CHANGE_CHUNK_SIZE // RECORDS_BUCKET_SIZE, 1) if bucketed else TYPE_CHANGE_CHUNK_SIZE
+    unit = "buckets" if bucketed else "records"
     try:
         logging.info(f"Changing parameter types for repository {repository_id}")
-        logging.info(f"total records to change: {repository['current_data_size']}")
-        for i in range(0, repository["current_data_size"], RECORDS_BATCH_SIZE):
-            records = await db["records"].find({"repository": ObjectId(repository_id)}).sort("_id", 1).skip(i).limit(RECORDS_BATCH_SIZE).to_list(length=None)
-            for parameter in changed_parameters:
-                repository_parameter = next((param for param in repository["parameters"] if param["name"] == parameter), None)
-                if repository_parameter is None:
-                    logging.error(f"Parameter '{parameter}' not found in repository parameters.")
-                    raise HTTPException(status_code=400, detail=f"Parameter '{parameter}' not found in repository parameters.")
-                
-                for record in records:
-                    value = record["data"].get(parameter)
-                    try:
-                        if repository_parameter["type"] == "number":                            
-                            value = float(value) if value is not None else None
-                        elif repository_parameter["type"] == "string":
-                            value = str(value) if value is not None else None
-                    except Exception as e:
-                        value = None
-                    record["data"][parameter] = value
-                
-                if records:
-                    await db["records"].bulk_write([
-                        UpdateOne({"_id": record["_id"]}, {"$set": {"data": record["data"], "updated_at": datetime.now(), "version": record.get("version", 0) + 1}})
-                        for record in records
-                    ])
+        logging.info(f"total records to change: {total}")
+        started_at = datetime.now()
+        start_time = time.perf_counter()
+        changed = 0
+        last_id = None
+        await db["repositories"].update_one({"_id": repository_object_id}, {"$set": {"data_updated_at": started_at, "type_change": {"status": "running", "parameters": [param["name"] for param in parameters], "processed": 0, "total": total, "unit": unit, "records_per_second": 0, "started_at": started_at, "updated_at": started_at}}, "$unset": {"zone_maps_import_id": ""}})
+        if parameters:
+            pipeline = get_convert_pipeline(parameters, bucketed)
+            # Every range is converted by one update_many over the (repository, _id) index, touching each record once
+            while True:
+                range_last_id = await get_range_last_id(records_collection, repository_object_id, last_id, chunk_size)
+                query = {"repository": repository_object_id}
+                id_range = {}
+                if last_id is not None:
+                    id_range["$gt"] = last_id
+                if range_last_id is not None:
+                    id_range["$lte"] = range_last_id
+                if id_range:
+                    query["_id"] = id_range
+                result = await records_collection.update_many(query, pipeline)
+                changed += result.matched_count
+                elapsed_time = time.perf_counter() - start_time
+                records_per_second = changed / elapsed_time if elapsed_time > 0 else 0
+                await db["repositories"].update_one({"_id": repository_object_id}, {"$set": {"type_change.processed": changed, "type_change.records_per_second": records_per_second, "type_change.updated_at": datetime.now()}})
+                logging.info(f"Changed parameter types of {changed}/{total} {unit} for repository {repository_id} ({records_per_second:.0f} {unit}/s)")
+                if range_last_id is None:
+                    break
+                last_id = range_last_id
         logging.info(f"Changed parameter types for repository {repository_id} successfully")
         await db["repositories"].update_one(
-            {"_id": ObjectId(repository_id)},
-            {"$set": {"version": repository["version"] + 1, "updated_at": datetime.now()}}
+            {"_id": repository_object_id},
+            {"$set": {"version": repository["version"] + 1, "updated_at": datetime.now(), "type_change.status": "completed", "type_change.updated_at": datetime.now()}}
         )
         logging.info(f"Updated repository {repository_id} version to {repository['version'] + 1}")
     except Exception as e:
         logging.error(f"Error changing parameter types for repository {repository_id}: {e}", exc_info=True)
-        raise ValueError(f"Error changing parameter types for repository {repository_id}: {e}")
\ No newline at end of file
+        await db["repositories"].update_one({"_id": repository_object_id}, {"$set": {"type_change.status": "failed", "type_change.error": str(e), "type_change.updated_at": datetime.now()}})
+        raise ValueError(f"Error changing parameter types for repository {repository_id}: {e}")
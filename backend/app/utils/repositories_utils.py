@@ -1,11 +1,14 @@
 import pandas as pd
-import mimetypes
 import logging
+import asyncio
 import os
 import json
 from fastapi import Request, Response, HTTPException
 from typing import List
 from app.database import db
+from app.utils.jobs_utils import enqueue_job
+from app.utils.file_formats_utils import get_file_format
+from app.utils.uploads_utils import save_upload_file, get_file_sha256
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
 from datetime import datetime
@@ -13,6 +16,7 @@ from datetime import datetime
 load_dotenv()
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "50"))  # Default to 50MB
+SUPPORTED_FILES = "CSV, JSON Lines (optionally gzip or zstd compressed) and Parquet"
 
 def validate_repository_file(repository: dict):
     if repository["file"] is None and repository["large_file"] is True and repository["file_path"] is None:
@@ -21,9 +25,8 @@ def validate_repository_file(repository: dict):
     if repository["file"] is not None and repository["file"].size > MAX_FILE_SIZE * 1024 * 1024:
         raise HTTPException(status_code=400, detail="File size exceeds 50MB limit. Please use large file upload.")
 
-    if repository["file"] and repository["file"].content_type != "text/csv":
-        mime_type, _ = mimetypes.guess_type(repository["file"].filename)
-        raise HTTPException(status_code=400, detail="Invalid file type. Only CSV files are allowed.")
+    if repository["file"] and get_file_format(repository["file"].filename) is None:
+        raise HTTPException(status_code=400, detail=f"Invalid file type. Only {SUPPORTED_FILES} files are allowed.")
     
     if "file" not in repository and repository["large_file"] is True:
         file_path = Path(repository["file_path"])
@@ -31,11 +34,21 @@ def validate_repository_file(repository: dict):
         if not file_path.exists() or not file_path.is_file():
             raise HTTPException(status_code=400, detail="File does not exist or is not a file.")
 
-        mime_type, _ = mimetypes.guess_type(file_path)
-
-        if mime_type != "text/csv":
-            raise HTTPException(status_code=400, detail="Invalid file type. Only CSV files are allowed.")
+        if get_file_format(file_path.name) is None:
+            raise HTTPException(status_code=400, detail=f"Invalid file type. Only {SUPPORTED_FILES} files are allowed.")
         
+async def keep_parameters_stats(repository_id: str, parameters: List[dict], changed_parameters: List[str]) -> List[dict]:
+    """
+    Keep the stats inferred at ingest of the parameters whose type did not change.
+    """
+    current_repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"parameters": 1})
+    current_stats = {param["name"]: param["stats"] for param in (current_repository or {}).get("parameters", []) if "stats" in param}
+
+    return [
+        {**parameter, "stats": current_stats[parameter["name"]]} if "stats" not in parameter and parameter.get("name") in current_stats and parameter["name"] not in changed_parameters else parameter
+        for parameter in parameters
+    ]
+
 async def get_changed_type_parameters(repository_id: str, parameters: List[dict]):
     """Validate repository parameters."""
     changed_parameters = []
@@ -60,12 +73,30 @@ async def get_changed_type_parameters(repository_id: str, parameters: List[dict]
     
     return changed_parameters
 
-async def upsert_repository(repository_id, name, description, url, large_file, file_path, file, parameters, current_user: dict, upsert_type: str) -> dict:
+def remove_file(file_path: str):
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+async def store_repository_file(repository: dict):
+    """
+    Save the uploaded file of a repository under UPLOAD_DIR without blocking the event loop, and set its file_path and
+    sha256. Files uploaded in chunks are already stored, their sha256 comes from the upload.
+    """
+    if "file" in repository and repository["file"] is not None:
+        file_name = f"{repository['name'].replace(' ', '_')}_{datetime.now().timestamp()}{get_file_format(repository['file'].filename)['extension']}"
+        repository["file_sha256"] = await save_upload_file(repository["file"], os.path.join(UPLOAD_DIR, file_name))
+        repository["file_path"] = file_name
+        repository["large_file"] = True
+        repository["file"] = None
+    elif repository.get("file_path"):
+        repository["file_sha256"] = await get_file_sha256(repository["file_path"])
+
+async def upsert_repository(repository_id, name, description, url, large_file, file_path, file, parameters, current_user: dict, upsert_type: str, cluster_key: str = "") -> dict:
     """Upsert a repository."""
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not enough permissions")
     
-    repository = {"name": name, "description": description, "url": url, "large_file": large_file, "file_path": file_path, "file": file}
+    repository = {"name": name, "description": description, "url": url, "large_file": large_file, "file_path": file_path, "file": file, "cluster_key": cluster_key or None}
 
     if upsert_type == "create":
         if repository["file"] is None and repository["large_file"] is not True:
@@ -74,23 +105,12 @@ async def upsert_repository(repository_id, name, description, url, large_file, f
         try:
             validate_repository_file(repository)
             now = datetime.now()
-            repository_data = {"name": repository["name"], "description": repository["description"], "url": repository["url"], "version": 0, "data_ready": False, "valid": False, "created_at": now, "updated_at": now}
+            repository_data = {"name": repository["name"], "description": repository["description"], "url": repository["url"], "version": 0, "data_ready": False, "valid": False, "cluster_key": repository["cluster_key"], "created_at": now, "updated_at": now}
             result = await db["repositories"].insert_one(repository_data)
-            if "file" in repository and repository["file"] is not None:
-                file_name = f"{repository['name'].replace(' ', '_')}_{datetime.now().timestamp()}.csv"
-                file_path = os.path.join(UPLOAD_DIR, file_name)
-                with open(file_path, "wb") as f:
-                    while chunk := await repository["file"].read(1024 * 1024):  # 1MB chunks
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                repository["file_path"] = file_name
-                repository["large_file"] = True
-                repository["file"] = None
-                
+            await store_repository_file(repository)
             repository["_id"] = str(result.inserted_id)
             
-            await db["jobs"].insert_one({"type": "store_repository_records", "data": {"repository": repository, "delete_existing_records": False}})
+            await enqueue_job("store_repository_records", {"repository": repository, "delete_existing_records": False})
 
             return Response(status_code=201, content=json.dumps({"id": str(repository["_id"]), "message": "Repository created successfully"}), media_type="application/json")
         except Exception as e:
@@ -101,41 +121,52 @@ async def upsert_repository(repository_id, name, description, url, large_file, f
         now = datetime.now()
         repository_data = {"name": repository["name"], "description": repository["description"], "url": repository["url"], "version": 0, "updated_at": now, "parameters": parameters}
         has_file = ("file" in repository and repository["file"] is not None) or repository["large_file"] is True
-        if has_file:
-            repository_data["parameters"] = []
-            repository_data["data_ready"] = False
-            repository_data["valid"] = False
-            repository_data["file_size"] = None
-            repository_data["original_data_size"] = None
-            repository_data["current_data_size"] = None
-            repository_data["data_updated_at"] = None
-            repository["_id"] = repository_id
 
         try:
+            if has_file:
+                await store_repository_file(repository)
+                current_repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"file_sha256": 1, "data_ready": 1, "cluster_key": 1, "imported_at": 1, "data_updated_at": 1})
+                # The same file was already imported and its records were not written since, keep them instead of importing them again
+                if repository["file_sha256"] is not None and current_repository is not None and current_repository.get("data_ready") is True and current_repository.get("file_sha256") == repository["file_sha256"] and current_repository.get("cluster_key") == repository["cluster_key"] and current_repository.get("imported_at") is not None and current_repository.get("data_updated_at") == current_repository["imported_at"]:
+                    logging.info(f"Skipping import of repository {repository_id}: the file is identical to the imported one")
+                    fields = {"name": repository["name"], "description": repository["description"], "url": repository["url"], "updated_at": now}
+                    # The records are kept, so the parameters sent with the file apply to them as in an update without file
+                    changed_parameters = []
+                    if parameters:
+                        changed_parameters = await get_changed_type_parameters(repository_id, parameters)
+                        fields["parameters"] = await keep_parameters_stats(repository_id, parameters, changed_parameters)
+                    await db["repositories"].update_one({"_id": ObjectId(repository_id)}, {"$set": fields})
+                    if len(changed_parameters) > 0:
+                        await enqueue_job("change_parameters_type", {"repository_id": repository_id, "changed_parameters": changed_parameters})
+                    await asyncio.to_thread(remove_file, os.path.join(UPLOAD_DIR, repository["file_path"]))
+                    return Response(status_code=200, content=json.dumps({"id": str(repository_id), "message": "Repository updated successfully. The file is identical to the imported one, records were kept"}), media_type="application/json")
+
+                repository_data["parameters"] = []
+                repository_data["data_ready"] = False
+                repository_data["valid"] = False
+                repository_data["file_size"] = None
+                repository_data["original_data_size"] = None
+                repository_data["current_data_size"] = None
+                repository_data["data_updated_at"] = None
+                repository_data["cluster_key"] = repository["cluster_key"]
+                repository["_id"] = repository_id
+
             changed_parameters = []
             if not has_file:
                 changed_parameters = await get_changed_type_parameters(repository_id, parameters)
+            if not has_file:
+                repository_data["parameters"] = await keep_parameters_stats(repository_id, parameters, changed_parameters)
             result = await db["repositories"].update_one({"_id": ObjectId(repository_id)}, {"$set": repository_data})
             if len(changed_parameters) > 0 and not has_file:
-                await db["jobs"].insert_one({"type": "change_parameters_type", "data": {"repository_id": repository_id, "changed_parameters": changed_parameters}})
-            
-            if "file" in repository and repository["file"] is not None:
-                file_name = f"{repository['name'].replace(' ', '_')}_{datetime.now().timestamp()}.csv"
-                file_path = os.path.join(UPLOAD_DIR, file_name)
-                with open(file_path, "wb") as f:
-                    while chunk := await repository["file"].read(1024 * 1024):  # 1MB chunks
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                repository["file_path"] = file_name
-                repository["large_file"] = True
-                repository["file"] = None
+                await enqueue_job("change_parameters_type", {"repository_id": repository_id, "changed_parameters": changed_parameters})
             
-            if ("file" in repository and repository["file"] is not None) or repository["large_file"] is True:
-                await db["jobs"].insert_one({"type": "store_repository_records", "data": {"repository": repository, "delete_existing_records": True}})
+            if has_file:
+                await enqueue_job("store_repository_records", {"repository": repository, "delete_existing_records": True})
             
             return Response(status_code=200, content=json.dumps({"id": str(repository_id), "message": "Repository updated successfully"}), media_type="application/json")
 
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error updating repository: {str(e)}")
         
@@ -0,0 +1,60 @@
+from fastapi import Response
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from datetime import datetime, timezone
+from typing import Any
+import numpy as np
+import orjson
+import base64
+
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def encode_datetime(value: datetime) -> dict:
+    """
+    Datetimes as bson.json_util relaxed mode writes them: ISO 8601 in UTC with milliseconds since 1970, milliseconds
+    since the epoch before.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    if value >= EPOCH:
+        millis = int(value.microsecond / 1000)
+        offset = value.utcoffset()
+        tz_string = "Z" if offset is not None and offset.total_seconds() == 0 else value.strftime("%z")
+        return {"$date": f"{value.strftime('%Y-%m-%dT%H:%M:%S')}{f'.{millis:03d}' if millis else ''}{tz_string}"}
+    delta = value - EPOCH
+    millis = (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    return {"$date": {"$numberLong": str(millis)}}
+
+def bson_default(value: Any) -> Any:
+    """
+    orjson hook for the types it does not serialize, written as bson.json_util does so clients keep reading $oid and
+    $date fields.
+    """
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime):
+        return encode_datetime(value)
+    if isinstance(value, (Binary, bytes)):
+        subtype = value.subtype if isinstance(value, Binary) else 0
+        return {"$binary": {"base64": base64.b64encode(bytes(value)).decode("ascii"), "subType": f"{subtype:02x}"}}
+    if isinstance(value, Decimal128):
+        return {"$numberDecimal": str(value)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=bson_default, option=ORJSON_OPTIONS)
+
+class MongoJSONResponse(Response):
+    """
+    JSON response of MongoDB documents serialized with orjson instead of bson.json_util.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
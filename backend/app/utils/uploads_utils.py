@@ -0,0 +1,202 @@
+from fastapi import HTTPException, UploadFile
+from app.database import db
+from app.utils.file_formats_utils import get_file_format
+from bson.objectid import ObjectId
+from datetime import datetime
+from typing import Any, AsyncIterator, Optional, Tuple
+from pymongo import ReturnDocument
+from dotenv import load_dotenv
+import hashlib
+import asyncio
+import logging
+import os
+
+load_dotenv()
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+UPLOAD_MAX_CHUNK_SIZE = int(os.getenv("UPLOAD_MAX_CHUNK_SIZE", "64"))  # MB per appended chunk
+UPLOAD_CLAIM_SECONDS = int(os.getenv("UPLOAD_CLAIM_SECONDS", "600"))  # How long an append or completion holds an upload
+UPLOAD_WRITE_SIZE = 1024 * 1024
+
+# Running sha256 of the uploads appended by this API process, with the offset it covers. Another API process
+# appending to the upload moves its size past that offset, and the hash is then rebuilt from the part file.
+upload_hashers = {}
+
+def get_part_path(upload: dict) -> str:
+    return os.path.join(UPLOAD_DIR, f"{upload['_id']}.part")
+
+def create_part_file(file_path: str):
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    open(file_path, "wb").close()
+
+def hash_file(file_path: str) -> Any:
+    hasher = hashlib.sha256()
+    if os.path.exists(file_path):
+        with open(file_path, "rb") as f:
+            while chunk := f.read(UPLOAD_WRITE_SIZE):
+                hasher.update(chunk)
+    return hasher
+
+async def get_upload_hasher(upload: dict) -> Any:
+    upload_id = str(upload["_id"])
+    offset, hasher = upload_hashers.get(upload_id, (None, None))
+    if offset != upload["size"]:
+        hasher = await asyncio.to_thread(hash_file, get_part_path(upload))
+        upload_hashers[upload_id] = (upload["size"], hasher)
+    return hasher
+
+def write_chunk(f: Any, hasher: Any, chunk: bytes):
+    f.write(chunk)
+    hasher.update(chunk)
+
+async def save_file(chunks: AsyncIterator[bytes], file_path: str, hasher: Any, mode: str = "wb", max_size: Optional[int] = None) -> int:
+    """
+    Write a stream of chunks to a file, hashing them on the way. Writes run in a thread so the event loop keeps
+    serving other requests. Returns the written size.
+    """
+    written = 0
+    f = await asyncio.to_thread(open, file_path, mode)
+    try:
+        async for chunk in chunks:
+            written += len(chunk)
+            if max_size is not None and written > max_size:
+                raise HTTPException(status_code=413, detail=f"Chunk exceeds the {UPLOAD_MAX_CHUNK_SIZE}MB limit.")
+            await asyncio.to_thread(write_chunk, f, hasher, chunk)
+        await asyncio.to_thread(f.flush)
+    finally:
+        await asyncio.to_thread(f.close)
+    return written
+
+async def read_upload_file(file: UploadFile) -> AsyncIterator[bytes]:
+    while chunk := await file.read(UPLOAD_WRITE_SIZE):
+        yield chunk
+
+async def save_upload_file(file: UploadFile, file_path: str) -> str:
+    """
+    Save a form upload without blocking the event loop. Returns its sha256.
+    """
+    hasher = hashlib.sha256()
+    await save_file(read_upload_file(file), file_path, hasher)
+    return hasher.hexdigest()
+
+async def init_upload(file_name: str, total_size: Optional[int], current_user: dict) -> dict:
+    file_format = get_file_format(file_name)
+    if file_format is None:
+        raise HTTPException(status_code=400, detail="Invalid file type. Only CSV, JSON Lines (optionally gzip or zstd compressed) and Parquet files are allowed.")
+    now = datetime.now()
+    upload = {
+        "file_name": file_name,
+        "file_path": None,
+        "extension": file_format["extension"],
+        "size": 0,
+        "total_size": total_size,
+        "status": "uploading",
+        "sha256": None,
+        "created_by": current_user.get("_id"),
+        "created_at": now,
+        "updated_at": now
+    }
+    result = await db["uploads"].insert_one(upload)
+    upload["_id"] = result.inserted_id
+    await asyncio.to_thread(create_part_file, get_part_path(upload))
+
+    return upload
+
+async def get_upload(upload_id: str) -> dict:
+    upload = await db["uploads"].find_one({"_id": ObjectId(upload_id)})
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found.")
+    return upload
+
+async def claim_upload(upload_id: str, status: str, offset: Optional[int] = None) -> Tuple[dict, ObjectId]:
+    """
+    Claim an upload in MongoDB for an append (status "appending") or its completion (status "completing") before
+    touching its file, so API processes never write the same upload at once. A claim whose process died expires
+    after UPLOAD_CLAIM_SECONDS. Returns the claimed upload and the claim token the upload is released with.
+    """
+    token = ObjectId()
+    query = {"_id": ObjectId(upload_id), "$or": [{"status": "uploading"}, {"status": {"$in": ["appending", "completing"]}, "$expr": {"$lt": ["$claim_expires_at", "$$NOW"]}}]}
+    if offset is not None:
+        query["size"] = offset
+    upload = await db["uploads"].find_one_and_update(
+        query,
+        [{"$set": {"status": status, "claim_token": token, "claim_expires_at": {"$add": ["$$NOW", UPLOAD_CLAIM_SECONDS * 1000]}}}],
+        return_document=ReturnDocument.AFTER
+    )
+    if upload is not None:
+        return upload, token
+
+    upload = await get_upload(upload_id)
+    if upload["status"] in ["appending", "completing"]:
+        raise HTTPException(status_code=409, detail=f"Upload is {upload['status']} in another request.")
+    if upload["status"] != "uploading":
+        raise HTTPException(status_code=409, detail=f"Upload is {upload['status']}.")
+    raise HTTPException(status_code=409, detail=f"Offset {offset} does not match the upload size {upload['size']}.")
+
+async def release_upload(upload: dict, token: ObjectId, fields: dict = None) -> bool:
+    """
+    Release a claimed upload setting fields. Returns False if the claim expired and another request took the upload.
+    """
+    result = await db["uploads"].update_one(
+        {"_id": upload["_id"], "claim_token": token},
+        {"$set": {"status": "uploading", **(fields or {}), "claim_token": None, "claim_expires_at": None, "updated_at": datetime.now()}}
+    )
+    return result.matched_count > 0
+
+async def append_upload_chunk(upload_id: str, offset: int, chunks: AsyncIterator[bytes]) -> dict:
+    """
+    Append a chunk at offset to an upload. The offset must be the current upload size, so a client that lost its
+    connection gets the size with GET and resends from there. The size is only acknowledged if the upload was still
+    claimed by this append when it was stored.
+    """
+    upload, token = await claim_upload(upload_id, "appending", offset)
+    part_path = get_part_path(upload)
+    try:
+        # Drop bytes of an interrupted append that were written but not acknowledged
+        if await asyncio.to_thread(os.path.getsize, part_path) != offset:
+            await asyncio.to_thread(os.truncate, part_path, offset)
+        hasher = await get_upload_hasher(upload)
+        written = await save_file(chunks, part_path, hasher, "ab", UPLOAD_MAX_CHUNK_SIZE * 1024 * 1024)
+    except BaseException:
+        upload_hashers.pop(upload_id, None)
+        await release_upload(upload, token)
+        raise
+    size = offset + written
+    if not await release_upload(upload, token, {"size": size}):
+        upload_hashers.pop(upload_id, None)
+        raise HTTPException(status_code=409, detail="Upload was claimed by another request while appending, get its size and resend from there.")
+    upload_hashers[upload_id] = (size, hasher)
+
+    return {"_id": upload["_id"], "size": size, "total_size": upload["total_size"], "status": "uploading"}
+
+async def complete_upload(upload_id: str, sha256: str) -> dict:
+    """
+    Check the sha256 of an upload and move it to its final file, which can be used as a large file repository file_path.
+    """
+    upload = await get_upload(upload_id)
+    if upload["status"] == "completed":
+        return upload
+    upload, token = await claim_upload(upload_id, "completing")
+    try:
+        if upload["total_size"] is not None and upload["size"] != upload["total_size"]:
+            raise HTTPException(status_code=409, detail=f"Upload has {upload['size']} of {upload['total_size']} bytes.")
+        hasher = await get_upload_hasher(upload)
+        if hasher.hexdigest() != sha256.lower():
+            raise HTTPException(status_code=422, detail="Checksum does not match the uploaded file.")
+    except BaseException:
+        await release_upload(upload, token)
+        raise
+    file_path = f"{upload['_id']}{upload['extension']}"
+    await asyncio.to_thread(os.replace, get_part_path(upload), os.path.join(UPLOAD_DIR, file_path))
+    upload_hashers.pop(upload_id, None)
+    upload.update({"status": "completed", "file_path": file_path, "sha256": hasher.hexdigest(), "claim_token": None, "claim_expires_at": None, "updated_at": datetime.now()})
+    await db["uploads"].update_one({"_id": upload["_id"], "claim_token": token}, {"$set": {key: upload[key] for key in ["status", "file_path", "sha256", "claim_token", "claim_expires_at", "updated_at"]}})
+    logging.info(f"Upload {upload_id} completed with {upload['size']} bytes")
+
+    return upload
+
+async def get_file_sha256(file_path: str) -> Optional[str]:
+    """
+    Get the sha256 of a completed upload by its file_path.
+    """
+    upload = await db["uploads"].find_one({"file_path": file_path, "status": "completed"}, {"sha256": 1})
+    return upload["sha256"] if upload is not None else None
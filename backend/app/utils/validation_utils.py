@@ -1,138 +1,136 @@
 from bson.objectid import ObjectId
 from typing import List
 from app.database import db
+from app.utils.equivalence_utils import compare_aggregation_results
 from collections import defaultdict
+from dotenv import load_dotenv
+from pymongo import UpdateMany
+import asyncio
 import logging
+import time
+import os
 
-async def validate_filter_processes(processes: List[dict]):
+load_dotenv()
+VALIDATION_CONCURRENCY = int(os.getenv("VALIDATION_CONCURRENCY", "8"))
+
+async def get_batch_fingerprints(process_id) -> dict:
   """
-  Validate filter processes.
+  Get the fingerprints stored for every batch of every process item of a process with a single aggregation.
+  Returns, per task process, a list of {batch_number, fingerprint, process_item_ids}.
   """
-  if len(processes) == 0:
-    logging.error("No filter processes to validate.")
-    return {"valid": [], "invalid": []}
-  
-  last_batch_results = await db["process_results"].find({"process_id": ObjectId(processes[0]["process_id"])}).sort("batch_number", -1).limit(1).to_list(length=None)
-  
-  if len(last_batch_results) == 0:
-    logging.error("No process results found for the given process_id.")
-    raise ValueError("No process results found for the given process_id.")
-  
-  invalid = []
-  
-  for i in range(last_batch_results[0]["batch_number"]):
-    current_batches = await db["process_results"].find({"process_id": ObjectId(processes[0]["process_id"]), "batch_number": i + 1}, {"results": 1}).to_list(length=None)
-    base_results = set(str(_id) for _id in current_batches[0]["results"] if _id is not None) if current_batches[0] else set()
-    invalid_in_batches = {str(batch["process_item_id"]) for batch in current_batches for result in batch["results"] if result is None or str(result) not in base_results}
-    invalid.extend(invalid_in_batches)
-  
-  valid = [process["_id"] for process in processes if str(process["_id"]) not in invalid]
-  
-  return {"valid": valid, "invalid": list(invalid)}
+  fingerprints = await db["process_results"].aggregate([
+    {"$match": {"process_id": ObjectId(process_id)}},
+    {"$group": {
+      "_id": {"type": "$type", "batch_number": "$batch_number", "fingerprint": "$fingerprint"},
+      "process_item_ids": {"$addToSet": "$process_item_id"}
+    }}
+  ]).to_list(length=None)
+
+  fingerprints_by_type = defaultdict(list)
+  for fingerprint in fingerprints:
+    fingerprints_by_type[fingerprint["_id"]["type"]].append({
+      "batch_number": fingerprint["_id"]["batch_number"],
+      "fingerprint": fingerprint["_id"].get("fingerprint"),
+      "process_item_ids": [str(_id) for _id in fingerprint["process_item_ids"]]
+    })
 
-async def validate_group_processes(processes):
+  return fingerprints_by_type
+
+async def get_batch_aggregations(process_id) -> dict:
   """
-  Validate group processes with results as a list of {group, values} objects.
-  Handles both single and multiple group keys.
+  Get the aggregation values stored for every batch of the aggregation process items of a process with a single query.
+  Returns, per batch number, a list of {process_item_id, results}.
   """
-  if len(processes) == 0:
-      logging.error("No group processes to validate.")
-      return {"valid": [], "invalid": []}
-
-  valid = []
-  invalid = []
-
-  # Helper to normalize group key to a tuple (for consistent comparison)
-  def normalize_group_key(group):
-      if isinstance(group, list):
-          return tuple(group)
-      return (group,)
-
-  # Build mapping from group key to set of values for the base process
-  def group_to_set(results):
-      mapping = {}
-      for obj in results:
-          group_key = normalize_group_key(obj["group"])
-          mapping[group_key] = set(str(v) for v in obj["values"] if v is not None)
-      return mapping
-    
-  last_batch_results = await db["process_results"].find({"process_id": ObjectId(processes[0]["process_id"])}).sort("batch_number", -1).limit(1).to_list(length=None)
-  
-  if len(last_batch_results) == 0:
-      logging.error("No process results found for the given process_id.")
-      raise ValueError("No process results found for the given process_id.")
-  
-  for i in range(last_batch_results[0]["batch_number"]):
-      current_batches = await db["process_results"].find({"process_id": ObjectId(processes[0]["process_id"]), "batch_number": i + 1}, {"results": 1}).to_list(length=None)
-      if not current_batches:
-          continue
-      
-      base_results = current_batches[0]["results"] if current_batches else []
-      base_mapping = group_to_set(base_results)
-      
-      for batch in current_batches:
-          proc_mapping = group_to_set(batch["results"])
-          # Compare group keys
-          if set(proc_mapping.keys()) != set(base_mapping.keys()):
-              invalid.append(str(batch["process_item_id"]))
-              continue
-          # Compare values for each group
-          for group_key in base_mapping:
-              if proc_mapping[group_key] != base_mapping[group_key]:
-                  invalid.append(str(batch["process_item_id"]))
-                  break
-  
-  invalid = list(set(invalid))
+  aggregations_by_batch = defaultdict(list)
+  async for result in db["process_results"].find({"process_id": ObjectId(process_id), "type": "aggregation"}, {"process_item_id": 1, "batch_number": 1, "results": 1}):
+    aggregations_by_batch[result["batch_number"]].append({"process_item_id": str(result["process_item_id"]), "results": result.get("results")})
+
+  return aggregations_by_batch
+
+def validate_aggregations(processes: List[dict], batch_aggregations: dict):
+  """
+  Validate the aggregation processes of a process comparing their batch values within AGGREGATION_ABSOLUTE_TOLERANCE.
+  In every batch the values close to the most process items are taken as the expected ones. A process is invalid
+  when one of its batches has other values, has no values, or is missing while other items have it.
+  """
+  process_item_ids = {str(process["_id"]) for process in processes}
+  invalid = set()
+  for batch_results in batch_aggregations.values():
+    candidates = [result for result in batch_results if result["results"] is not None]
+    matching_ids = set()
+    for candidate in candidates:
+      close_ids = {result["process_item_id"] for result in candidates if compare_aggregation_results(candidate["results"], result["results"]) is None}
+      if len(close_ids) > len(matching_ids):
+        matching_ids = close_ids
+    invalid.update(process_item_ids - matching_ids)
+
   valid = [process["_id"] for process in processes if str(process["_id"]) not in invalid]
-  
-  return {"valid": valid, "invalid": invalid}
 
-async def validate_aggregation_processes(processes: List[dict]):
+  return {"valid": valid, "invalid": list(invalid)}
+
+def validate_fingerprints(processes: List[dict], batch_fingerprints: List[dict]):
   """
-  Validate aggregation processes.
+  Validate the processes of one task process comparing their batch fingerprints.
+  In every batch the fingerprint shared by most process items is taken as the expected one. A process is invalid
+  when one of its batches has another fingerprint, has no fingerprint, or is missing while other items have it.
   """
   if len(processes) == 0:
-    logging.error("No aggregation processes to validate.")
     return {"valid": [], "invalid": []}
-  
-  valid = []
-  invalid = []
-  last_batch_results = await db["process_results"].find({"process_id": ObjectId(processes[0]["process_id"])}).sort("batch_number", -1).limit(1).to_list(length=None)
-  
-  if len(last_batch_results) == 0:
-    logging.error("No process results found for the given process_id.")
+
+  if len(batch_fingerprints) == 0:
+    logging.error(f"No process results found for process_id {processes[0]['process_id']}.")
     raise ValueError("No process results found for the given process_id.")
-  
-  for i in range(last_batch_results[0]["batch_number"]):
-    current_batches = await db["process_results"].find({"process_id": ObjectId(processes[0]["process_id"]), "batch_number": i + 1}, {"results": 1}).to_list(length=None)
-    if not current_batches:
-      continue
-    
-    base_results = current_batches[0]["results"] if current_batches else []
-    for current_batch in current_batches:
-      batch_results = current_batch["results"]
-      
-      if len(batch_results) != len(base_results):
-        invalid.append(str(current_batch["process_item_id"]))
-        continue
-      for batch_result in batch_results:
-        base_result = next((r for r in base_results if r["property"] == batch_result["property"]), None)
-        
-        if base_result is None or set(base_result.keys()) != set(batch_result.keys()):
-          invalid.append(str(current_batch["process_item_id"]))
-          break
-        
-        for key in base_result.keys():
-          not_nones_condition = (batch_result[key] is not None and base_result[key] is None) or (batch_result[key] is None and base_result[key] is not None)
-          
-          if key != "property" and (not_nones_condition or abs(batch_result[key] - base_result[key]) > 0.002):
-            invalid.append(str(current_batch["process_item_id"]))
-            break
-  
-  invalid = list(set(invalid))
+
+  fingerprints_by_batch = defaultdict(list)
+  for batch_fingerprint in batch_fingerprints:
+    fingerprints_by_batch[batch_fingerprint["batch_number"]].append(batch_fingerprint)
+
+  process_item_ids = {str(process["_id"]) for process in processes}
+  invalid = set()
+  for batch_number, fingerprints in fingerprints_by_batch.items():
+    candidates = [fingerprint for fingerprint in fingerprints if fingerprint["fingerprint"] is not None]
+    expected = max(candidates, key=lambda fingerprint: len(fingerprint["process_item_ids"]), default=None)
+    matching_ids = set(expected["process_item_ids"]) if expected is not None else set()
+    invalid.update(process_item_ids - matching_ids)
+
   valid = [process["_id"] for process in processes if str(process["_id"]) not in invalid]
-  
-  return {"valid": valid, "invalid": invalid}
+
+  return {"valid": valid, "invalid": list(invalid)}
+
+async def validate_process_group(process_id, process_group: List[dict], semaphore: asyncio.Semaphore) -> int:
+  """
+  Validate the processes of one process_id and store its own valid and invalid sets with a single bulk write.
+  Returns the number of validated processes.
+  """
+  async with semaphore:
+    actions = process_group[0]["actions"]
+    batch_fingerprints = await get_batch_fingerprints(process_id)
+    valid = set()
+    invalid = set()
+
+    for task_process in ["filter", "group", "aggregation"]:
+      if task_process in actions:
+        task_processes = [p for p in process_group if p["task_process"] == task_process]
+        result = validate_fingerprints(task_processes, batch_fingerprints[task_process])
+        valid.update(str(_id) for _id in result["valid"])
+        invalid.update(str(_id) for _id in result["invalid"])
+        if task_process == "aggregation":
+          # Aggregation fingerprints only cover the properties and operations, the values are compared here
+          result = await asyncio.to_thread(validate_aggregations, task_processes, await get_batch_aggregations(process_id))
+          invalid.update(str(_id) for _id in result["invalid"])
+        logging.info(f"Validated {task_process} processes for process_id: {process_id} for task_process: {task_process}")
+
+    valid -= invalid
+    operations = []
+    if len(valid) > 0:
+      operations.append(UpdateMany({"_id": {"$in": [ObjectId(_id) for _id in valid]}}, {"$set": {"validated": True, "valid": True}}))
+    if len(invalid) > 0:
+      operations.append(UpdateMany({"_id": {"$in": [ObjectId(_id) for _id in invalid]}}, {"$set": {"validated": True, "valid": False}}))
+    if len(operations) > 0:
+      await db["processes"].bulk_write(operations, ordered=False)
+    logging.info(f"Stored validation results for process_id: {process_id}")
+
+    return len(valid) + len(invalid)
 
 async def init_validation():
   try:
@@ -140,54 +138,34 @@ async def init_validation():
     if len(processes) == 0:
       logging.info("No completed processes to validate or all processes are already validated.")
       return
-    
+
     logging.info(f"Found {len(processes)} processes to validate.")
     grouped_processes = defaultdict(list)
     for process in processes:
       grouped_processes[process["process_id"]].append(process)
-    
-    filter_valid = []
-    filter_invalid = []
-    group_valid = []
-    group_invalid = []
-    aggregation_valid = []
-    aggregation_invalid = []
-
-    for process_id, process_group in grouped_processes.items():
-      if len(process_group) != 0:
-        actions = process_group[0]["actions"]
-
-        if "filter" in actions:
-          filter_processes = [p for p in process_group if p["task_process"] == "filter"]
-          result = await validate_filter_processes(filter_processes)
-          filter_valid += result["valid"]
-          filter_invalid += result["invalid"]
-          logging.info(f"Validated filter processes for process_id: {process_id} for task_process: filter")
-        if "group" in actions:
-          group_processes = [p for p in process_group if p["task_process"] == "group"]
-          result = await validate_group_processes(group_processes)
-          group_valid += result["valid"]
-          group_invalid += result["invalid"]
-          logging.info(f"Validated group processes for process_id: {process_id} for task_process: group")
-        if "aggregation" in actions:
-          aggregation_processes = [p for p in process_group if p["task_process"] == "aggregation"]
-          result = await validate_aggregation_processes(aggregation_processes)
-          aggregation_valid += result["valid"]
-          aggregation_invalid += result["invalid"]
-          logging.info(f"Validated aggregation processes for process_id: {process_id} for task_process: aggregation")
-          
-        total_valid = list(set(filter_valid + group_valid + aggregation_valid))
-        total_invalid = list(set(filter_invalid + group_invalid + aggregation_invalid))
-        
-        total_valid = [ObjectId(_id) for _id in total_valid]
-        total_invalid = [ObjectId(_id) for _id in total_invalid]
-     
-        await db["processes"].update_many({"_id": {"$in": total_valid}},{"$set": {"validated": True, "valid": True}})
-        await db["processes"].update_many({"_id": {"$in": total_invalid}}, {"$set": {"validated": True, "valid": False}})
-        logging.info(f"Stored validation results for process_id: {process_id}")
-  
-    logging.info("Validation completed for all processes.")     
-        
+
+    start_time = time.perf_counter()
+    semaphore = asyncio.Semaphore(VALIDATION_CONCURRENCY)
+    process_ids = list(grouped_processes.keys())
+    results = await asyncio.gather(*[validate_process_group(process_id, grouped_processes[process_id], semaphore) for process_id in process_ids], return_exceptions=True)
+
+    validated = 0
+    errors = []
+    for process_id, result in zip(process_ids, results):
+      if isinstance(result, Exception):
+        logging.error(f"Error in validating processes of process_id {process_id}: {result}")
+        errors.append(f"{process_id}: {result}")
+      else:
+        validated += result
+
+    elapsed_time = time.perf_counter() - start_time
+    throughput = validated / elapsed_time if elapsed_time > 0 else float(validated)
+    logging.info(f"Validated {validated} processes of {len(process_ids)} process groups in {elapsed_time:.2f}s ({throughput:.2f} processes/s).")
+    if len(errors) > 0:
+      raise ValueError(f"{len(errors)} process groups failed: {'; '.join(errors)}")
+
+    logging.info("Validation completed for all processes.")
+
   except Exception as e:
     logging.error(f"Error in validating processes: {e}")
     raise ValueError(f"Error in validating processes: {e}")
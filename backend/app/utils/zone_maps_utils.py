@@ -0,0 +1,174 @@
+from app.database import db
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from datetime import datetime
+from typing import Any, List, Optional
+from dotenv import load_dotenv
+import numpy as np
+import pandas as pd
+from app.utils.records_layout_utils import get_records_collection_name
+import logging
+import os
+
+load_dotenv()
+ZONE_MAPS_ENABLED = bool(os.getenv("ZONE_MAPS_ENABLED", "true").lower() == "true")
+ZONE_BLOOM_BITS = int(os.getenv("ZONE_BLOOM_BITS", "4096"))
+ZONE_BLOOM_HASHES = 3
+# Two keys of 16 characters give two independent hashes, the others are derived with double hashing
+BLOOM_HASH_KEYS = ["zonemapbloom0001", "zonemapbloom0002"]
+NUMERIC_OPERATORS = {"==", ">", "<", ">=", "<="}
+
+def bloom_positions(values: np.ndarray, bits: int) -> np.ndarray:
+    first_hash = pd.util.hash_array(values, hash_key=BLOOM_HASH_KEYS[0])
+    second_hash = pd.util.hash_array(values, hash_key=BLOOM_HASH_KEYS[1])
+    return np.stack([(first_hash + np.uint64(i) * second_hash) % np.uint64(bits) for i in range(ZONE_BLOOM_HASHES)]).ravel()
+
+def build_bloom(values: np.ndarray, bits: int) -> bytes:
+    bloom = np.zeros(bits, dtype=np.uint8)
+    if len(values) > 0:
+        bloom[bloom_positions(values, bits)] = 1
+    return np.packbits(bloom, bitorder="little").tobytes()
+
+def bloom_may_contain(bloom: bytes, value: str) -> bool:
+    bits = np.unpackbits(np.frombuffer(bloom, dtype=np.uint8), bitorder="little")
+    return bool(bits[bloom_positions(np.asarray([value], dtype=object), len(bits))].all())
+
+def compute_column_zone(column: pd.Series) -> dict:
+    """
+    Min/max of the values that coerce to numbers (as the engines compare them), null count and a bloom filter of the
+    text values of a column chunk.
+    """
+    non_null = column.dropna()
+    numeric = pd.to_numeric(non_null, errors="coerce").dropna() if column.dtype.kind not in "iufb" else non_null.astype(float)
+    zone = {"null_count": int(len(column) - len(non_null)), "numeric_count": int(len(numeric))}
+    if len(numeric) > 0:
+        zone["min"] = float(numeric.min())
+        zone["max"] = float(numeric.max())
+    if column.dtype.kind == "O":
+        distinct_values = non_null.astype(str).unique()
+        # A bloom filter with more values than a tenth of its bits matches almost anything, so it is not kept
+        if len(distinct_values) * 10 <= ZONE_BLOOM_BITS:
+            zone["bloom"] = Binary(build_bloom(np.asarray(distinct_values, dtype=object), ZONE_BLOOM_BITS))
+    return zone
+
+def compute_zone_map(chunk: pd.DataFrame, repository_id: Any, import_id: Any, first_id: Any, last_id: Any, first_ordinal: int) -> dict:
+    """
+    Zone map of an ingested chunk, kept for the import it was computed by and the _id range of the chunk.
+    """
+    return {
+        "repository": ObjectId(repository_id),
+        "import_id": import_id,
+        "first_id": first_id,
+        "last_id": last_id,
+        "first_ordinal": first_ordinal,
+        "count": len(chunk),
+        "columns": {str(name): compute_column_zone(chunk[name]) for name in chunk.columns},
+        "created_at": datetime.now()
+    }
+
+def condition_proves_empty(column_zone: Optional[dict], condition: dict) -> bool:
+    """
+    Check if no record of a zone can match a filter condition. Only numeric comparisons and text equality are used,
+    anything else (contains, !=, unknown columns) is assumed to match.
+    """
+    if column_zone is None:
+        return False
+    operator = condition["operator"]
+    if operator not in NUMERIC_OPERATORS:
+        return False
+    try:
+        value = float(condition["value"])
+    except (ValueError, TypeError):
+        # Text equality: the value must be in the bloom filter of the zone
+        return operator == "==" and "bloom" in column_zone and not bloom_may_contain(bytes(column_zone["bloom"]), str(condition["value"]))
+    if np.isnan(value):
+        return False
+    if column_zone["numeric_count"] == 0:
+        # No value coerces to a number, so no numeric comparison can be true
+        return True
+    minimum, maximum = column_zone["min"], column_zone["max"]
+    if operator == "==":
+        return value < minimum or value > maximum
+    if operator == ">":
+        return maximum <= value
+    if operator == ">=":
+        return maximum < value
+    if operator == "<":
+        return minimum >= value
+    return minimum > value
+
+def zone_proves_empty(zone: dict, filters: List[dict]) -> bool:
+    """
+    Filter conditions are combined with AND, so one condition no record can match proves the zone empty.
+    """
+    return any(condition_proves_empty(zone["columns"].get(condition["name"]), condition) for condition in filters)
+
+async def store_zone_map(zone_map: dict):
+    try:
+        await db["zone_maps"].insert_one(zone_map)
+    except Exception as e:
+        logging.error(f"Error storing zone map of repository {zone_map['repository']}: {e}")
+
+class ZonePlan:
+    """
+    Processing batches whose records all lie in zones proven empty by the filter. Batch b holds the records with
+    index (b - 1) * batch_size to b * batch_size - 1 in _id order, which the zone counts locate without reading them:
+    record ids are made from the ordinals, so the zones of the import chunks are consecutive in _id order.
+    """
+
+    def __init__(self, repository: dict, zones: List[dict], filters: List[dict], batch_size: int):
+        self.repository_id = ObjectId(repository["_id"])
+        self.records_collection = db[get_records_collection_name(repository)]
+        self.zones = zones
+        self.batch_size = batch_size
+        counts = np.asarray([zone["count"] for zone in zones], dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+        self.empty = np.asarray([zone_proves_empty(zone, filters) for zone in zones], dtype=bool)
+
+    def get_zone_index(self, record_index: int) -> int:
+        return int(np.searchsorted(self.starts, record_index, side="right") - 1)
+
+    def is_batch_empty(self, batch_number: int) -> bool:
+        first_index = (batch_number - 1) * self.batch_size
+        last_index = min(batch_number * self.batch_size, int(self.starts[-1])) - 1
+        if first_index > last_index:
+            return False
+        return bool(self.empty[self.get_zone_index(first_index):self.get_zone_index(last_index) + 1].all())
+
+    def get_batch_size(self, batch_number: int) -> int:
+        first_index = (batch_number - 1) * self.batch_size
+        last_index = min(batch_number * self.batch_size, int(self.starts[-1])) - 1
+        return max(last_index - first_index + 1, 0)
+
+    async def get_batch_last_id(self, batch_number: int) -> Any:
+        """
+        Get the _id of the last record of a batch, the keyset position the next batch starts after.
+        """
+        last_index = min(batch_number * self.batch_size, int(self.starts[-1])) - 1
+        zone = self.zones[self.get_zone_index(last_index)]
+        offset = last_index - int(self.starts[self.get_zone_index(last_index)])
+        if offset == zone["count"] - 1:
+            return zone["last_id"]
+        record = await self.records_collection.find({"repository": self.repository_id, "_id": {"$gte": zone["first_id"]}}, {"_id": 1}).sort("_id", 1).skip(offset).limit(1).to_list(length=1)
+        return record[0]["_id"]
+
+async def get_zone_plan(repository_id: str, processes: List[Any], actions, batch_size: int) -> Optional[ZonePlan]:
+    """
+    Get the zone plan of a run when it filters and the zone maps of the last import are still valid: any record write
+    or type change unsets the zone_maps_import_id of the repository.
+    """
+    if not ZONE_MAPS_ENABLED or "filter" not in actions:
+        return None
+    filter_process = next((process for process in processes if process["task_process"] == "filter"), None)
+    if filter_process is None or len(filter_process["parameters"]) == 0:
+        return None
+    repository = await db["repositories"].find_one({"_id": ObjectId(repository_id)}, {"zone_maps_import_id": 1, "current_data_size": 1, "records_layout": 1})
+    if repository.get("zone_maps_import_id") is None:
+        return None
+    zones = await db["zone_maps"].find({"repository": ObjectId(repository_id), "import_id": repository["zone_maps_import_id"]}).sort("first_id", 1).to_list(length=None)
+    if len(zones) == 0 or sum(zone["count"] for zone in zones) != repository["current_data_size"]:
+        return None
+    zone_plan = ZonePlan(repository, zones, filter_process["parameters"], batch_size)
+    logging.info(f"Zone maps prove {int(zone_plan.empty.sum())} of {len(zones)} zones empty for process_id {filter_process['process_id']}")
+
+    return zone_plan
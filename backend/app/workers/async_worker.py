@@ -1,18 +1,52 @@
 import asyncio
 from app.logging_config import *
-from app.database import db
+from app.database import db, client
 from app.utils.records_utils import delete_repository_related_data, store_repository_records, change_parameters_type
 from app.utils.validation_utils import init_validation
-from app.utils.processing_utils import start_process, prepare_cron_initiated_processes, reset_processes
+from app.utils.processing_utils import start_process, process_batch_range, gather_process_results, prepare_cron_initiated_processes, reset_processes
+from app.utils.jobs_utils import claim_job, renew_job_lease, complete_job, fail_job, release_job, requeue_expired_jobs, get_queue_latency, store_job_metrics
+from pymongo.errors import PyMongoError
+from datetime import datetime
 from dotenv import load_dotenv
+import multiprocessing as mp
+import signal
+import socket
+import uuid
 import os
 
+def parse_job_concurrency_limits(value: str) -> dict:
+  """
+  Parse job concurrency limits with the format "job_type:limit,job_type:limit".
+  """
+  limits = {}
+  for item in value.split(","):
+    if ":" not in item:
+      continue
+    job_type, limit = item.split(":", 1)
+    limits[job_type.strip()] = max(int(limit), 1)
+  return limits
+
 load_dotenv()
+CPU_COUNT = mp.cpu_count()
 WORKER_SECONDS_TIME =  int(os.getenv("WORKER_SECONDS_TIME", "10"))
+WORKER_MIN_POLL_SECONDS = float(os.getenv("WORKER_MIN_POLL_SECONDS", "0.5"))
+WORKER_USE_CHANGE_STREAM = bool(os.getenv("WORKER_USE_CHANGE_STREAM", "true").lower() == "true")
+WORKER_MAX_CONCURRENT_JOBS = int(os.getenv("WORKER_MAX_CONCURRENT_JOBS", str(CPU_COUNT * 2)))
+# Processing metrics sample the resources of the whole worker process (or its cgroup), so by default a worker runs
+# one CPU bound job at a time and scales out with more worker processes
+WORKER_CPU_BUDGET = int(os.getenv("WORKER_CPU_BUDGET", "1"))
+WORKER_SHUTDOWN_TIMEOUT = int(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "0"))  # 0 waits for in-flight jobs without limit
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", str(max(JOB_LEASE_SECONDS // 3, 1))))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_REQUEUE_SECONDS = int(os.getenv("JOB_REQUEUE_SECONDS", "30"))
 
 # Map job type to the actual async function
 JOB_DISPATCH = {
     "start_process": start_process,
+    "process_batch_range": process_batch_range,
+    "gather_process_results": gather_process_results,
     "delete_repository": delete_repository_related_data,
     "store_repository_records": store_repository_records,
     "validate_processes": init_validation,
@@ -21,38 +55,253 @@ JOB_DISPATCH = {
     "reset_processes": reset_processes
 }
 
-async def get_next_job():
-    job = await db["jobs"].find_one_and_delete({})
+# Maximum number of jobs of each type running at the same time, overridable with JOB_CONCURRENCY_LIMITS.
+# Processing jobs run one at a time per worker: monitor_resources measures the CPU and memory of the whole worker
+# process, so concurrent processing jobs would record each other's usage in their metrics.
+JOB_CONCURRENCY_LIMITS = {
+    "start_process": 1,
+    "process_batch_range": 1,
+    "gather_process_results": 2,
+    "delete_repository": 8,
+    "store_repository_records": 2,
+    "validate_processes": 1,
+    "change_parameters_type": 2,
+    "prepare_cron_processes": 1,
+    "reset_processes": 8,
+    **parse_job_concurrency_limits(os.getenv("JOB_CONCURRENCY_LIMITS", ""))
+}
+
+# Job types that keep the CPU busy, together they can not use more than WORKER_CPU_BUDGET slots. Imports, type
+# changes and gathering are included so they do not run next to a processing job whose metrics the monitor samples
+CPU_BOUND_JOB_TYPES = {"start_process", "process_batch_range", "validate_processes", "gather_process_results", "store_repository_records", "change_parameters_type"}
+
+async def get_next_job(excluded_types: list):
+    job = await claim_job(WORKER_ID, JOB_LEASE_SECONDS, excluded_types)
     return job
 
-async def main():
+def get_saturated_job_types(job_semaphores: dict, cpu_semaphore: asyncio.Semaphore) -> list:
+  """
+  Get the job types that can not be started now because their concurrency limit is reached.
+  """
+  saturated = [job_type for job_type, semaphore in job_semaphores.items() if semaphore.locked()]
+  if cpu_semaphore.locked():
+    saturated += [job_type for job_type in CPU_BOUND_JOB_TYPES if job_type not in saturated]
+  return saturated
+
+def get_job_slots(job_type: str, worker_semaphore: asyncio.Semaphore, job_semaphores: dict, cpu_semaphore: asyncio.Semaphore) -> list:
   """
-  Main function to continuously poll for jobs and process them.
-  This function runs indefinitely, checking for new jobs every second.
+  Get the semaphores a job of the given type holds while it runs.
+  """
+  slots = [worker_semaphore]
+  if job_type in job_semaphores:
+    slots.append(job_semaphores[job_type])
+  if job_type in CPU_BOUND_JOB_TYPES:
+    slots.append(cpu_semaphore)
+  return slots
+
+async def open_jobs_change_stream():
+  """
+  Open a change stream on the jobs collection so the worker wakes up as soon as a job is inserted or re-queued.
+  Change streams are only available on replica sets and sharded clusters, None is returned otherwise.
+  """
+  if not WORKER_USE_CHANGE_STREAM:
+    return None
+  try:
+    hello = await client.admin.command("hello")
+    if "setName" not in hello and hello.get("msg") != "isdbgrid":
+      logging.info("MongoDB is not a replica set, the worker will poll the jobs queue.")
+      return None
+    pipeline = [{"$match": {"$or": [{"operationType": "insert"}, {"updateDescription.updatedFields.status": "queued"}]}}]
+    stream = db["jobs"].watch(pipeline, max_await_time_ms=WORKER_SECONDS_TIME * 1000)
+    logging.info("Listening for new jobs through a change stream.")
+    return stream
+  except PyMongoError as e:
+    logging.warning(f"Jobs change stream not available: {e}. The worker will poll the jobs queue.")
+    return None
+
+class JobsListener:
+  """
+  Wakes the worker when new jobs may be available.
+  With a change stream it wakes on the next insert (or after WORKER_SECONDS_TIME), otherwise after the poll interval.
+  The pending wait is kept between calls, so a change stream read is never abandoned while it is in progress.
+  """
+  def __init__(self, stream):
+    self.stream = stream
+    self.pending = None
+
+  def next_wakeup(self, poll_interval: float) -> asyncio.Future:
+    if self.pending is None or self.pending.done():
+      self.pending = asyncio.ensure_future(self.wait(poll_interval))
+    return self.pending
+
+  async def wait(self, poll_interval: float):
+    if self.stream is not None:
+      try:
+        await self.stream.try_next()
+        return
+      except PyMongoError as e:
+        logging.warning(f"Jobs change stream failed: {e}. Falling back to polling.")
+        await self.stream.close()
+        self.stream = None
+    await asyncio.sleep(poll_interval)
+
+  async def close(self):
+    if self.pending is not None and not self.pending.done():
+      self.pending.cancel()
+    if self.stream is not None:
+      await self.stream.close()
+
+async def keep_job_lease(job, work: asyncio.Task):
+  """
+  Renew the lease of a running job every JOB_HEARTBEAT_SECONDS while it runs. When the lease is lost the job was
+  (or will be) handed to another worker, so its work is cancelled instead of running twice.
+  Returns True when the lease was lost.
   """
-  logging.info("Async worker started, waiting for jobs...")  
   while True:
-    job = await get_next_job()
+    await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+    try:
+      if not await renew_job_lease(job["_id"], WORKER_ID, JOB_LEASE_SECONDS):
+        logging.warning(f"Lease of job {job['_id']} was lost, cancelling it so it only runs on the worker that claims it again.")
+        work.cancel()
+        return True
+    except PyMongoError as e:
+      logging.error(f"Error renewing the lease of job {job['_id']}: {e}")
+
+async def run_job(job):
+  """
+  Execute a claimed job while renewing its lease and store its queue latency and run time metrics.
+  Finished jobs are removed from the queue, failed jobs are kept with status failed.
+  """
+  job_type = job.get("type")
+  task_func = JOB_DISPATCH.get(job_type)
+  if not task_func:
+    logging.error(f"Unknown job type: {job_type}")
+    await fail_job(job["_id"], WORKER_ID, f"Unknown job type: {job_type}")
+    return
+
+  started_at = datetime.now()
+  queue_latency = get_queue_latency(job, started_at)
+  error = None
+  # Pass job["data"] as arguments, adjust as needed
+  if isinstance(job.get("data"), dict):
+    work = asyncio.create_task(task_func(**job["data"]))
+  elif job.get("data") is not None:
+    work = asyncio.create_task(task_func(job["data"]))
+  else:
+    work = asyncio.create_task(task_func())
+  heartbeat = asyncio.create_task(keep_job_lease(job, work))
+  try:
+    await work
+  except asyncio.CancelledError:
+    if not (heartbeat.done() and not heartbeat.cancelled() and heartbeat.result()):
+      raise
+    logging.warning(f"Job {job['_id']} of type {job_type} was cancelled after losing its lease")
+    return
+  except Exception as e:
+    error = str(e)
+    logging.error(f"Error processing job {job}: {e}")
+  finally:
+    heartbeat.cancel()
+
+  run_time = int((datetime.now() - started_at).total_seconds() * 1000)
+  logging.info(f"Job {job['_id']} of type {job_type} (attempt {job.get('attempts')}) waited {queue_latency} ms in queue and ran for {run_time} ms")
+  try:
+    if error is None:
+      stored = await complete_job(job["_id"], WORKER_ID, job.get("attempts"))
+    else:
+      stored = await fail_job(job["_id"], WORKER_ID, error, job.get("attempts"))
+    if not stored:
+      logging.warning(f"Lease of job {job['_id']} was lost before it finished, its final status is left to the worker that claimed it again")
+  except PyMongoError as e:
+    logging.error(f"Error storing the final status of job {job['_id']}: {e}")
+  await store_job_metrics(job_type, queue_latency, run_time, error is not None)
+
+async def run_job_in_slots(job, slots: list):
+  try:
+    await run_job(job)
+  finally:
+    for slot in slots:
+      slot.release()
+
+async def requeue_expired_jobs_periodically(stop_event: asyncio.Event):
+  """
+  Re-queue jobs whose lease expired every JOB_REQUEUE_SECONDS until the worker stops.
+  """
+  while not stop_event.is_set():
+    try:
+      await requeue_expired_jobs(JOB_MAX_ATTEMPTS)
+    except PyMongoError as e:
+      logging.error(f"Error re-queuing jobs with expired leases: {e}")
+    try:
+      await asyncio.wait_for(stop_event.wait(), timeout=JOB_REQUEUE_SECONDS)
+    except asyncio.TimeoutError:
+      pass
+
+def register_shutdown_signals(stop_event: asyncio.Event):
+  loop = asyncio.get_running_loop()
+  for sig in (signal.SIGINT, signal.SIGTERM):
+    try:
+      loop.add_signal_handler(sig, stop_event.set)
+    except NotImplementedError:
+      # Signal handlers are not supported by the event loop on Windows
+      pass
+
+async def main():
+  """
+  Main function to process jobs.
+  Jobs are started concurrently as long as the worker, their job type and, for CPU bound jobs, the CPU budget
+  have free slots. When the queue is empty the worker waits for new jobs through a change stream when available,
+  otherwise it polls with an interval that backs off from WORKER_MIN_POLL_SECONDS up to WORKER_SECONDS_TIME.
+  Jobs are claimed with a lease renewed while they run, so several workers on one or many hosts can share the
+  queue and the jobs of a crashed worker are re-queued once their lease expires.
+  On SIGINT/SIGTERM no new jobs are claimed and the in-flight jobs are finished before exiting.
+  """
+  logging.info(f"Async worker {WORKER_ID} started, waiting for jobs...")
+  stop_event = asyncio.Event()
+  register_shutdown_signals(stop_event)
+  worker_semaphore = asyncio.Semaphore(WORKER_MAX_CONCURRENT_JOBS)
+  cpu_semaphore = asyncio.Semaphore(WORKER_CPU_BUDGET)
+  job_semaphores = {job_type: asyncio.Semaphore(limit) for job_type, limit in JOB_CONCURRENCY_LIMITS.items()}
+  listener = JobsListener(await open_jobs_change_stream())
+  stop_waiter = asyncio.ensure_future(stop_event.wait())
+  requeuer = asyncio.create_task(requeue_expired_jobs_periodically(stop_event))
+  in_flight = {}
+  poll_interval = WORKER_MIN_POLL_SECONDS
+
+  while not stop_event.is_set():
+    job = None
+    if not worker_semaphore.locked():
+      job = await get_next_job(get_saturated_job_types(job_semaphores, cpu_semaphore))
     if job:
       logging.info(f"Fetched job: {job}")
-      job_type = job.get("type")
-      task_func = JOB_DISPATCH.get(job_type)
-      if task_func:
-        try:
-          # Pass job["data"] as arguments, adjust as needed
-          if isinstance(job.get("data"), dict):
-              await task_func(**job["data"])
-          elif job.get("data") is not None:
-              await task_func(job["data"])
-          else:
-              await task_func()
-        except Exception as e:
-          logging.error(f"Error processing job {job}: {e}")
-      else:
-        logging.error(f"Unknown job type: {job_type}")
-    await asyncio.sleep(WORKER_SECONDS_TIME)
-  
+      slots = get_job_slots(job.get("type"), worker_semaphore, job_semaphores, cpu_semaphore)
+      for slot in slots:
+        await slot.acquire()
+      task = asyncio.create_task(run_job_in_slots(job, slots))
+      in_flight[task] = job
+      task.add_done_callback(lambda finished_task: in_flight.pop(finished_task, None))
+      poll_interval = WORKER_MIN_POLL_SECONDS
+      continue
+    # Wake up on new jobs, on a finished job freeing a slot or on shutdown
+    wakeup = listener.next_wakeup(poll_interval)
+    await asyncio.wait({wakeup, stop_waiter, *in_flight}, return_when=asyncio.FIRST_COMPLETED)
+    if wakeup.done():
+      poll_interval = min(poll_interval * 2, WORKER_SECONDS_TIME)
+
+  logging.info(f"Async worker stopping, waiting for {len(in_flight)} in-flight jobs to finish...")
+  await listener.close()
+  await requeuer
+  if in_flight:
+    _, pending = await asyncio.wait(set(in_flight), timeout=WORKER_SHUTDOWN_TIMEOUT or None)
+    for task in pending:
+      job = in_flight.get(task)
+      task.cancel()
+      if job is not None:
+        await release_job(job["_id"], WORKER_ID)
+    if pending:
+      logging.error(f"{len(pending)} jobs did not finish within {WORKER_SHUTDOWN_TIMEOUT} seconds, they were cancelled and given back to the queue.")
+
   logging.info("Async worker stopped.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""
+Compare the record encoding paths of the CSV importer in rows per second and peak RSS.
+
+  python -m benchmarks.ingest_benchmark path/to/file.csv
+  python -m benchmarks.ingest_benchmark path/to/file.csv --generate 20000000 --columns 12
+
+Each path runs in its own process so their peak RSS do not mix. Only parsing and BSON encoding are measured, the
+inserts depend on the MongoDB deployment.
+"""
+from bson.objectid import ObjectId
+from datetime import datetime
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import argparse
+import resource
+import time
+import bson
+import os
+
+def generate_csv(path: str, rows: int, columns: int, chunk_size: int):
+    rng = np.random.default_rng(0)
+    with open(path, "w") as f:
+        for start in range(0, rows, chunk_size):
+            size = min(chunk_size, rows - start)
+            chunk = pd.DataFrame({f"column_{index}": rng.normal(size=size) if index % 3 == 0 else rng.integers(0, 1000, size=size) if index % 3 == 1 else rng.choice(["alpha", "beta", "gamma", None], size=size) for index in range(columns)})
+            chunk.to_csv(f, index=False, header=start == 0)
+
+def run_path(path: str, csv_path: str, chunk_size: int, results: mp.Queue):
+    from app.utils.records_utils import build_records
+    from app.utils.bson_utils import encode_records, new_record_ids_prefix
+
+    repository_id = ObjectId()
+    now = datetime.now()
+    ids_prefix = new_record_ids_prefix(now)
+    rows = 0
+    encoded_bytes = 0
+    start_time = time.perf_counter()
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        if path == "dict":
+            # What insert_many does with the built dicts
+            documents = [bson.encode(record) for record in build_records(chunk, repository_id, rows, now, ids_prefix)]
+            encoded_bytes += sum(len(document) for document in documents)
+        else:
+            documents = encode_records(chunk, repository_id, rows, now, ids_prefix)
+            encoded_bytes += sum(len(document.raw) for document in documents)
+        rows += len(chunk)
+    elapsed_time = time.perf_counter() - start_time
+    results.put({"path": path, "rows": rows, "seconds": elapsed_time, "rows_per_second": rows / elapsed_time if elapsed_time > 0 else 0, "encoded_mb": encoded_bytes / (1024 * 1024), "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the record encoding paths of the CSV importer.")
+    parser.add_argument("csv_path")
+    parser.add_argument("--paths", nargs="+", default=["dict", "bson"], choices=["dict", "bson"])
+    parser.add_argument("--chunk-size", type=int, default=int(os.getenv("RECORDS_BATCH_SIZE", "5000")))
+    parser.add_argument("--generate", type=int, default=0, help="Write a synthetic CSV of this many rows to csv_path first")
+    parser.add_argument("--columns", type=int, default=12)
+    args = parser.parse_args()
+
+    if args.generate > 0:
+        generate_csv(args.csv_path, args.generate, args.columns, 100000)
+
+    print(f"{args.csv_path}: {os.path.getsize(args.csv_path) / (1024 * 1024):.1f} MB")
+    context = mp.get_context("spawn")
+    for path in args.paths:
+        results = context.Queue()
+        process = context.Process(target=run_path, args=(path, args.csv_path, args.chunk_size, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print(f"{result['path']:>5}: {result['rows']} rows in {result['seconds']:.2f}s, {result['rows_per_second']:.0f} rows/s, {result['encoded_mb']:.1f} MB of BSON, peak RSS {result['peak_rss_mb']:.1f} MB")
+
+if __name__ == "__main__":
+    main()
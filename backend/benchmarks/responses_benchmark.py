@@ -0,0 +1,74 @@
+"""
+Compare the JSON serialization of the records and processes endpoints with bson.json_util and orjson in response
+time and CPU time.
+
+  python -m benchmarks.responses_benchmark
+  python -m benchmarks.responses_benchmark --records 10000 --processes 50 --measurements 2000
+
+The documents are synthetic but shaped as the endpoints return them: records pages with ObjectIds and datetimes, and
+processes with their metrics measurements and results bitmap. Both outputs are checked to decode to the same JSON.
+"""
+from bson import json_util
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
+from app.utils.responses_utils import MongoJSONResponse
+import argparse
+import random
+import json
+import time
+
+def build_records_page(size: int) -> dict:
+    repository_id = ObjectId()
+    now = datetime.now()
+    items = [
+        {"_id": ObjectId(), "repository": repository_id, "data": {"name": f"item {index}", "category": random.choice(["alpha", "beta", "gamma"]), "price": round(random.uniform(0, 1000), 2), "quantity": random.randint(0, 100)}, "ordinal": index, "created_at": now, "updated_at": now, "version": 1}
+        for index in range(size)
+    ]
+    return {"totalItems": size * 10, "totalPages": 10, "page": 1, "nextAfter": str(items[-1]["_id"]), "items": items}
+
+def build_processes_page(size: int, measurements: int) -> dict:
+    repository_id = ObjectId()
+    process_id = ObjectId()
+    start = datetime.now()
+    items = []
+    for index in range(size):
+        metrics = [{"timestamp": start + timedelta(milliseconds=250 * step), "cpu": random.uniform(0, 100), "memory": random.uniform(0, 4096), "io_read": random.randint(0, 10 ** 9), "io_write": random.randint(0, 10 ** 9)} for step in range(measurements)]
+        items.append({"_id": ObjectId(), "process_id": process_id, "repository": repository_id, "task_process": random.choice(["filter", "group", "aggregation"]), "optimized": index % 2 == 0, "status": "completed", "iteration": 1, "trigger_type": "user", "parameters": [{"name": "price", "operator": ">", "value": "10"}], "metrics": metrics, "results_bitmap": Binary(random.randbytes(4096)), "created_at": start, "updated_at": start})
+    return {"totalItems": size, "totalPages": 1, "page": 1, "items": items}
+
+def measure(serialize, content: dict, iterations: int) -> dict:
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    for _ in range(iterations):
+        body = serialize(content)
+    wall_time = (time.perf_counter() - start_time) / iterations
+    cpu_time = (time.process_time() - start_cpu) / iterations
+    return {"wall_ms": wall_time * 1000, "cpu_ms": cpu_time * 1000, "bytes": len(body)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the JSON serialization of the API responses.")
+    parser.add_argument("--records", type=int, default=100, help="Records per page")
+    parser.add_argument("--processes", type=int, default=10, help="Processes per page")
+    parser.add_argument("--measurements", type=int, default=500, help="Metrics measurements per process")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    serializers = {
+        "json_util": lambda content: json_util.dumps(content).encode("utf-8"),
+        "orjson": lambda content: MongoJSONResponse(content=content).body,
+    }
+    pages = {
+        "records": build_records_page(args.records),
+        "processes": build_processes_page(args.processes, args.measurements),
+    }
+    for endpoint, content in pages.items():
+        if json.loads(serializers["json_util"](content)) != json.loads(serializers["orjson"](content)):
+            print(f"{endpoint}: the outputs differ")
+        results = {name: measure(serialize, content, args.iterations) for name, serialize in serializers.items()}
+        for name, result in results.items():
+            print(f"{endpoint:>9} {name:>9}: {result['wall_ms']:.2f} ms, {result['cpu_ms']:.2f} ms CPU, {result['bytes'] / 1024:.1f} KB")
+        print(f"{endpoint:>9} speedup: {results['json_util']['wall_ms'] / results['orjson']['wall_ms']:.1f}x")
+
+if __name__ == "__main__":
+    main()
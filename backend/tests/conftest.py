@@ -0,0 +1,17 @@
+from mongomock_motor import AsyncMongoMockClient
+import pytest
+
+@pytest.fixture
+def mock_db(monkeypatch):
+    """
+    In-memory MongoDB database replacing the db of the modules a test exercises. It runs the queries and updates of
+    those modules, except the ones using server variables like $$NOW.
+    """
+    database = AsyncMongoMockClient()["big_data_optimizer_test"]
+
+    def use_in(*modules):
+        for module in modules:
+            monkeypatch.setattr(module, "db", database)
+        return database
+
+    return use_in
@@ -0,0 +1,59 @@
+"""
+Users of validated tokens are cached for AUTH_CACHE_TTL_SECONDS, never past the token expiration, the least recently
+used first evicted and dropped by invalidate_user_cache.
+"""
+from collections import OrderedDict
+from app.utils import auth_utils
+import pytest
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth_utils, "time", clock)
+    monkeypatch.setattr(auth_utils, "users_cache", OrderedDict())
+    monkeypatch.setattr(auth_utils, "AUTH_CACHE_TTL_SECONDS", 30)
+    monkeypatch.setattr(auth_utils, "AUTH_CACHE_MAX_SIZE", 2)
+    return clock
+
+def user(username: str) -> dict:
+    return {"username": username, "role": "admin"}
+
+def test_cached_users_expire_after_the_ttl(clock):
+    auth_utils.cache_user("token", user("alice"))
+    clock.now += 29
+    assert auth_utils.get_cached_user("token") == user("alice")
+    clock.now += 1
+    assert auth_utils.get_cached_user("token") is None
+
+def test_cached_users_expire_with_their_token(clock):
+    auth_utils.cache_user("token", user("alice"), clock.now + 10)
+    clock.now += 10
+    assert auth_utils.get_cached_user("token") is None
+    auth_utils.cache_user("expired", user("alice"), clock.now - 1)
+    assert "expired" not in auth_utils.users_cache
+
+def test_least_recently_used_tokens_are_evicted(clock):
+    auth_utils.cache_user("first", user("alice"))
+    auth_utils.cache_user("second", user("bob"))
+    assert auth_utils.get_cached_user("first") is not None
+    auth_utils.cache_user("third", user("carol"))
+    assert list(auth_utils.users_cache) == ["first", "third"]
+
+def test_invalidation_drops_the_tokens_of_a_user(clock):
+    auth_utils.cache_user("first", user("alice"))
+    auth_utils.cache_user("second", user("bob"))
+    auth_utils.invalidate_user_cache("alice")
+    assert auth_utils.get_cached_user("first") is None
+    assert auth_utils.get_cached_user("second") == user("bob")
+    auth_utils.invalidate_user_cache()
+    assert len(auth_utils.users_cache) == 0
@@ -0,0 +1,17 @@
+"""
+Unsigned columns are encoded as PyMongo encodes their values, and the ones above INT64_MAX are not wrapped around.
+"""
+from app.utils.bson_utils import INT64_MAX, encode_column, encode_element
+import numpy as np
+import pandas as pd
+import pytest
+
+def test_unsigned_values_are_encoded_as_pymongo_does():
+    values = [2 ** 31, 2 ** 40, INT64_MAX]
+    assert encode_column("value", pd.Series(values, dtype=np.uint64)) == [encode_element("value", value) for value in values]
+
+def test_unsigned_values_above_int64_fail_as_in_pymongo():
+    with pytest.raises(OverflowError):
+        encode_element("value", INT64_MAX + 1)
+    with pytest.raises(OverflowError):
+        encode_column("value", pd.Series([1, INT64_MAX + 1], dtype=np.uint64))
@@ -0,0 +1,27 @@
+"""
+Bucket row ids grow with the ordinals, so find_bucket locates every row by the last bucket starting at or before it.
+"""
+from datetime import datetime
+from bson.objectid import ObjectId
+from app.utils import buckets_utils
+from app.utils.bson_utils import new_record_ids_prefix
+import asyncio
+import pandas as pd
+
+REPOSITORY_ID = ObjectId()
+WRAPPING_ORDINAL = 2 ** 24 - 3
+
+def test_find_bucket_locates_rows_past_a_counter_wrap(mock_db):
+    db = mock_db()
+    chunk = pd.DataFrame({"price": range(7)})
+    buckets = buckets_utils.build_buckets(chunk, REPOSITORY_ID, WRAPPING_ORDINAL, datetime.now(), 3, new_record_ids_prefix(datetime.now()))
+    ids = [record_id for bucket in buckets for record_id in bucket["ids"]]
+    assert ids == sorted(ids)
+
+    async def scenario():
+        await db["record_buckets"].insert_many(buckets)
+        for index, record_id in enumerate(ids):
+            bucket, position = await buckets_utils.find_bucket(db["record_buckets"], REPOSITORY_ID, record_id)
+            assert bucket["columns"]["price"][position] == index
+
+    asyncio.run(scenario())
@@ -0,0 +1,71 @@
+"""
+Cron iterations are chained: a failed iteration, or a run whose batch range keeps failing, still finishes and
+enqueues the next iteration.
+"""
+from bson.objectid import ObjectId
+from app.utils import processing_utils, jobs_utils
+import asyncio
+import pytest
+
+PROCESS_ID = ObjectId()
+REPOSITORY_ID = ObjectId()
+
+async def insert_run(db):
+    await db["repositories"].insert_one({"_id": REPOSITORY_ID, "current_data_size": 10})
+    for iteration in [1, 2]:
+        await db["processes"].insert_many([
+            {"process_id": PROCESS_ID, "repository": REPOSITORY_ID, "task_process": task_process, "optimized": optimized, "trigger_type": "system", "iteration": iteration, "status": "in_progress", "cron_enqueued": iteration == 1}
+            for task_process in ["filter"] for optimized in [True, False]
+        ])
+
+async def get_jobs(db, job_type: str) -> list:
+    return await db["jobs"].find({"type": job_type}).to_list(length=None)
+
+async def failing_range(*args, **kwargs):
+    raise ValueError("batch failed")
+
+def test_failed_iteration_enqueues_the_next_one(mock_db, monkeypatch):
+    db = mock_db(processing_utils, jobs_utils)
+    monkeypatch.setattr(processing_utils, "run_batch_range", failing_range)
+
+    async def scenario():
+        await insert_run(db)
+        with pytest.raises(ValueError):
+            await processing_utils.start_process(str(PROCESS_ID), str(REPOSITORY_ID), ["filter"], 1, "system")
+        jobs = await get_jobs(db, "start_process")
+        assert [job["data"]["iteration"] for job in jobs] == [2]
+        assert await db["processes"].count_documents({"iteration": 1, "status": "failed"}) == 2
+        assert await db["processes"].count_documents({"iteration": 2, "status": "in_progress"}) == 2
+
+        # Finishing the failed iteration again does not enqueue the next one twice
+        await processing_utils.enqueue_next_cron_iteration(str(PROCESS_ID), str(REPOSITORY_ID), ["filter"], 1, "system")
+        assert len(await get_jobs(db, "start_process")) == 1
+
+    asyncio.run(scenario())
+
+def test_exhausted_batch_range_finishes_the_run_and_enqueues_the_next_iteration(mock_db, monkeypatch):
+    db = mock_db(processing_utils, jobs_utils)
+    monkeypatch.setattr(processing_utils, "run_batch_range", failing_range)
+    monkeypatch.setattr(processing_utils, "PROCESS_RANGE_MAX_ATTEMPTS", 2)
+
+    async def scenario():
+        await insert_run(db)
+        await db["process_shards"].insert_one({**processing_utils.get_run_query(str(PROCESS_ID), 1, "system"), "total_ranges": 2, "completed_ranges": [1], "failed_ranges": []})
+        batch_range = {"process_id": str(PROCESS_ID), "repository_id": str(REPOSITORY_ID), "actions": ["filter"], "iteration": 1, "trigger_type": "system", "first_batch": 21, "last_batch": 40}
+
+        with pytest.raises(ValueError):
+            await processing_utils.process_batch_range(**batch_range)
+        assert [job["data"]["first_batch"] for job in await get_jobs(db, "process_batch_range")] == [21]
+        assert await get_jobs(db, "gather_process_results") == []
+
+        with pytest.raises(ValueError):
+            await processing_utils.process_batch_range(**batch_range)
+        assert len(await get_jobs(db, "process_batch_range")) == 1
+        assert len(await get_jobs(db, "gather_process_results")) == 1
+        assert await db["processes"].count_documents({"iteration": 1, "status": "failed"}) == 2
+
+        await processing_utils.gather_process_results(str(PROCESS_ID), str(REPOSITORY_ID), ["filter"], 1, "system")
+        assert await db["process_shards"].count_documents({}) == 0
+        assert [job["data"]["iteration"] for job in await get_jobs(db, "start_process")] == [2]
+
+    asyncio.run(scenario())
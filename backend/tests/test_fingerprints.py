@@ -0,0 +1,46 @@
+"""
+Fingerprints and aggregation comparisons of values on both sides of a rounding boundary, as float noise between
+the engines produces them.
+"""
+from bson.objectid import ObjectId
+from app.utils.fingerprint_utils import aggregation_fingerprint, group_fingerprint
+from app.utils.equivalence_utils import compare_aggregation_results, compare_batch_results, values_close, AGGREGATION_ABSOLUTE_TOLERANCE
+from app.utils.validation_utils import validate_aggregations
+
+BELOW_BOUNDARY = 0.12345649999999
+ABOVE_BOUNDARY = 0.12345650000001
+
+def aggregation(mean: float) -> list:
+    return [{"property": "price", "mean": mean, "count": 3}]
+
+def test_batch_values_around_a_boundary_are_equal():
+    assert values_close(BELOW_BOUNDARY, ABOVE_BOUNDARY)
+    comparison = compare_batch_results({"aggregation": {"results": aggregation(BELOW_BOUNDARY)}}, {"aggregation": {"results": aggregation(ABOVE_BOUNDARY)}})
+    assert comparison == {"aggregation": None}
+
+def test_aggregation_fingerprint_ignores_values_around_a_boundary():
+    assert aggregation_fingerprint(aggregation(BELOW_BOUNDARY)) == aggregation_fingerprint(aggregation(ABOVE_BOUNDARY))
+
+def test_aggregation_fingerprint_covers_properties_and_operations():
+    assert aggregation_fingerprint(aggregation(BELOW_BOUNDARY)) != aggregation_fingerprint([{"property": "price", "sum": BELOW_BOUNDARY, "count": 3}])
+    assert aggregation_fingerprint(aggregation(BELOW_BOUNDARY)) != aggregation_fingerprint([{"property": "quantity", "mean": BELOW_BOUNDARY, "count": 3}])
+
+def test_aggregation_values_around_a_boundary_are_close():
+    assert compare_aggregation_results(aggregation(BELOW_BOUNDARY), aggregation(ABOVE_BOUNDARY)) is None
+    assert compare_aggregation_results(aggregation(BELOW_BOUNDARY), aggregation(BELOW_BOUNDARY + 10 * AGGREGATION_ABSOLUTE_TOLERANCE)) is not None
+
+def test_group_fingerprint_matches_integer_and_float_keys():
+    assert group_fingerprint({1: [1, 2], 2: [3]}) == group_fingerprint({1.0: [2, 1], 2.0: [3]})
+
+def test_validate_aggregations_around_a_boundary():
+    processes = [{"_id": ObjectId()} for _ in range(3)]
+    batch_aggregations = {
+        1: [
+            {"process_item_id": str(processes[0]["_id"]), "results": aggregation(BELOW_BOUNDARY)},
+            {"process_item_id": str(processes[1]["_id"]), "results": aggregation(ABOVE_BOUNDARY)},
+            {"process_item_id": str(processes[2]["_id"]), "results": aggregation(BELOW_BOUNDARY + 1)}
+        ]
+    }
+    result = validate_aggregations(processes, batch_aggregations)
+    assert result["valid"] == [processes[0]["_id"], processes[1]["_id"]]
+    assert result["invalid"] == [str(processes[2]["_id"])]
@@ -0,0 +1,27 @@
+"""
+Updating a repository with the file it was imported from keeps its records only while they are untouched since the
+import.
+"""
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from app.utils import repositories_utils, uploads_utils, jobs_utils
+import asyncio
+
+REPOSITORY_ID = ObjectId()
+IMPORTED_AT = datetime(2026, 1, 1)
+FILE_SHA256 = "a" * 64
+ADMIN = {"role": "admin"}
+
+async def update_with_imported_file(db, data_updated_at: datetime):
+    await db["repositories"].insert_one({"_id": REPOSITORY_ID, "data_ready": True, "file_sha256": FILE_SHA256, "cluster_key": None, "imported_at": IMPORTED_AT, "data_updated_at": data_updated_at, "parameters": []})
+    await db["uploads"].insert_one({"file_path": "data.csv", "status": "completed", "sha256": FILE_SHA256})
+    await repositories_utils.upsert_repository(str(REPOSITORY_ID), "name", "description", "url", True, "data.csv", None, [], ADMIN, "update")
+    return [job["type"] for job in await db["jobs"].find().to_list(length=None)]
+
+def test_untouched_records_are_kept(mock_db):
+    db = mock_db(repositories_utils, uploads_utils, jobs_utils)
+    assert asyncio.run(update_with_imported_file(db, IMPORTED_AT)) == []
+
+def test_written_records_are_imported_again(mock_db):
+    db = mock_db(repositories_utils, uploads_utils, jobs_utils)
+    assert asyncio.run(update_with_imported_file(db, IMPORTED_AT + timedelta(minutes=1))) == ["store_repository_records"]
@@ -0,0 +1,97 @@
+"""
+Lease handling of the worker on an in-memory MongoDB: jobs are only completed or failed by the worker holding the
+lease of their current attempt, and a job whose lease is lost is cancelled. Lease renewals use $$NOW, which the
+in-memory database does not run, so they are replaced by a fake; test_jobs_lease.py covers them on a real MongoDB.
+"""
+from bson.objectid import ObjectId
+from app.utils import jobs_utils
+from app.utils.jobs_utils import complete_job, fail_job
+from app.workers import async_worker
+import asyncio
+
+async def insert_running_job(db, owner: str = "worker-a", attempts: int = 1, job_type: str = "test_job") -> ObjectId:
+    result = await db["jobs"].insert_one({"type": job_type, "data": {}, "status": "running", "owner": owner, "attempts": attempts})
+    return result.inserted_id
+
+def test_complete_job_requires_the_owner_and_attempt(mock_db):
+    db = mock_db(jobs_utils)
+
+    async def scenario():
+        job_id = await insert_running_job(db, attempts=2)
+        assert not await complete_job(job_id, "worker-b", 2)
+        assert not await complete_job(job_id, "worker-a", 1)
+        assert await db["jobs"].count_documents({"_id": job_id}) == 1
+        assert await complete_job(job_id, "worker-a", 2)
+        assert await db["jobs"].count_documents({"_id": job_id}) == 0
+
+    asyncio.run(scenario())
+
+def test_fail_job_requires_the_owner_and_attempt(mock_db):
+    db = mock_db(jobs_utils)
+
+    async def scenario():
+        job_id = await insert_running_job(db, attempts=2)
+        assert not await fail_job(job_id, "worker-b", "error", 2)
+        assert not await fail_job(job_id, "worker-a", "error", 1)
+        assert (await db["jobs"].find_one({"_id": job_id}))["status"] == "running"
+        assert await fail_job(job_id, "worker-a", "error", 2)
+        job = await db["jobs"].find_one({"_id": job_id})
+        assert job["status"] == "failed" and job["errors"] == "error"
+
+    asyncio.run(scenario())
+
+def test_run_job_cancels_the_job_when_the_lease_is_lost(mock_db, monkeypatch):
+    db = mock_db(jobs_utils)
+    events = []
+    renewals = []
+
+    async def slow_job():
+        try:
+            await asyncio.sleep(30)
+            events.append("finished")
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+
+    async def renew_job_lease(job_id, worker_id, lease_seconds):
+        renewals.append(job_id)
+        # Another worker claimed the job again after the second heartbeat
+        return len(renewals) < 2
+
+    monkeypatch.setitem(async_worker.JOB_DISPATCH, "test_slow_job", slow_job)
+    monkeypatch.setattr(async_worker, "renew_job_lease", renew_job_lease)
+    monkeypatch.setattr(async_worker, "JOB_HEARTBEAT_SECONDS", 0.01)
+
+    async def scenario():
+        job_id = await insert_running_job(db, owner=async_worker.WORKER_ID, job_type="test_slow_job")
+        job = await db["jobs"].find_one({"_id": job_id})
+        await asyncio.wait_for(async_worker.run_job(job), timeout=5)
+        assert events == ["cancelled"]
+        assert len(renewals) == 2
+        # The job is left to the worker that claimed it again
+        assert (await db["jobs"].find_one({"_id": job_id}))["status"] == "running"
+        assert await db["job_metrics"].count_documents({}) == 0
+
+    asyncio.run(scenario())
+
+def test_run_job_completes_the_job_while_the_lease_is_held(mock_db, monkeypatch):
+    db = mock_db(jobs_utils)
+
+    async def quick_job():
+        await asyncio.sleep(0.05)
+
+    async def renew_job_lease(job_id, worker_id, lease_seconds):
+        return True
+
+    monkeypatch.setitem(async_worker.JOB_DISPATCH, "test_quick_job", quick_job)
+    monkeypatch.setattr(async_worker, "renew_job_lease", renew_job_lease)
+    monkeypatch.setattr(async_worker, "JOB_HEARTBEAT_SECONDS", 0.01)
+
+    async def scenario():
+        job_id = await insert_running_job(db, owner=async_worker.WORKER_ID, job_type="test_quick_job")
+        job = await db["jobs"].find_one({"_id": job_id})
+        await asyncio.wait_for(async_worker.run_job(job), timeout=5)
+        assert await db["jobs"].count_documents({"_id": job_id}) == 0
+        assert (await db["job_metrics"].find_one({"_id": "test_quick_job"}))["count"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,113 @@
+"""
+Lease and requeue flow of the jobs queue against a local MongoDB.
+
+  MONGO_URI=mongodb://localhost:27017 python -m pytest tests/test_jobs_lease.py
+
+The tests use their own database and are skipped when no MongoDB answers at MONGO_URI.
+"""
+import os
+
+os.environ["DATABASE_NAME"] = os.getenv("TEST_DATABASE_NAME", "big_data_optimizer_test")
+
+import asyncio
+import pytest
+
+pytest.importorskip("motor")
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from app.config import MONGO_URI
+
+try:
+    MongoClient(MONGO_URI, serverSelectionTimeoutMS=1000).admin.command("ping")
+except PyMongoError:
+    pytest.skip(f"No MongoDB reachable at {MONGO_URI}", allow_module_level=True)
+
+from app.database import db
+from app.utils.jobs_utils import enqueue_job, claim_job, renew_job_lease, complete_job, fail_job, requeue_expired_jobs
+from app.workers import async_worker
+
+# Motor binds its client to the first event loop that uses it, so every test runs on the same loop
+loop = asyncio.new_event_loop()
+
+@pytest.fixture(autouse=True)
+def clean_jobs():
+    loop.run_until_complete(db["jobs"].delete_many({}))
+    yield
+    loop.run_until_complete(db["jobs"].delete_many({}))
+
+async def expire_lease(job_id):
+    await db["jobs"].update_one({"_id": job_id}, [{"$set": {"lease_expires_at": {"$subtract": ["$$NOW", 1000]}}}])
+
+def test_expired_lease_is_requeued_and_only_the_new_owner_completes_it():
+    async def scenario():
+        job_id = await enqueue_job("test_job", {"value": 1})
+        first = await claim_job("worker-a", 60)
+        assert first["_id"] == job_id and first["attempts"] == 1
+        assert await renew_job_lease(job_id, "worker-a", 60)
+
+        await expire_lease(job_id)
+        await requeue_expired_jobs(max_attempts=3)
+        assert (await db["jobs"].find_one({"_id": job_id}))["status"] == "queued"
+        assert not await renew_job_lease(job_id, "worker-a", 60)
+
+        second = await claim_job("worker-b", 60)
+        assert second["_id"] == job_id and second["attempts"] == 2
+        assert not await complete_job(job_id, "worker-a", first["attempts"])
+        assert not await fail_job(job_id, "worker-a", "late failure", first["attempts"])
+        assert (await db["jobs"].find_one({"_id": job_id}))["status"] == "running"
+        assert await complete_job(job_id, "worker-b", second["attempts"])
+        assert await db["jobs"].find_one({"_id": job_id}) is None
+
+    loop.run_until_complete(scenario())
+
+def test_same_worker_does_not_complete_an_earlier_attempt():
+    async def scenario():
+        job_id = await enqueue_job("test_job")
+        first = await claim_job("worker-a", 60)
+        await expire_lease(job_id)
+        await requeue_expired_jobs(max_attempts=3)
+        second = await claim_job("worker-a", 60)
+        assert not await complete_job(job_id, "worker-a", first["attempts"])
+        assert await complete_job(job_id, "worker-a", second["attempts"])
+
+    loop.run_until_complete(scenario())
+
+def test_expired_lease_fails_after_max_attempts():
+    async def scenario():
+        job_id = await enqueue_job("test_job")
+        for _ in range(2):
+            await claim_job("worker-a", 60)
+            await expire_lease(job_id)
+            await requeue_expired_jobs(max_attempts=2)
+        job = await db["jobs"].find_one({"_id": job_id})
+        assert job["status"] == "failed" and job["attempts"] == 2
+
+    loop.run_until_complete(scenario())
+
+def test_run_job_cancels_the_work_when_the_lease_is_lost(monkeypatch):
+    events = []
+
+    async def slow_job():
+        try:
+            await asyncio.sleep(30)
+            events.append("finished")
+        except asyncio.CancelledError:
+            events.append("cancelled")
+            raise
+
+    monkeypatch.setitem(async_worker.JOB_DISPATCH, "test_slow_job", slow_job)
+    monkeypatch.setattr(async_worker, "JOB_HEARTBEAT_SECONDS", 0.1)
+
+    async def scenario():
+        job_id = await enqueue_job("test_slow_job")
+        job = await claim_job(async_worker.WORKER_ID, 60)
+        running = asyncio.create_task(async_worker.run_job(job))
+        await asyncio.sleep(0.2)
+        # Another worker claimed the job after its lease expired
+        await db["jobs"].update_one({"_id": job_id}, {"$set": {"owner": "worker-b"}, "$inc": {"attempts": 1}})
+        await asyncio.wait_for(running, timeout=5)
+        stored = await db["jobs"].find_one({"_id": job_id})
+        assert events == ["cancelled"]
+        assert stored["status"] == "running" and stored["owner"] == "worker-b"
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,25 @@
+"""
+Record ids of an import grow with the ordinals, also past the 3 byte counter ObjectId() wraps around.
+"""
+from datetime import datetime
+from bson.objectid import ObjectId
+import pandas as pd
+from app.utils.bson_utils import encode_records, new_record_ids_prefix, record_object_id
+from app.utils.records_utils import build_records
+
+WRAPPING_ORDINAL = 2 ** 24 - 2
+
+def test_record_ids_follow_the_ordinals():
+    ids_prefix = new_record_ids_prefix(datetime.now())
+    ids = [record_object_id(ids_prefix, ordinal) for ordinal in range(WRAPPING_ORDINAL, WRAPPING_ORDINAL + 4)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+def test_imported_records_are_in_id_order():
+    chunk = pd.DataFrame({"price": [1.5, 2.5, None, 4.5], "name": ["a", "b", "c", None]})
+    ids_prefix = new_record_ids_prefix(datetime.now())
+    now = datetime.now()
+    for records in [build_records(chunk, ObjectId(), WRAPPING_ORDINAL, now, ids_prefix), encode_records(chunk, ObjectId(), WRAPPING_ORDINAL, now, ids_prefix)]:
+        ids = [record["_id"] for record in records]
+        assert ids == sorted(ids)
+        assert [record["ordinal"] for record in records] == list(range(WRAPPING_ORDINAL, WRAPPING_ORDINAL + 4))
@@ -0,0 +1,34 @@
+"""
+Zone maps are used while the records are as imported: record writes stop them, metadata updates resetting the
+repository version do not bring stale ones back.
+"""
+from bson.objectid import ObjectId
+from app.utils import records_utils, zone_maps_utils
+import asyncio
+import pandas as pd
+
+REPOSITORY_ID = ObjectId()
+IMPORT_ID = ObjectId()
+PROCESSES = [{"process_id": ObjectId(), "task_process": "filter", "parameters": [{"name": "price", "operator": ">", "value": 100}]}]
+
+async def insert_import(db):
+    await db["repositories"].insert_one({"_id": REPOSITORY_ID, "version": 0, "current_data_size": 4, "zone_maps_import_id": IMPORT_ID})
+    for first_ordinal, prices in [(0, [1, 2]), (2, [150, 160])]:
+        zone_map = zone_maps_utils.compute_zone_map(pd.DataFrame({"price": prices}), REPOSITORY_ID, IMPORT_ID, ObjectId(), ObjectId(), first_ordinal)
+        await db["zone_maps"].insert_one(zone_map)
+
+def test_record_writes_invalidate_the_zone_maps(mock_db):
+    db = mock_db(records_utils, zone_maps_utils)
+
+    async def scenario():
+        await insert_import(db)
+        zone_plan = await zone_maps_utils.get_zone_plan(str(REPOSITORY_ID), PROCESSES, ["filter"], 2)
+        assert zone_plan is not None
+        assert zone_plan.is_batch_empty(1) and not zone_plan.is_batch_empty(2)
+
+        await records_utils.invalidate_zone_maps(REPOSITORY_ID)
+        # A metadata update resets the version, the zone maps stay invalid
+        await db["repositories"].update_one({"_id": REPOSITORY_ID}, {"$set": {"version": 0}})
+        assert await zone_maps_utils.get_zone_plan(str(REPOSITORY_ID), PROCESSES, ["filter"], 2) is None
+
+    asyncio.run(scenario())
@@ -70,7 +70,7 @@ export default function EditRecordPage() {
   }, [role, authLoading]);
 
   const handleEdit = (form) => {
-    return api.put(`/records/${record._id.$oid}`, form)
+    return api.put(`/records/${record._id.$oid}?repository=${searchParams.get("repository")}`, form)
   };
 
   return (
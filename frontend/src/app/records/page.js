@@ -80,7 +80,7 @@ export default function RecordsListPage() {
 
   const confirmDelete = async () => {
     try {
-      await api.delete(`/records/${recordToDelete._id.$oid}`);
+      await api.delete(`/records/${recordToDelete._id.$oid}?repository=${searchParams.get("repository")}`);
       showSnackbar(`Record "${recordToDelete._id.$oid}" deleted successfully`, "success", true, "bottom-right");
       setRecords(prev => prev.filter((repo) => repo._id.$oid !== recordToDelete._id.$oid));
       setRepository(prev => ({
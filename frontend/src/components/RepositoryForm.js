@@ -150,10 +150,10 @@ export default function RepositoryForm({
             <label className="mt-2 block text-sm font-medium text-gray-700">Make sure the file has been uploaded to {process.env.NEXT_PUBLIC_UPLOAD_DIR}.</label>
           </div>
           <div className={largeFile ? 'hidden':  'visible'}>
-            <label className="block text-sm font-medium text-gray-700">CSV File</label>
+            <label className="block text-sm font-medium text-gray-700">Data File (CSV, JSON Lines, gzip/zstd compressed, or Parquet)</label>
             <input
               type="file"
-              accept='text/csv'
+              accept='.csv,.jsonl,.ndjson,.gz,.zst,.parquet,text/csv'
               onChange={(e) => {
                 const selectedFile = e.target.files[0];
                 if (selectedFile && selectedFile.size > maxFileSizeBytes) {